@@ -24,7 +24,9 @@ setup(name='virltester',
           "Development Status :: 3 - Alpha",
           "Topic :: Utilities",
           "License :: OSI Approved :: MIT License",
+          "Programming Language :: Python :: 3",
       ],
+      python_requires='>=3.7',
       entry_points={
           'console_scripts': [
               'virltester=virltester.tester:main',
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmark of do_all_sims against the fake VIRL API (see
+fakevirl.py), no lab hardware needed. For every engine and number of
+sims the fake API and the tester run in processes of their own, so
+the CPU time and peak memory are the tester's only:
+
+python test/benchmark.py --sims 1 10 100 500 --boot 2 --latency 0.01
+
+reports the makespan (wall time of do_all_sims), API calls, CPU time
+(of do_all_sims) and peak RSS per run."""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, process_time
+from urllib.request import urlopen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from virltester.plan import Plan  # noqa: E402
+from virltester.tester import do_all_sims  # noqa: E402
+
+
+def cmdfile(args, port, workdir):
+    "The command file: sims with 'actions' chained captures each."
+    topo = os.path.join(workdir, 'topo.virl')
+    with open(topo, 'w') as fh:
+        fh.write('<topology/>')
+    actions = [dict(type='filter', intfc='GigabitEthernet0/1',
+                    expect_min=1) for _ in range(args.actions)]
+    config = dict(host='127.0.0.1', port=port, wait=300,
+                  parallel=args.parallel, engine=args.engine,
+                  captures=workdir)
+    return dict(config=config, sims=[
+        dict(topo=topo, nodes=[dict(name='iosv-1', actions=actions)])
+        for _ in range(args.worker)])
+
+
+def worker(args):
+    "Run the sims once, print the measurements as JSON."
+    logging.basicConfig(level=logging.CRITICAL)
+    workdir = tempfile.mkdtemp(prefix='virltester-bench-')
+    try:
+        plan = Plan(cmdfile(args, args.port, workdir))
+        started, cpu = perf_counter(), process_time()
+        ok = do_all_sims(plan, logging.getLogger())
+        makespan, cpu = perf_counter() - started, process_time() - cpu
+    finally:
+        shutil.rmtree(workdir)
+    total, passed = plan.summary()
+    # ru_maxrss is in KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps(dict(ok=ok, actions=total, passed=passed,
+                          makespan=round(makespan, 3),
+                          cpu=round(cpu, 3),
+                          rss_mb=round(rss / 1024.0, 1))))
+
+
+def fake_virl(args):
+    "Start the fake VIRL API, returns the process and its port."
+    command = [sys.executable, os.path.join(HERE, 'fakevirl.py'),
+               '--nodes', str(args.nodes), '--boot', str(args.boot),
+               '--latency', str(args.latency),
+               '--capture', str(args.capture)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE,
+                              universal_newlines=True)
+    return server, int(server.stdout.readline())
+
+
+def run(args, engine, sims):
+    "One benchmark run, returns its measurements."
+    server, port = fake_virl(args)
+    try:
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--worker', str(sims), '--port', str(port),
+                   '--engine', engine, '--parallel', str(args.parallel),
+                   '--actions', str(args.actions)]
+        output = subprocess.check_output(command, universal_newlines=True)
+        result = json.loads(output.strip().split('\n')[-1])
+        with urlopen('http://127.0.0.1:%d/_stats' % port) as r:
+            result['calls'] = sum(json.loads(r.read())['calls'].values())
+    finally:
+        server.terminate()
+        server.wait()
+    result.update(engine=engine, sims=sims)
+    return result
+
+
+def main():
+    "Run the benchmark, print a table (and write JSON lines)."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sims', type=int, nargs='+',
+                        default=[1, 10, 100, 500],
+                        help="numbers of sims to run (1 10 100 500)")
+    parser.add_argument('--engine', action='append',
+                        choices=('threads', 'asyncio'),
+                        help="engine(s) to run (default both)")
+    parser.add_argument('--parallel', type=int, default=50,
+                        help="sims running in parallel (50)")
+    parser.add_argument('--actions', type=int, default=2,
+                        help="capture actions per sim (2)")
+    parser.add_argument('--nodes', type=int, default=3,
+                        help="nodes per sim (3)")
+    parser.add_argument('--boot', type=float, default=0,
+                        help="node boot time in seconds (0)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="API latency in seconds (0)")
+    parser.add_argument('--capture', type=float, default=0,
+                        help="capture run time in seconds (0)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON lines to FILE")
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        args.engine = args.engine[0]
+        worker(args)
+        return 0
+
+    results = list()
+    print('%-8s %5s %10s %7s %8s %8s %7s' % (
+        'engine', 'sims', 'makespan', 'calls', 'cpu', 'rss MB', 'passed'))
+    for engine in args.engine or ('threads', 'asyncio'):
+        for sims in args.sims:
+            result = run(args, engine, sims)
+            results.append(result)
+            print('%-8s %5d %9.2fs %7d %7.2fs %8.1f %3d/%-3d' % (
+                engine, sims, result['makespan'], result['calls'],
+                result['cpu'], result['rss_mb'], result['passed'],
+                result['actions']))
+            sys.stdout.flush()
+    if args.json:
+        with open(args.json, 'w') as fh:
+            for result in results:
+                fh.write(json.dumps(result) + '\n')
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
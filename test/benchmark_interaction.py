@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Latency benchmark of the device interaction (command.interaction())
+against the fake mgmt LXC and devices (see fakelxc.py), no lab hardware
+needed. The fake VIRL API and LXC run in processes of their own, for
+every mode (native channels or the LXC shell), transport and number of
+concurrent interactions
+
+python test/benchmark_interaction.py --concurrency 1 4 16 --delay 0.01
+
+reports the interaction latency, the round trip per command (p50/p95),
+the expect overhead (round trip less the device delay), the login time
+and the throughput in commands and output bytes per second. With
+--baseline the results of an earlier --json run are the reference and
+the exit code is 1 if a round trip or the throughput got worse by more
+than --tolerance."""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from fakelxc import Device  # noqa: E402
+from virltester import metrics  # noqa: E402
+from virltester.command import interaction  # noqa: E402
+from virltester.trace import TRACER  # noqa: E402
+from virltester.virlsim import VIRLSim  # noqa: E402
+
+
+def percentile(values, p):
+    "The p-th percentile (nearest rank) of the values, 0 if none."
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def spawn(script, *args):
+    "Start a fake of the test directory, returns the process and its port."
+    command = [sys.executable, os.path.join(HERE, script)]
+    command.extend(str(arg) for arg in args)
+    server = subprocess.Popen(command, stdout=subprocess.PIPE,
+                              universal_newlines=True)
+    return server, int(server.stdout.readline())
+
+
+def commands(args):
+    "The commands of one interaction."
+    return ['show bench %d' % (i + 1) for i in range(args.commands)]
+
+
+def run(args, port, mode, transport, concurrency, topo):
+    """Run 'interactions' interactions in each of 'concurrency' threads,
+    every thread with a device of its own. Returns the measurements."""
+    logger = logging.getLogger('bench')
+    sim = VIRLSim('127.0.0.1', 'guest', 'guest', topo, logger=logger,
+                  port=port, timeout=60, sessions=concurrency,
+                  native=(mode == 'native'))
+    if not (sim.startSim() and sim.waitForSimStart()):
+        raise RuntimeError('the fake sim did not start')
+    lines = commands(args)
+    latencies, failed = list(), list()
+    lock = threading.Lock()
+
+    def worker(index):
+        address = '10.255.0.%d' % (index % args.devices + 1)
+        for _ in range(args.interactions):
+            started = perf_counter()
+            ok = interaction(sim, None, address, transport, 'cisco',
+                             'cisco', lines, r'r\d+ 1: ', 'one',
+                             args.timeout, persistent=args.persistent)
+            with lock:
+                latencies.append(perf_counter() - started)
+                if not ok:
+                    failed.append(address)
+
+    login = metrics.LOGIN_SECONDS
+    logins = login.count(transport=transport)
+    login_total = login.total(transport=transport)
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    TRACER.enable()
+    started = perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = perf_counter() - started
+    finally:
+        TRACER.disable()
+        sim.stopSim()
+
+    rtts = [e['dur'] / 1e6 for e in TRACER.events()
+            if e.get('cat') == 'device' and e['name'] in lines]
+    logins = login.count(transport=transport) - logins
+    login_total = login.total(transport=transport) - login_total
+    device = Device('r1', size=args.size, width=args.width)
+    size = sum(len(device.output(line).replace('\n', '\r\n')) + 2
+               for line in lines)
+    done = len(latencies) - len(failed)
+    rtt_p50 = percentile(rtts, 50)
+    return dict(
+        mode=mode, transport=transport, concurrency=concurrency,
+        interactions=len(latencies), failed=len(failed),
+        latency_p50=round(percentile(latencies, 50), 4),
+        latency_p95=round(percentile(latencies, 95), 4),
+        rtt_p50=round(rtt_p50, 4),
+        rtt_p95=round(percentile(rtts, 95), 4),
+        overhead=round(max(0.0, rtt_p50 - args.delay), 4),
+        logins=logins,
+        login=round(login_total / logins, 4) if logins else 0.0,
+        cmds=round(len(rtts) / wall, 1),
+        bytes=round(done * size / wall, 1))
+
+
+def regressions(results, baseline, tolerance):
+    "The results which are worse than their baseline (as messages)."
+    reference = dict(((r['mode'], r['transport'], r['concurrency']), r)
+                     for r in baseline)
+    messages = list()
+    for result in results:
+        key = (result['mode'], result['transport'], result['concurrency'])
+        base = reference.get(key)
+        if base is None:
+            continue
+        name = '%s/%s/%d' % key
+        for field in ('rtt_p50', 'rtt_p95'):
+            if result[field] > base[field] * (1 + tolerance):
+                messages.append('%s: %s %.4fs (baseline %.4fs)' % (
+                    name, field, result[field], base[field]))
+        if result['cmds'] * (1 + tolerance) < base['cmds']:
+            messages.append('%s: %.1f commands/s (baseline %.1f)' % (
+                name, result['cmds'], base['cmds']))
+    return messages
+
+
+def main():
+    "Run the benchmark, print a table (and write JSON lines)."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', action='append',
+                        choices=('native', 'shell'),
+                        help="mode(s) to run (default both)")
+    parser.add_argument('--transport', action='append',
+                        choices=('telnet', 'ssh'),
+                        help="transport(s) to run (default both)")
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16],
+                        help="concurrent interactions (1 4 16)")
+    parser.add_argument('--interactions', type=int, default=10,
+                        help="interactions per thread (10)")
+    parser.add_argument('--commands', type=int, default=5,
+                        help="commands per interaction (5)")
+    parser.add_argument('--persistent', action='store_true',
+                        help="keep the device logins between interactions")
+    parser.add_argument('--kind', choices=('ios', 'nxos', 'xr', 'linux'),
+                        default='ios', help="device kind (ios)")
+    parser.add_argument('--size', type=int, default=10,
+                        help="output lines per command (10)")
+    parser.add_argument('--width', type=int, default=72,
+                        help="characters per output line (72)")
+    parser.add_argument('--delay', type=float, default=0,
+                        help="device delay per command in seconds (0)")
+    parser.add_argument('--timeout', type=int, default=30,
+                        help="interaction timeout in seconds (30)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON lines to FILE")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="JSON lines of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown against the baseline (0.25)")
+    args = parser.parse_args()
+    args.devices = max(args.concurrency)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    lxc, lxc_port = spawn(
+        'fakelxc.py', '--devices', args.devices, '--kind', args.kind,
+        '--size', args.size, '--width', args.width, '--delay', args.delay)
+    virl, port = spawn('fakevirl.py', '--nodes', args.devices,
+                       '--lxc-port', lxc_port)
+    fh, topo = tempfile.mkstemp(prefix='virltester-bench-', suffix='.virl')
+    os.write(fh, b'<topology/>')
+    os.close(fh)
+
+    results = list()
+    print('%-6s %-6s %4s %9s %9s %9s %9s %9s %6s %8s %8s %10s %6s' % (
+        'mode', 'trans', 'conc', 'lat p50', 'lat p95', 'rtt p50',
+        'rtt p95', 'overhead', 'logins', 'login', 'cmds/s', 'bytes/s',
+        'failed'))
+    try:
+        for mode in args.mode or ('native', 'shell'):
+            for transport in args.transport or ('telnet', 'ssh'):
+                for concurrency in args.concurrency:
+                    r = run(args, port, mode, transport, concurrency, topo)
+                    results.append(r)
+                    print('%-6s %-6s %4d %8.1fms %8.1fms %8.2fms %8.2fms '
+                          '%8.2fms %6d %7.1fms %8.1f %10.0f %6d' % (
+                              mode, transport, concurrency,
+                              r['latency_p50'] * 1e3,
+                              r['latency_p95'] * 1e3, r['rtt_p50'] * 1e3,
+                              r['rtt_p95'] * 1e3, r['overhead'] * 1e3,
+                              r['logins'], r['login'] * 1e3, r['cmds'],
+                              r['bytes'], r['failed']))
+                    sys.stdout.flush()
+    finally:
+        for server in (virl, lxc):
+            server.terminate()
+            server.wait()
+        os.remove(topo)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            for result in results:
+                fh.write(json.dumps(result) + '\n')
+    code = 0 if not any(r['failed'] for r in results) else 1
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = [json.loads(line) for line in fh if line.strip()]
+        for message in regressions(results, baseline, args.tolerance):
+            print('REGRESSION %s' % message)
+            code = 1
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
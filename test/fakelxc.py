@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+"""A fake mgmt LXC for the device interaction: a paramiko SSH server
+with the shell prompt of the LXC from which 'ssh' and 'telnet' reach
+emulated IOS, NX-OS, IOS XR and Linux devices (see prompts.py). It also
+forwards direct-tcpip channels (the native transport) to the devices,
+port 23 speaks telnet and port 22 SSH. Devices answer with scripted
+outputs or generated ones of a configurable size after a configurable
+delay. Runs in a thread of the tests or stand-alone for the interaction
+benchmark:
+
+python test/fakelxc.py --devices 16 --size 100 --delay 0.01
+
+prints the port it listens on, the devices are at 10.255.0.1 and up
+(the management addresses handed out by fakevirl.py)."""
+
+import argparse
+import logging
+import select
+import socket
+import sys
+import threading
+from time import sleep
+
+import paramiko
+
+# login prompt, unprivileged, privileged and configuration prompt
+KINDS = dict(
+    ios=('Username: ', '{host}>', '{host}#', '{host}(config)#'),
+    nxos=('login: ', None, '{host}# ', '{host}(config)# '),
+    xr=('Username: ', None, 'RP/0/0/CPU0:{host}#', None),
+    linux=('login: ', None, '{user}@{host}:~$ ', None),
+)
+
+# Ctrl-C and Ctrl-^ abort a running command
+BREAK = ('\x03', '\x1e')
+
+# characters of output sent at once, a break is checked in between
+CHUNK = 4096
+
+_host_key = None
+_key_lock = threading.Lock()
+
+
+def host_key():
+    "The host key of all fake SSH servers (generated once)."
+    global _host_key
+    with _key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+class Terminal(object):
+    """Line oriented I/O on a channel or socket. Lines end with CR, LF or CR LF and
+    are echoed like a pty does (passwords are not). Raises EOFError
+    when the channel is closed."""
+
+    def __init__(self, channel):
+        super(Terminal, self).__init__()
+        self.channel = channel
+        self._buffer = ''
+        self._cr = False
+
+    def write(self, text):
+        "Send the text, LF becomes CR LF."
+        try:
+            self.channel.sendall(text.replace('\n', '\r\n').encode())
+        except socket.error:
+            raise EOFError('channel closed')
+
+    def _fill(self):
+        data = self.channel.recv(1024)
+        if not data:
+            raise EOFError('channel closed')
+        self._buffer += data.decode('utf-8', 'ignore')
+
+    def readline(self, echo=True):
+        "The next line without its end, input before a break is dropped."
+        while True:
+            # LF of a CR LF which was split across two reads
+            if self._cr and self._buffer:
+                if self._buffer[0] == '\n':
+                    self._buffer = self._buffer[1:]
+                self._cr = False
+            ends = [i for i in (self._buffer.find('\r'),
+                                self._buffer.find('\n')) if i >= 0]
+            if ends:
+                end = min(ends)
+                line = self._buffer[:end]
+                self._cr = self._buffer[end] == '\r'
+                self._buffer = self._buffer[end + 1:]
+                line = line[max(line.rfind(c) for c in BREAK) + 1:]
+                if echo:
+                    self.write(line + '\n')
+                return line
+            self._fill()
+
+    def _ready(self):
+        "True if input is waiting (the channel may be a socket)."
+        ready = getattr(self.channel, 'recv_ready', None)
+        if ready is not None:
+            return ready()
+        return bool(select.select([self.channel], [], [], 0)[0])
+
+    def interrupted(self):
+        "True if a break has come in, the input up to it is dropped."
+        if not self._ready():
+            return False
+        self._fill()
+        pos = max(self._buffer.rfind(c) for c in BREAK)
+        if pos < 0:
+            return False
+        self._buffer = self._buffer[pos + 1:]
+        return True
+
+
+class Device(object):
+    """An emulated device of the given kind (see KINDS). outputs maps
+    commands to their output (a string or a function of the command),
+    other commands get 'size' generated lines of 'width' characters.
+    Every command takes 'delay' seconds. IOS devices start unprivileged
+    and are enabled with the password. logins and commands count the
+    sessions and commands served."""
+
+    def __init__(self, hostname='router', kind='ios', outputs=None, size=10,
+                 width=72, delay=0, username='cisco', password='cisco'):
+        super(Device, self).__init__()
+        self.hostname = hostname
+        self.kind = kind
+        self.outputs = outputs or dict()
+        self.size = size
+        self.width = width
+        self.delay = delay
+        self.username = username
+        self.password = password
+        self.logins = 0
+        self.commands = 0
+        self._lock = threading.Lock()
+
+    def prompt(self, mode):
+        "The prompt in 'exec', 'priv' or 'config' mode."
+        _, user, priv, config = KINDS[self.kind]
+        prompt = dict(exec=user or priv, priv=priv, config=config)[mode]
+        return prompt.format(host=self.hostname, user=self.username)
+
+    def output(self, command):
+        "The output of the command."
+        output = self.outputs.get(command)
+        if callable(output):
+            return output(command)
+        if output is not None:
+            return output
+        return '\n'.join(
+            ('%s %d: %s ' % (self.hostname, n + 1, command)).ljust(
+                self.width, '.') for n in range(self.size))
+
+    def login(self, term):
+        "Ask for the username and password, True if they match."
+        if self.kind in ('ios', 'xr'):
+            term.write('\nUser Access Verification\n\n')
+        for _ in range(3):
+            term.write(KINDS[self.kind][0])
+            username = term.readline()
+            term.write('Password: ')
+            password = term.readline(echo=False)
+            term.write('\n')
+            if (username, password) == (self.username, self.password):
+                return True
+            term.write('% Login invalid\n\n')
+        return False
+
+    def _send(self, term, output):
+        "Send the output in chunks, stops at a break."
+        for pos in range(0, len(output), CHUNK):
+            if term.interrupted():
+                term.write('^C\n')
+                return
+            term.write(output[pos:pos + CHUNK])
+
+    def _command(self, term, line, mode):
+        "Run the command, returns the new mode (None to log out)."
+        words = line.split()
+        if not words:
+            return mode
+        if words[0] in ('exit', 'logout', 'quit'):
+            return 'priv' if mode == 'config' else None
+        if words[0] == 'end' and mode == 'config':
+            return 'priv'
+        if words[0] == 'enable' and mode == 'exec':
+            if KINDS[self.kind][1] is None:
+                return mode
+            term.write('Password: ')
+            password = term.readline(echo=False)
+            term.write('\n')
+            if password != self.password:
+                term.write('% Access denied\n')
+                return mode
+            return 'priv'
+        if words[0] in ('conf', 'configure') and mode == 'priv':
+            if KINDS[self.kind][3] is not None:
+                term.write('Enter configuration commands, one per line.  '
+                           'End with CNTL/Z.\n')
+                return 'config'
+        if words[0] == 'terminal':
+            return mode
+
+        with self._lock:
+            self.commands += 1
+        if self.delay:
+            sleep(self.delay)
+        self._send(term, self.output(line) + '\n')
+        return mode
+
+    def serve(self, term, login=True):
+        """Run a session on the terminal: log in (unless the transport did,
+        i.e. SSH) and run commands until the user logs out."""
+        try:
+            if login and not self.login(term):
+                return
+            if not login:
+                # the prompt is on a line of its own like after a login
+                term.write('\n')
+            with self._lock:
+                self.logins += 1
+            mode = 'exec'
+            while mode is not None:
+                term.write(self.prompt(mode))
+                mode = self._command(term, term.readline().strip(), mode)
+        except EOFError:
+            pass
+
+
+class _Server(paramiko.ServerInterface):
+    """Accepts every password (or the device's), session channels with a
+    pty and shell and, if forwarding, direct-tcpip channels to known
+    devices."""
+
+    def __init__(self, devices=None, forward=False, device=None):
+        super(_Server, self).__init__()
+        self.devices = devices or dict()
+        self.forward = forward
+        self.device = device
+        self.username = None
+        self.targets = dict()
+        self.shells = dict()
+        self._lock = threading.Lock()
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        device = self.device
+        if device is not None and (username, password) != (
+                device.username, device.password):
+            return paramiko.AUTH_FAILED
+        self.username = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def shell(self, chanid):
+        "The event set when the channel got its shell."
+        with self._lock:
+            return self.shells.setdefault(chanid, threading.Event())
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if not self.forward:
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        address, port = destination
+        if address not in self.devices or port not in (22, 23):
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        with self._lock:
+            self.targets[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, *_):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell(channel.get_id()).set()
+        return True
+
+
+class FakeConsole(object):
+    """The serial console of a device: a telnet port on 127.0.0.1 which
+    serves one connection at a time. Like a console it stays silent
+    until the first line comes in."""
+
+    def __init__(self, device, port=0):
+        super(FakeConsole, self).__init__()
+        self.device = device
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(1)
+        self._closed = False
+
+    @property
+    def port(self):
+        "The TCP port of the console."
+        return self._socket.getsockname()[1]
+
+    def serve(self):
+        "Serve connections in the calling thread until closed."
+        while not self._closed:
+            try:
+                conn, _ = self._socket.accept()
+            except socket.error:
+                break
+            term = Terminal(conn)
+            try:
+                term.readline()
+                self.device.serve(term)
+            except EOFError:
+                pass
+            conn.close()
+
+    def start(self):
+        "Serve in a background thread."
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def close(self):
+        "Stop serving."
+        self._closed = True
+        self._socket.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class FakeLXC(object):
+    """The mgmt LXC on 127.0.0.1: an SSH server (any password) with the
+    shell prompt user@hostname$. devices maps IP addresses to Devices.
+    forward=False refuses direct-tcpip channels like an LXC without
+    port forwarding. Connecting to a device takes 'delay' seconds.
+    connections and channels count the SSH connections and the
+    forwarded channels."""
+
+    def __init__(self, devices=None, hostname='mgmt-lxc', forward=True,
+                 delay=0, port=0):
+        super(FakeLXC, self).__init__()
+        self.devices = devices or dict()
+        self.hostname = hostname
+        self.forward = forward
+        self.delay = delay
+        self.connections = 0
+        self.channels = 0
+        self._lock = threading.Lock()
+        self._transports = list()
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(50)
+        self._closed = False
+
+    @property
+    def port(self):
+        "The TCP port of the SSH server."
+        return self._socket.getsockname()[1]
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        "Accept SSH connections in the calling thread until closed."
+        host_key()
+        while not self._closed:
+            try:
+                conn, _ = self._socket.accept()
+            except socket.error:
+                break
+            self._spawn(self._connection, conn)
+
+    def start(self):
+        "Serve in a background thread."
+        self._spawn(self.serve)
+        return self
+
+    def close(self):
+        "Stop serving and drop all connections."
+        self._closed = True
+        self._socket.close()
+        with self._lock:
+            transports, self._transports = self._transports, list()
+        for transport in transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _connection(self, conn):
+        # sshd does this for interactive sessions, echo, output and
+        # prompt would wait for delayed ACKs otherwise
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key())
+        server = _Server(self.devices, self.forward)
+        try:
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError, socket.error):
+            return
+        with self._lock:
+            self.connections += 1
+            self._transports.append(transport)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            with server._lock:
+                target = server.targets.pop(channel.get_id(), None)
+            if target is not None:
+                with self._lock:
+                    self.channels += 1
+                self._spawn(self._forward, channel, target)
+            else:
+                self._spawn(self._shell, channel, server)
+
+    def _forward(self, channel, target):
+        "A forwarded channel to a device: telnet (23) or SSH (22)."
+        address, port = target
+        device = self.devices[address]
+        if self.delay:
+            sleep(self.delay)
+        if port == 23:
+            device.serve(Terminal(channel))
+            channel.close()
+            return
+        transport = paramiko.Transport(channel)
+        transport.add_server_key(host_key())
+        server = _Server(device=device)
+        try:
+            transport.start_server(server=server)
+            session = transport.accept(10)
+            if session is not None and server.shell(
+                    session.get_id()).wait(10):
+                device.serve(Terminal(session), login=False)
+                session.close()
+        except (paramiko.SSHException, EOFError, socket.error):
+            pass
+        transport.close()
+
+    def _shell(self, channel, server):
+        "The shell of the LXC, 'ssh' and 'telnet' reach the devices."
+        if not server.shell(channel.get_id()).wait(10):
+            channel.close()
+            return
+        term = Terminal(channel)
+        prompt = '%s@%s$ ' % (server.username, self.hostname)
+        try:
+            # the first prompt comes with the answer to the first line,
+            # like a shell which starts up slower than the client types
+            term.write('Welcome to the mgmt LXC of %s\n' % self.hostname)
+            while True:
+                words = term.readline().split()
+                if words and words[0] in ('exit', 'logout'):
+                    break
+                if words and words[0] == 'telnet' and len(words) > 1:
+                    self._telnet(term, words[1])
+                elif words and words[0] == 'ssh' and '@' in words[-1]:
+                    self._ssh(term, *words[-1].split('@', 1))
+                elif words:
+                    term.write('-bash: %s: command not found\n' % words[0])
+                term.write(prompt)
+        except EOFError:
+            pass
+        channel.close()
+
+    def _telnet(self, term, address):
+        term.write('Trying %s...\n' % address)
+        if self.delay:
+            sleep(self.delay)
+        device = self.devices.get(address)
+        if device is None:
+            term.write('telnet: Unable to connect to remote host: '
+                       'Connection refused\n')
+            return
+        term.write("Connected to %s.\nEscape character is '^]'.\n" % address)
+        device.serve(term)
+        term.write('Connection closed by foreign host.\n')
+
+    def _ssh(self, term, username, address):
+        if self.delay:
+            sleep(self.delay)
+        device = self.devices.get(address)
+        if device is None:
+            term.write('ssh: connect to host %s port 22: '
+                       'Connection refused\n' % address)
+            return
+        for _ in range(3):
+            term.write("%s@%s's password: " % (username, address))
+            password = term.readline(echo=False)
+            term.write('\n')
+            if (username, password) == (device.username, device.password):
+                device.serve(term, login=False)
+                term.write('Connection to %s closed.\n' % address)
+                return
+            term.write('Permission denied, please try again.\n')
+        term.write('%s@%s: Permission denied (password).\n' % (
+            username, address))
+
+
+def main():
+    "Run the fake mgmt LXC until interrupted."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--devices', type=int, default=3)
+    parser.add_argument('--kind', choices=sorted(KINDS), default='ios')
+    parser.add_argument('--size', type=int, default=10)
+    parser.add_argument('--width', type=int, default=72)
+    parser.add_argument('--delay', type=float, default=0)
+    parser.add_argument('--connect-delay', type=float, default=0)
+    parser.add_argument('--no-forward', action='store_true')
+    args = parser.parse_args()
+    # connections reset by the tester are no news
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    devices = dict(('10.255.0.%d' % (i + 1), Device(
+        'r%d' % (i + 1), args.kind, size=args.size, width=args.width,
+        delay=args.delay)) for i in range(args.devices))
+    lxc = FakeLXC(devices, forward=not args.no_forward,
+                  delay=args.connect_delay, port=args.port)
+    print(lxc.port)
+    sys.stdout.flush()
+    try:
+        lxc.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
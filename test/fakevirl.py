@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""A stand-in for the VIRL API: the simengine and roster endpoints used
+by VIRLSim (launch, list, nodes, interfaces, capture, stop, status,
+events and the roster) with configurable latency, node boot, capture
+and stop times. Runs in a thread of the tests or stand-alone for the
+benchmark:
+
+python test/fakevirl.py --boot 5 --latency 0.02
+
+prints the port it listens on. GET /_stats returns the number of API
+calls per verb and endpoint (not part of the VIRL API)."""
+
+import argparse
+import json
+import random
+import string
+import struct
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+
+def make_pcap(packets):
+    "A pcap file with the given number of ICMP echo requests."
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28, 0, 0, 64, 1, 0,
+                     bytes((10, 0, 0, 1)), bytes((10, 0, 0, 2)))
+    frame = b'\x00' * 12 + b'\x08\x00' + ip + b'\x08\x00\x00\x00' * 2
+    data = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    for ts in range(packets):
+        data += struct.pack('<IIII', ts, 0, len(frame), len(frame)) + frame
+    return data
+
+
+class FakeSim(object):
+    "A launched simulation with its nodes and captures."
+
+    def __init__(self, sim_id, nodes):
+        super(FakeSim, self).__init__()
+        self.sim_id = sim_id
+        self.nodes = nodes
+        self.launched = time()
+        self.stopped = None
+        self.captures = dict()
+
+
+class FakeVIRL(object):
+    """The VIRL API of a host on 127.0.0.1. nodes is the number of IOSv
+    nodes of every sim (or their names), they are reachable 'boot'
+    seconds after the launch. Captures run for 'capture' seconds and
+    hold 'packets' packets, a stopped sim is DONE after 'stop' seconds.
+    latency (seconds) delays every response, a dict gives it per
+    endpoint ('*' is the default). lxc_port is the SSH port of the mgmt
+    LXC handed out for every sim."""
+
+    def __init__(self, nodes=3, boot=0, latency=0, capture=0, stop=0,
+                 packets=10, lxc_port=0, port=0):
+        super(FakeVIRL, self).__init__()
+        if isinstance(nodes, int):
+            nodes = ['iosv-%d' % (i + 1) for i in range(nodes)]
+        self.nodes = list(nodes)
+        self.boot = boot
+        self.latency = latency
+        self.capture = capture
+        self.stop = stop
+        self.pcap = make_pcap(packets)
+        self.lxc_port = lxc_port
+        self.sims = dict()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.virl = self
+        self._thread = None
+
+    @property
+    def port(self):
+        "The TCP port the API listens on."
+        return self._server.server_address[1]
+
+    def serve(self):
+        "Serve in the calling thread until closed."
+        self._server.serve_forever()
+
+    def start(self):
+        "Serve in a background thread."
+        self._thread = threading.Thread(target=self.serve, name='fakevirl')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        "Stop serving."
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.close()
+
+    def delay(self, endpoint):
+        "The latency of the endpoint."
+        if isinstance(self.latency, dict):
+            return self.latency.get(endpoint, self.latency.get('*', 0))
+        return self.latency
+
+    def state(self, sim):
+        "ACTIVE, STOPPING or DONE."
+        if sim.stopped is None:
+            return 'ACTIVE'
+        return 'DONE' if time() - sim.stopped >= self.stop else 'STOPPING'
+
+    def handle(self, verb, path, query):
+        """Answer the API call, returns the status code, body, content
+        type and extra headers."""
+        parts = path.strip('/').split('/')
+        if parts[0] == 'roster':
+            endpoint, arg = 'roster', None
+        elif len(parts) > 2 and parts[:2] == ['simengine', 'rest']:
+            endpoint = parts[2]
+            arg = parts[3] if len(parts) > 3 else None
+        else:
+            endpoint, arg = parts[0], None
+        with self._lock:
+            self.calls['%s %s' % (verb, endpoint)] += 1
+        delay = self.delay(endpoint)
+        if delay:
+            sleep(delay)
+
+        method = getattr(self, '_%s_%s' % (verb.lower(), endpoint), None)
+        if method is None:
+            return 404, dict(cause='unknown call %s %s' % (verb, path))
+        if endpoint in ('launch', 'list', 'roster', '_stats'):
+            return method(query)
+        with self._lock:
+            sim = self.sims.get(arg)
+        if sim is None:
+            return 404, dict(cause='simulation %s not found' % arg)
+        return method(sim, query)
+
+    def _post_launch(self, query):
+        sim_id = query.get('session')
+        if sim_id is None:
+            sim_id = '%s-%s' % (query.get('file', 'topology'), ''.join(
+                random.choice(string.ascii_letters) for _ in range(6)))
+        with self._lock:
+            if sim_id in self.sims:
+                return 400, dict(cause='simulation %s exists' % sim_id)
+            self.sims[sim_id] = FakeSim(sim_id, self.nodes)
+        return 200, sim_id, 'text/plain'
+
+    def _get_list(self, query):
+        with self._lock:
+            sims = list(self.sims.values())
+        return 200, dict(simulations=dict(
+            (sim.sim_id, dict(status=self.state(sim))) for sim in sims
+            if self.state(sim) != 'DONE'))
+
+    def _get_roster(self, query):
+        roster = dict()
+        with self._lock:
+            sims = list(self.sims.values())
+        for sim in sims:
+            for i, node in enumerate(sim.nodes):
+                roster['guest|%s|virl|%s' % (sim.sim_id, node)] = dict(
+                    NodeSubtype='IOSv', PortConsole=17000 + i)
+        return 200, roster
+
+    def _get__stats(self, query):
+        with self._lock:
+            return 200, dict(calls=dict(self.calls), sims=len(self.sims))
+
+    def _get_nodes(self, sim, query):
+        up = sim.stopped is None and time() - sim.launched >= self.boot
+        state = 'ACTIVE' if sim.stopped is None else 'SHUTOFF'
+        return 200, {sim.sim_id: dict(
+            (node, dict(state=state, reachable=up)) for node in sim.nodes)}
+
+    def _get_interfaces(self, sim, query):
+        interfaces = dict()
+        for i, node in enumerate(sim.nodes):
+            interfaces[node] = {
+                'management': {'ip-address': '10.255.0.%d/16' % (i + 1)},
+                '0': {'name': 'GigabitEthernet0/1',
+                      'ip-address': '10.0.%d.1/24' % i},
+            }
+        interfaces['~mgmt-lxc'] = {
+            'management': {'ip-address': '10.255.255.254/16'},
+            '0': {'external-ip-address': '127.0.0.1',
+                  'external-port': str(self.lxc_port)},
+        }
+        node = query.get('nodes')
+        if node is not None:
+            interfaces = {node: interfaces.get(node)}
+        return 200, {sim.sim_id: interfaces}
+
+    def _post_capture(self, sim, query):
+        with self._lock:
+            cap_id = '%s_%s_%d' % (query.get('node'), query.get('interface'),
+                                   len(sim.captures))
+            sim.captures[cap_id] = time()
+        return 200, {cap_id: dict(running=True)}
+
+    def _get_capture(self, sim, query):
+        cap_id = query.get('capture')
+        if cap_id is None:
+            with self._lock:
+                captures = list(sim.captures.items())
+            return 200, dict((c, dict(running=time() - t < self.capture))
+                             for c, t in captures)
+        if cap_id not in sim.captures:
+            return 404, dict(cause='capture %s not found' % cap_id)
+        return 200, self.pcap, 'application/vnd.tcpdump.pcap', {
+            'Content-Disposition': 'attachment; filename=%s_%s.pcap' % (
+                sim.sim_id, cap_id)}
+
+    def _delete_capture(self, sim, query):
+        with self._lock:
+            sim.captures.pop(query.get('capture'), None)
+        return 200, dict()
+
+    def _get_stop(self, sim, query):
+        if sim.stopped is None:
+            sim.stopped = time()
+        return 200, dict()
+
+    def _get_status(self, sim, query):
+        return 200, dict(state=self.state(sim), launched=sim.launched)
+
+    def _get_events(self, sim, query):
+        events = [dict(time=sim.launched, event='launched')]
+        if sim.stopped is not None:
+            events.append(dict(time=sim.stopped, event='stopped'))
+        return 200, events
+
+
+class _Handler(BaseHTTPRequestHandler):
+    "Hands the requests to the FakeVIRL of the server."
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_):
+        pass
+
+    def _reply(self, verb):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        reply = self.server.virl.handle(verb, url.path, query)
+        code, body = reply[:2]
+        ctype = reply[2] if len(reply) > 2 else 'application/json'
+        headers = reply[3] if len(reply) > 3 else dict()
+        if ctype == 'application/json':
+            body = json.dumps(body)
+        if not isinstance(body, bytes):
+            body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply('GET')
+
+    def do_POST(self):
+        self._reply('POST')
+
+    def do_DELETE(self):
+        self._reply('DELETE')
+
+
+def main():
+    "Run the fake VIRL API until interrupted."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--boot', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--capture', type=float, default=0)
+    parser.add_argument('--stop', type=float, default=0)
+    parser.add_argument('--packets', type=int, default=10)
+    parser.add_argument('--lxc-port', type=int, default=0)
+    args = parser.parse_args()
+    virl = FakeVIRL(args.nodes, args.boot, args.latency, args.capture,
+                    args.stop, args.packets, args.lxc_port, args.port)
+    print(virl.port)
+    sys.stdout.flush()
+    try:
+        virl.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"Tests for matching command output against the expected REs."
+
+import pytest
+
+from virltester.assertions import OutputAssertion
+
+ROUTES = "C  10.0.0.0/24 is directly connected\nO  192.168.0.2 [110/2]\n"
+PING = "Type escape sequence to abort.\nSuccess rate is 100 percent (5/5)\n"
+
+
+def test_last_output_only():
+    "By default only the output of the last command is checked."
+    a = OutputAssertion('192.168.0.2')
+    assert not a.check([ROUTES, PING])
+    assert a.check([PING, ROUTES])
+
+
+def test_logic_all_and_negation():
+    "All REs must match, '!' negates."
+    assert OutputAssertion(['192.168.0.2', 'directly'], 'all').check(ROUTES)
+    assert not OutputAssertion(['192.168.0.2', '192.168.0.3'], 'all').check(ROUTES)
+    assert OutputAssertion(['192.168.0.3', '192.168.0.2'], 'one').check(ROUTES)
+    assert not OutputAssertion('192.168.0.2', '!one').check(ROUTES)
+
+
+def test_scope_all_reports_matches():
+    "Patterns match anywhere, matches tell command and line."
+    r = OutputAssertion(['192.168.0.2', 'Success'], 'all', 'all').check([ROUTES, PING])
+    assert r.ok and not r.missing
+    found = sorted((m.pattern, m.command, m.lineno) for m in r.matches)
+    assert found == [('192.168.0.2', 0, 1), ('Success', 1, 1)]
+
+
+def test_scope_each():
+    "Every command output has its own REs."
+    a = OutputAssertion([None, ['Success', '5/5']], 'all', 'each')
+    assert a.check([ROUTES, PING])
+    a = OutputAssertion(['Success', None], 'one', 'each')
+    r = a.check([ROUTES, PING])
+    assert not r and r.missing == ['Success']
+
+
+def test_empty_re_and_errors():
+    "An empty RE always matches, invalid settings raise."
+    assert OutputAssertion('').check('')
+    with pytest.raises(ValueError):
+        OutputAssertion('x', 'some')
+    with pytest.raises(ValueError):
+        OutputAssertion('x', scope='first')
+    # nothing to check would pass 'all' on the first line
+    with pytest.raises(ValueError):
+        OutputAssertion([], 'all')
+    with pytest.raises(ValueError):
+        OutputAssertion([None, None], 'all', 'each')
+
+
+def test_fail_patterns_and_streaming():
+    "Failure REs fail the check, a matcher decides on the first hit."
+    a = OutputAssertion('Success', fail=r'% Invalid input')
+    r = a.check(["% Invalid input detected\nSuccess rate is 100 percent"])
+    assert not r and r.failed.pattern == '% Invalid input'
+    m = a.matcher(1)
+    assert m.feed(0, '!!!!!') is None
+    assert m.feed(0, 'Success rate is 100 percent') is True
+    m = OutputAssertion('Success', fail='Success rate is 0').matcher(1)
+    assert m.feed(0, 'Success rate is 0 percent (0/5)') is False
+    assert OutputAssertion('!!', '!one').matcher(1).feed(0, '!!!!!') is False
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"Tests for compiling command files."
+
+import os
+
+import pytest
+
+from virltester.compiler import CompileError, Compiler, compile_file
+
+TOP = '''
+config:
+  host: {{ env["VIRL_HOST"] or "localhost" }}
+includes:
+- sub/inc.yml
+sims:
+- topo: top.virl
+  nodes:
+  - name: iosv-1
+    actions:
+    - type: command
+      in: show version
+      out: IOS
+'''
+
+INC = '''
+sims:
+- topo: inc.virl
+  nodes:
+  - name: iosv-2
+    actions:
+    - type: filter
+      intfc: GigabitEthernet0/1
+      expect_protocols:
+        icmp: '>=5'
+'''
+
+
+def write(tmpdir, top=TOP, inc=INC):
+    "Write the command file and its include, returns the file name."
+    tmpdir.join('top.yml').write(top)
+    tmpdir.mkdir('sub').join('inc.yml').write(inc)
+    return str(tmpdir.join('top.yml'))
+
+
+def test_includes(tmpdir):
+    "Includes are relative to the including file, cwd stays the same."
+    filename = write(tmpdir)
+    cwd = os.getcwd()
+    plan = compile_file(filename, env=dict(VIRL_HOST='virl'))
+    assert os.getcwd() == cwd
+    assert plan['config']['host'] == 'virl'
+    assert 'includes' not in plan
+    assert [s['topo'] for s in plan['sims']] == ['top.virl', 'sub/inc.virl']
+    assert plan['sims'][1]['_source'] == 'sub/inc.yml'
+
+
+def test_validation(tmpdir):
+    "Schema errors name the offending element."
+    inc = INC.replace('intfc: GigabitEthernet0/1', 'count: many')
+    filename = write(tmpdir, inc=inc)
+    with pytest.raises(CompileError) as e:
+        compile_file(filename)
+    message = str(e.value)
+    assert 'sub/inc.yml: sims[1].nodes[0].actions[0]: "intfc" is missing' in message
+    assert 'actions[0].count: must be an integer' in message
+
+    tmpdir.join('top.yml').write(TOP.replace('out: IOS', 'out: []'))
+    with pytest.raises(CompileError) as e:
+        compile_file(filename)
+    assert 'sims[0].nodes[0].actions[0].out: must be a regex or a ' \
+        'non-empty list' in str(e.value)
+
+    tmpdir.join('top.yml').write('sims: [')
+    with pytest.raises(CompileError):
+        compile_file(filename)
+
+
+def test_cache(tmpdir):
+    "The cache is used until a file or a used env var changes."
+    filename = write(tmpdir)
+    cache = str(tmpdir.join('cache'))
+    env = dict(VIRL_HOST='a', OTHER='x')
+    plan = compile_file(filename, cache, env)
+
+    compiler = Compiler(env, cache)
+    assert compiler._cached(filename) == plan
+    assert Compiler(dict(env, OTHER='y'), cache)._cached(filename) == plan
+    assert Compiler(dict(env, VIRL_HOST='b'), cache)._cached(filename) is None
+
+    tmpdir.join('sub', 'inc.yml').write(INC.replace('iosv-2', 'iosv-3'))
+    assert compiler._cached(filename) is None
+    plan = compile_file(filename, cache, env)
+    assert plan['sims'][1]['nodes'][0]['name'] == 'iosv-3'
+    assert compiler._cached(filename) == plan
+
+
+def test_dependencies(tmpdir):
+    "Action ids must be unique and depends_on must name them without cycles."
+    top = TOP.replace('      out: IOS', """      out: IOS
+      id: a
+      depends_on: [b, x]
+    - type: command
+      in: show clock
+      id: b
+      depends_on: a
+    - type: command
+      in: show clock
+      id: b""")
+    filename = write(tmpdir, top=top)
+    with pytest.raises(CompileError) as e:
+        compile_file(filename)
+    message = str(e.value)
+    assert 'actions[0].depends_on: unknown id "x"' in message
+    assert 'actions[2]: duplicate id "b"' in message
+    assert 'depends_on cycle through' in message
+
+
+def test_gate(tmpdir):
+    "The quorum of a converge gate can't exceed its nodes."
+    top = TOP.replace('  nodes:\n  - name: iosv-1', """  converge:
+    nodes: [iosv-1, iosv-2]
+    in: show ip route
+    quorum: 3
+  nodes:
+  - name: iosv-1""", 1)
+    filename = write(tmpdir, top=top)
+    with pytest.raises(CompileError) as e:
+        compile_file(filename)
+    assert 'sims[0].converge.quorum: must be 1 to 2' in str(e.value)
+    tmpdir.join('top.yml').write(top.replace('quorum: 3', 'quorum: 2'))
+    assert compile_file(filename)['sims'][0]['converge']['quorum'] == 2
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"Tests for the console sessions and the post-mortem collection."
+
+import socket
+import threading
+import time
+
+from virltester.console import postMortems
+
+
+class FakeSim(object):
+    "Just enough of a VIRLSim for postMortem."
+
+    simId = 'test'
+
+    def log(self, *args):
+        pass
+
+
+def fake_console(hostname, delay):
+    """Serve an IOSv console at the exec prompt on a local port, every
+    command takes delay seconds. Returns the port."""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        prompt = '%s>' % hostname
+        buf = b''
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                line = line.decode().strip()
+                time.sleep(delay)
+                if line == 'exit':
+                    conn.close()
+                    server.close()
+                    return
+                if line == 'enable':
+                    out = 'enable\r\nPassword: '
+                elif line == 'cisco':
+                    prompt = '%s#' % hostname
+                    out = '\r\n' + prompt
+                elif line.startswith('show'):
+                    out = '%s\r\n%s output\r\n%s' % (line, hostname, prompt)
+                else:
+                    out = '%s\r\n%s' % (line, prompt)
+                conn.sendall(out.encode())
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def test_concurrent_post_mortems(tmpdir, monkeypatch):
+    "Consoles are read in parallel and do not share any state."
+    monkeypatch.chdir(tmpdir)
+    nodes = [('iosv-%d' % i, 'IOSv', fake_console('iosv-%d' % i, 0.1))
+             for i in range(4)]
+    nodes.append(('bad', 'unknown device', 17000))
+
+    started = time.time()
+    result = postMortems(FakeSim(), nodes, '127.0.0.1', workers=4)
+    # 6 lines per console, 0.1s each
+    assert time.time() - started < 4 * 0.6
+
+    assert result == {'iosv-0': True, 'iosv-1': True, 'iosv-2': True,
+                      'iosv-3': True, 'bad': False}
+    for i in range(4):
+        log = tmpdir.join('pm-test-iosv-%d.log' % i).read()
+        assert 'iosv-%d output' % i in log
+        assert 'output' not in log.replace('iosv-%d output' % i, '')
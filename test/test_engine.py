@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"End-to-end runs of both engines against the fake VIRL API."
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fakevirl import FakeVIRL
+from virltester import aioengine, tester
+from virltester.plan import Plan
+from virltester.tester import do_all_sims
+from virltester.virlsim import VIRLSim
+
+
+def cmdfile(virl, captures, engine, sims=2):
+    "Sims with a capture each, the second one depends on the first."
+    topo = captures.join('topo.virl')
+    topo.write('<topology/>')
+    actions = [
+        dict(type='filter', intfc='GigabitEthernet0/1', id='first',
+             expect_packets=10),
+        dict(type='filter', intfc='GigabitEthernet0/1', depends_on='first',
+             expect_protocols=dict(icmp=10), expect_min=1),
+    ]
+    config = dict(host='127.0.0.1', port=virl.port, wait=30, parallel=2,
+                  engine=engine, captures=str(captures))
+    return dict(config=config, sims=[
+        dict(topo=str(topo), nodes=[dict(name='iosv-1', actions=actions)])
+        for _ in range(sims)])
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_run(tmpdir, engine):
+    "All sims are launched, their captures checked and the sims stopped."
+    with FakeVIRL(nodes=2) as virl:
+        plan = Plan(cmdfile(virl, tmpdir, engine))
+        assert do_all_sims(plan, logging.getLogger('test'))
+    assert plan.summary() == (4, 4)
+    assert len(virl.sims) == 2
+    assert all(virl.state(sim) == 'DONE' for sim in virl.sims.values())
+    assert virl.calls['POST launch'] == 2
+    assert virl.calls['POST capture'] == virl.calls['DELETE capture'] == 4
+    assert all(a.result.capture['packets'] == 10 for a in plan.actions)
+
+
+def test_boot_timeout(tmpdir, monkeypatch):
+    "Sims whose nodes don't come up in time are stopped, nothing runs."
+    # the status and post-mortem logs go to the current directory
+    monkeypatch.chdir(tmpdir)
+    with FakeVIRL(boot=60) as virl:
+        config = cmdfile(virl, tmpdir, 'threads', sims=1)
+        config['config']['wait'] = 1
+        plan = Plan(config)
+        assert not do_all_sims(plan, logging.getLogger('test'))
+    assert plan.summary() == (2, 0)
+    assert virl.calls['GET stop'] == 1
+    assert 'POST capture' not in virl.calls
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_gate_probes(engine, monkeypatch):
+    "The gate waits for probes still running once the quorum is in."
+    plan = Plan({'sims': [{'topo': 'a.virl', 'converge': {
+        'nodes': ['iosv-1', 'iosv-2'], 'in': 'show ip route', 'out': 'O',
+        'quorum': 1}, 'nodes': [{'name': 'iosv-1'}, {'name': 'iosv-2'}]}]})
+    sim = plan.sims[0]
+    virl = VIRLSim('127.0.0.1', 'guest', 'guest', 'a.virl',
+                   logger=logging.getLogger('test'), timeout=60)
+    running = set()
+
+    def probe(virl, name, action, *args, **kwargs):
+        action.result.start()
+        running.add(name)
+        time.sleep(0.01 if name == 'iosv-1' else 0.2)
+        running.discard(name)
+        action.result.finish(name == 'iosv-1')
+
+    def done(virl, sim):
+        assert not running
+        return gate_done(virl, sim)
+
+    module = aioengine if engine == 'asyncio' else tester
+    gate_done = module.gate_done
+    monkeypatch.setattr(module, 'do_command_action', probe)
+    monkeypatch.setattr(module, 'gate_done', done)
+    if engine == 'threads':
+        assert tester.run_gate(virl, sim)
+    else:
+        with ThreadPoolExecutor(2) as devices:
+            token = aioengine._devices.set(devices)
+            try:
+                loop = asyncio.new_event_loop()
+                assert loop.run_until_complete(aioengine.run_gate(virl, sim))
+                loop.close()
+            finally:
+                aioengine._devices.reset(token)
+    assert [a.node.name for a in sim.gate.converged] == ['iosv-1']
+    assert sim.gate.actions[1].result.attempts == 1
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_attach(tmpdir, engine):
+    "A second run attaches to the simulation the first one left running."
+    with FakeVIRL(nodes=2) as virl:
+        for _ in range(2):
+            config = cmdfile(virl, tmpdir, engine, sims=1)
+            config['sims'][0]['reuse'] = 'attach'
+            plan = Plan(config)
+            assert do_all_sims(plan, logging.getLogger('test'))
+    assert virl.calls['POST launch'] == 1
+    assert 'GET stop' not in virl.calls
+    assert [virl.state(sim) for sim in virl.sims.values()] == ['ACTIVE']
+
+
+def test_attach_failed(tmpdir, monkeypatch):
+    "An attachable simulation whose nodes don't come up is stopped."
+    monkeypatch.chdir(tmpdir)
+    with FakeVIRL(boot=60) as virl:
+        config = cmdfile(virl, tmpdir, 'threads', sims=1)
+        config['config']['wait'] = 1
+        config['sims'][0]['reuse'] = 'attach'
+        assert not do_all_sims(Plan(config), logging.getLogger('test'))
+    assert virl.calls['GET stop'] == 1
+
+
+def test_attach_launched(tmpdir):
+    "A session launched by another run after the check is attached to."
+    topo = tmpdir.join('topo.virl')
+    topo.write('<topology/>')
+    with FakeVIRL(nodes=1) as virl:
+        other = VIRLSim('127.0.0.1', 'guest', 'guest', str(topo),
+                        logger=logging.getLogger('test'), port=virl.port,
+                        attach=True)
+        sim = VIRLSim('127.0.0.1', 'guest', 'guest', str(topo),
+                      logger=logging.getLogger('test'), port=virl.port,
+                      attach=True)
+        # both runs see no session before launching
+        listed = [dict()]
+        sim.listSims = lambda: listed.pop() if listed else other.listSims()
+        assert other.startSim()
+        assert sim.startSim()
+    assert sim.simId == other.simId == sim.simSession
+    assert virl.calls['POST launch'] == 2
+    assert len(virl.sims) == 1
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_sim_error(tmpdir, engine, monkeypatch):
+    "An error in one sim fails that sim only, the others are run."
+    start = VIRLSim.startSim
+    raised = list()
+
+    def startSim(self):
+        if not raised:
+            raised.append(self)
+            raise ConnectionError('boom')
+        return start(self)
+
+    monkeypatch.setattr(VIRLSim, 'startSim', startSim)
+    with FakeVIRL(nodes=2) as virl:
+        plan = Plan(cmdfile(virl, tmpdir, engine))
+        assert not do_all_sims(plan, logging.getLogger('test'))
+    assert plan.summary() == (4, 2)
+    assert sorted(sim.result.status for sim in plan.sims) == [
+        'failed', 'passed']
+
+
+def test_no_parallel(tmpdir):
+    "A parallel setting of 0 runs the sims one at a time."
+    with FakeVIRL(nodes=2) as virl:
+        config = cmdfile(virl, tmpdir, 'asyncio')
+        config['config']['parallel'] = 0
+        plan = Plan(config)
+        assert do_all_sims(plan, logging.getLogger('test'))
+    assert plan.summary() == (4, 4)
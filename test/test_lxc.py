@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"Device interaction through the fake mgmt LXC and emulated devices."
+
+import logging
+import socket
+import threading
+
+import pytest
+
+from fakelxc import Device, FakeConsole, FakeLXC
+from fakevirl import FakeVIRL
+from virltester.command import _config_mode, _logout, _probe, interaction
+from virltester.prompts import PROMPT
+from virltester.sshpool import SessionPool
+from virltester.virlsim import VIRLSim
+
+ADDRESS = '10.255.0.1'
+
+
+@pytest.fixture
+def lab(tmpdir):
+    "A running sim whose mgmt LXC reaches one device at ADDRESS."
+    topo = tmpdir.join('lab.virl')
+    topo.write('<topology/>')
+    device = Device('r1', outputs={'show version': 'Cisco IOS Software'})
+    with FakeLXC({ADDRESS: device}) as lxc:
+        with FakeVIRL(nodes=1, lxc_port=lxc.port) as virl:
+            sim = VIRLSim('127.0.0.1', 'guest', 'guest', str(topo),
+                          logger=logging.getLogger('test'), port=virl.port,
+                          timeout=10, native=True)
+            assert sim.startSim() and sim.waitForSimStart()
+            yield sim, lxc, device
+            sim.stopSim()
+
+
+def run(sim, transport, commands, out, **kwargs):
+    return interaction(sim, None, ADDRESS, transport, 'cisco', 'cisco',
+                       commands, out, 'one', 5, **kwargs)
+
+
+@pytest.mark.parametrize('native', [True, False])
+@pytest.mark.parametrize('transport', ['telnet', 'ssh'])
+def test_transports(lab, native, transport):
+    "Log in, enable and run commands over all transports."
+    sim, lxc, device = lab
+    sim.simNative = native
+    ok = run(sim, transport, ['terminal length 0', 'show version'], 'IOS')
+    assert ok and ok.matches[0].line == 'Cisco IOS Software'
+    assert (device.logins, device.commands) == (1, 1)
+    assert lxc.channels == (1 if native else 0)
+
+
+@pytest.mark.parametrize('kind', ['nxos', 'xr', 'linux'])
+def test_kinds(lab, kind):
+    "The prompts of all device kinds are recognized."
+    sim, _, device = lab
+    device.kind = kind
+    assert run(sim, 'telnet', 'show clock', r'r1 1: show clock')
+
+
+@pytest.mark.parametrize('native', [True, False])
+def test_persistent(lab, native):
+    "Logins are kept unless the device is left in configuration mode."
+    sim, _, device = lab
+    sim.simNative = native
+    for _ in range(3):
+        assert run(sim, 'telnet', 'show version', 'IOS', persistent=True)
+    assert device.logins == 1
+    assert run(sim, 'telnet', ['configure terminal', 'hostname r1'], '',
+               persistent=True)
+    assert run(sim, 'telnet', 'show version', 'IOS', persistent=True)
+    assert device.logins == 2
+
+
+def test_session_contention(lab):
+    "Interactions queue for the only LXC session longer than their wait."
+    sim, _, device = lab
+    sim.simNative = False
+    sim._ssh_pool = SessionPool(sim._sshConnect, 1)
+    device.delay = 0.6
+    results = dict()
+
+    def worker(index):
+        results[index] = bool(interaction(
+            sim, None, ADDRESS, 'telnet', 'cisco', 'cisco', 'show version',
+            'IOS', 'one', 1))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {0: True, 1: True, 2: True}
+
+
+def test_probe(lab):
+    "A kept shell session is found at the device or the LXC prompt."
+    sim, _, _ = lab
+    sim.simNative = False
+    assert run(sim, 'telnet', 'show version', 'IOS', persistent=True)
+    session = sim.sshOpen(5, (ADDRESS, 'telnet', 'cisco'))
+    assert _probe(sim, session) == 'device'
+    assert not _config_mode(session.interact)
+    session.interact.send('configure terminal')
+    session.interact.expect(PROMPT)
+    assert _config_mode(session.interact)
+    session.interact.send('end')
+    session.interact.expect(PROMPT)
+    assert _logout(sim, session) and _probe(sim, session) == 'lxc'
+    sim.sshRelease(session)
+
+
+def test_stream_abort(lab):
+    "A streamed command is aborted once the result is known."
+    sim, _, device = lab
+    device.size = 20000
+    ok = run(sim, 'telnet', 'show tech', r'r1 2: ', stream=True,
+             persistent=True)
+    assert ok and ok.matches[0].lineno == 1
+    # the kept login is back in sync: no stale prompt
+    for _ in range(3):
+        assert run(sim, 'telnet', 'show version', 'IOS', persistent=True)
+    assert device.logins == 1
+
+
+def test_dropped_connection(lab):
+    "A LXC connection lost during a command does not leak its session."
+    sim, lxc, device = lab
+    sim.simNative = False
+
+    def drop(command):
+        for transport in list(lxc._transports):
+            transport.close()
+        return ''
+    device.outputs['reload'] = drop
+    assert not run(sim, 'telnet', 'reload', 'x', stream=True)
+    assert run(sim, 'telnet', 'show version', 'IOS')
+
+
+def test_console_stream_abort(lab):
+    "A streamed command on the console is aborted, the login is kept."
+    sim, _, device = lab
+    device.size = 20000
+    with FakeConsole(device) as console:
+        sim._roster = {(sim.simId, 'r1'): ('IOSv', console.port)}
+        ok = interaction(sim, None, 'r1', 'console', 'cisco', 'cisco',
+                         'show tech', r'r1 2: ', 'one', 5, stream=True,
+                         persistent=True)
+        assert ok and ok.matches[0].lineno == 1
+        assert interaction(sim, None, 'r1', 'console', 'cisco', 'cisco',
+                           'show version', 'IOS', 'one', 5, persistent=True)
+        assert device.logins == 1
+        sim.consoleClose()
+
+
+def test_nodelay(lab):
+    "The connections to the LXC don't wait for delayed ACKs."
+    sim, _, _ = lab
+    clients = [sim._lxcClient(), sim._sshConnect(5).client]
+    for client in clients:
+        sock = client.get_transport().sock
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        client.close()
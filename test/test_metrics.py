@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"Tests for the metrics and the textfile writer."
+
+from virltester.metrics import Registry, TextfileWriter
+
+
+def test_render():
+    "Counters get the _total suffix, histogram buckets are cumulative."
+    registry = Registry()
+    polls = registry.counter('x_polls', 'Polls.')
+    rest = registry.histogram('x_rest_seconds', 'REST.', buckets=(0.1, 1))
+    registry.inc(polls, check='checkSimStart')
+    registry.inc(polls, 2, check='checkSimStart')
+    registry.observe(rest, 0.05, endpoint='nodes')
+    registry.observe(rest, 0.5, endpoint='nodes')
+    registry.observe(rest, 3, endpoint='nodes')
+    lines = registry.render().splitlines()
+    assert lines[:3] == [
+        '# HELP x_polls_total Polls.',
+        '# TYPE x_polls_total counter',
+        'x_polls_total{check="checkSimStart"} 3',
+    ]
+    assert lines[5:] == [
+        'x_rest_seconds_bucket{endpoint="nodes",le="0.1"} 1',
+        'x_rest_seconds_bucket{endpoint="nodes",le="1.0"} 2',
+        'x_rest_seconds_bucket{endpoint="nodes",le="+Inf"} 3',
+        'x_rest_seconds_count{endpoint="nodes"} 3',
+        'x_rest_seconds_sum{endpoint="nodes"} 3.55',
+    ]
+
+
+def test_writer(tmpdir):
+    "The file is written when the writer stops, no temp file is left."
+    registry = Registry()
+    registry.inc(registry.counter('x_polls', 'Polls.'))
+    filename = str(tmpdir.join('virltester.prom'))
+    writer = TextfileWriter(filename, interval=60, registry=registry)
+    writer.start()
+    writer.stop()
+    assert 'x_polls_total 1\n' in open(filename).read()
+    assert tmpdir.listdir() == [tmpdir.join('virltester.prom')]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"Tests for the pcap reader."
+
+import struct
+
+import pytest
+
+from virltester.assertions import CaptureAssertion
+from virltester.pcap import PacketCounter, summarize
+
+
+def make_pcap(sizes, order='<'):
+    "Build a pcap file with one packet of each given size."
+    data = struct.pack(order + 'IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    for ts, size in enumerate(sizes):
+        data += struct.pack(order + 'IIII', ts, 0, size, size)
+        data += b'\x00' * size
+    return data
+
+
+def test_counter_chunks():
+    "Packets are counted no matter how the file is chunked."
+    for order in '<>':
+        data = make_pcap([60, 1500, 0, 17], order)
+        for chunk in (1, 7, 16, 24, 4096):
+            counter = PacketCounter()
+            for pos in range(0, len(data), chunk):
+                counter.feed(data[pos:pos + chunk])
+            assert counter.packets == 4
+
+
+def test_counter_not_pcap():
+    "Data that is not a pcap file has no packet count."
+    counter = PacketCounter()
+    counter.feed(b'\x0a\x0d\x0d\x0a' + b'\x00' * 100)
+    assert counter.packets is None
+
+
+def make_frame(src, dst, proto, payload=b''):
+    "Build an Ethernet/IPv4 frame."
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64,
+                     proto, 0, bytes(src), bytes(dst))
+    return b'\x00' * 12 + b'\x08\x00' + ip + payload
+
+
+def test_summarize(tmpdir):
+    "Protocols and hosts are counted per packet."
+    frames = [
+        make_frame([10, 0, 0, 1], [10, 0, 0, 2], 1, b'\x08\x00\x00\x00'),
+        make_frame([10, 0, 0, 2], [10, 0, 0, 1], 1, b'\x00\x00\x00\x00'),
+        make_frame([10, 0, 0, 1], [10, 0, 0, 3], 6,
+                   struct.pack('!HH', 40000, 179) + b'\x00' * 16),
+        b'\x00' * 12 + b'\x00\x26' + b'\x42\x42\x03' + b'\x00' * 35,
+    ]
+    data = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    for ts, frame in enumerate(frames):
+        data += struct.pack('<IIII', ts, 0, len(frame), len(frame)) + frame
+    filename = str(tmpdir.join('test.pcap'))
+    with open(filename, 'wb') as fh:
+        fh.write(data + b'\x00' * 10)  # truncated record is ignored
+
+    summary = summarize(filename)
+    assert summary.packets == 4
+    assert summary.protocols['ipv4'] == 3
+    assert summary.protocols['icmp'] == 2
+    assert summary.protocols['bgp'] == 1
+    assert summary.protocols['stp'] == 1
+    assert summary.hosts['10.0.0.1'] == 3
+    assert summary.hosts['10.0.0.3'] == 1
+
+    ok = CaptureAssertion(4, 2, dict(icmp='>=2', udp=0),
+                          {'10.0.0.2': '<3'}).check(summary)
+    assert ok and len(ok.matches) == 5
+    ok = CaptureAssertion(minimum=5, protocols=dict(tcp='!=1')).check(summary)
+    assert not ok and len(ok.missing) == 2
+
+
+def test_capture_assertion_invalid():
+    "Invalid conditions and addresses are rejected."
+    for kwargs in (dict(packets='>>3'), dict(minimum='x'),
+                   dict(hosts={'10.0.0': 1}), dict(protocols=dict(tcp=True))):
+        with pytest.raises(ValueError):
+            CaptureAssertion(**kwargs)
+    with pytest.raises(ValueError):
+        summarize(__file__)
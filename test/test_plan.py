@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"Tests for the plan objects."
+
+from virltester.plan import FAILED, PENDING, SKIPPED, Plan
+
+CMDFILE = {
+    'config': {'host': 'virl'},
+    'sims': [
+        {'topo': 'a.virl', 'nodes': [
+            {'name': 'iosv-1', 'username': 'admin', 'actions': [
+                {'type': 'command', 'in': 'show version', 'out': 'IOS'},
+                {'type': 'filter', 'intfc': 'GigabitEthernet0/1'},
+            ]},
+            {'name': 'iosv-2', 'actions': [
+                {'type': 'converge', 'in': 'show ip route', 'password': 'x'},
+            ]},
+        ]},
+        {'topo': 'b.virl', 'skip': True, 'nodes': [
+            {'name': 'iosv-1', 'actions': [{'type': 'command', 'in': 'x'}]},
+        ]},
+    ],
+}
+
+
+def test_build():
+    "Defaults are applied and actions are numbered per sim."
+    plan = Plan(CMDFILE, 'work')
+    assert plan.config == {'host': 'virl'}
+    assert len(plan.actions) == 4
+    command, capture, converge = plan.sims[0].actions()
+    assert [a.seq for a in plan.actions] == [1, 2, 3, 1]
+    assert (command.transport, command.wait, command.username) == (
+        'telnet', 30, 'admin')
+    assert (capture.count, capture.wait, capture.bpf) == (20, None, '')
+    assert (converge.username, converge.password) == ('cisco', 'x')
+    assert converge.node.name == 'iosv-2'
+    assert command.result.status == PENDING
+    assert plan.actions[3].result.status == SKIPPED
+
+
+def test_summary():
+    "Skipped sims don't count, actions not run count as failed."
+    plan = Plan(CMDFILE)
+    command, capture, converge = plan.sims[0].actions()
+    command.result.start()
+    command.result.finish(True)
+    converge.result.start()
+    converge.result.start()
+    converge.result.finish(False)
+    assert plan.summary() == (3, 1)
+    assert converge.result.status == FAILED
+    assert converge.result.attempts == 2
+    assert converge.result.seconds >= 0
+    assert 'matches' not in capture.result.asdict()
+
+
+def test_gate():
+    "Gate probes are converge actions with the credentials of their node."
+    plan = Plan({'sims': [{'topo': 'a.virl', 'converge': {
+        'nodes': ['iosv-1', 'iosv-9'], 'in': 'show ip route', 'out': 'O',
+        'quorum': 1}, 'nodes': CMDFILE['sims'][0]['nodes']}]})
+    gate = plan.sims[0].gate
+    assert [(a.seq, a.type, a.node.name) for a in gate.actions] == [
+        (4, 'converge', 'iosv-1'), (5, 'converge', 'iosv-9')]
+    assert [a.username for a in gate.actions] == ['admin', 'cisco']
+    assert (gate.quorum, gate.timeout) == (1, None)
+    gate.actions[1].result.start()
+    gate.actions[1].result.finish(True)
+    assert gate.converged == [gate.actions[1]]
+    assert plan.summary() == (4, 0)
+
+
+def test_reuse_groups(tmpdir):
+    "Sims with reuse and the same topology content share a simulation."
+    import logging
+    from virltester.tester import sim_groups
+    tmpdir.join('a.virl').write('<topology/>')
+    tmpdir.join('copy.virl').write('<topology/>')
+    tmpdir.join('b.virl').write('<other/>')
+    reset = [{'name': 'iosv-1', 'actions': [{'type': 'command', 'in': 'x'}]}]
+    plan = Plan({'config': {'reuse': True}, 'sims': [
+        {'topo': 'a.virl', 'reset': reset, 'nodes': CMDFILE['sims'][0]['nodes']},
+        {'topo': 'b.virl'},
+        {'topo': 'copy.virl'},
+        {'topo': 'a.virl', 'reuse': False},
+        {'topo': 'a.virl', 'username': 'other'},
+    ]}, str(tmpdir))
+    groups = sim_groups(plan, logging.getLogger())
+    topos = [[plan.sims.index(s) for s in group] for group in groups]
+    assert topos == [[0, 2], [1], [3], [4]]
+    assert [a.seq for a in plan.sims[0].reset] == [4]
+
+
+def test_attach_session(tmpdir):
+    "Attachable sims are launched under the topology name and fingerprint."
+    import logging
+    from virltester.tester import make_sim
+    tmpdir.join('a.virl').write('<topology/>')
+    plan = Plan({'config': {'reuse': 'attach'}, 'sims': [{'topo': 'a.virl'}]},
+                str(tmpdir))
+    virl = make_sim(plan, plan.sims[0], logging.getLogger())
+    assert virl.simSession == 'a-' + virl.simFingerprint[:12]
+    assert virl._attach
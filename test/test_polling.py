@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"Tests for polling with backoff."
+
+from virltester.polling import Backoff, poll
+
+
+def test_backoff_grows_to_cap():
+    "Intervals start small, grow by factor and stop at the cap."
+    b = Backoff(1000, cap=10, initial=1, factor=2, jitter=0)
+    assert [b.next() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+    assert b.iterations == 6
+
+
+def test_backoff_deadline():
+    "Intervals never go beyond the deadline."
+    b = Backoff(0.5, cap=10, initial=5, jitter=0)
+    assert b.next() <= 0.5
+
+
+def test_poll_results():
+    "Poll stops on success, terminal error or timeout."
+    results = [False, False, True]
+    assert poll(lambda: results.pop(0), Backoff(5, initial=0.01)) is True
+    assert poll(lambda: None, Backoff(5)) is None
+    assert poll(lambda: False, Backoff(0.05, initial=0.01)) is False
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"Tests for the JSON lines and JUnit XML results."
+
+import json
+import xml.etree.ElementTree as ET
+
+from virltester.assertions import Match
+from virltester.plan import Plan
+from virltester.results import write_json, write_junit
+
+CMDFILE = {'sims': [
+    {'topo': 'lab/ospf.virl',
+     'converge': {'nodes': ['iosv-1', 'iosv-2'], 'in': 'show ip route'},
+     'nodes': [{'name': 'iosv-1', 'actions': [
+         {'type': 'command', 'in': 'show version', 'out': 'IOS'},
+         {'type': 'command', 'in': 'show clock', 'out': 'UTC'},
+         {'type': 'filter', 'intfc': 'Gi0/1'},
+     ]}]},
+]}
+
+
+def run(plan):
+    "Pretend the plan has been run: the gate passed, the actions vary."
+    sim = plan.sims[0]
+    sim.result.start()
+    with sim.timed('launch'):
+        pass
+    for action in sim.gate.actions:
+        action.result.start()
+        action.result.finish(True)
+    sim.gate.result.start()
+    sim.gate.result.finish(True)
+    command, clock, capture = sim.actions()
+    command.result.start()
+    command.result.matches = [Match('IOS', 0, 1, 'Cisco IOS Software')]
+    command.result.finish(True)
+    clock.result.start()
+    clock.result.missing = ['UTC']
+    clock.result.finish(False)
+    capture.result.skip()
+    sim.result.finish(True)
+
+
+def test_json(tmpdir):
+    "One record per sim, gate and action plus the summary."
+    plan = Plan(CMDFILE)
+    run(plan)
+    filename = str(tmpdir.join('results.jsonl'))
+    write_json(plan, filename)
+    records = [json.loads(line) for line in open(filename)]
+    assert [r['record'] for r in records] == [
+        'sim', 'gate', 'action', 'action', 'action', 'summary']
+    assert 'launch' in records[0]['phases']
+    assert [n['status'] for n in records[1]['nodes']] == ['passed', 'passed']
+    assert records[2]['matches'] == [dict(
+        pattern='IOS', command=0, lineno=1, line='Cisco IOS Software')]
+    assert records[3]['missing'] == ['UTC']
+    assert records[-1] == dict(record='summary', total=4, passed=2)
+
+
+def test_junit(tmpdir):
+    "A testsuite per sim with a testcase per action and the gate."
+    plan = Plan(CMDFILE)
+    run(plan)
+    filename = str(tmpdir.join('results.xml'))
+    write_junit(plan, filename)
+    root = ET.parse(filename).getroot()
+    assert (root.get('tests'), root.get('failures'), root.get('skipped')) == (
+        '4', '1', '1')
+    suite = root.find('testsuite')
+    assert suite.get('name') == 'lab/ospf.virl'
+    cases = suite.findall('testcase')
+    assert [c.get('classname') for c in cases] == [
+        'ospf.converge', 'ospf.iosv-1', 'ospf.iosv-1', 'ospf.iosv-1']
+    assert cases[2].find('failure').get('message') == 'missing: UTC'
+    assert cases[3].find('skipped') is not None
+    assert 'Cisco IOS Software' in cases[1].find('system-out').text
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"Tests for the sim slot, launch rate and action scheduling."
+
+import threading
+from time import sleep, time
+
+from virltester.plan import FAILED, PASSED, SKIPPED, Plan
+from virltester.scheduler import ActionGraph, LaunchLimiter, SimSlots
+
+
+def test_slots_wake_on_release():
+    "A waiting sim starts as soon as a slot is released."
+    slots = SimSlots(1)
+    slots.acquire()
+    started = list()
+
+    def waiter():
+        slots.acquire()
+        started.append(time())
+        slots.release()
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    sleep(0.1)
+    assert not started
+    released = time()
+    slots.release()
+    t.join(1)
+    assert started and started[0] - released < 0.05
+    slots.join()
+    assert slots.active == 0
+
+
+def test_launch_limiter():
+    "Launches are spaced by the interval, no delay without interval."
+    assert LaunchLimiter(0).delay() == 0
+    limiter = LaunchLimiter(10)
+    assert limiter.delay() == 0
+    assert 9 < limiter.delay() <= 10
+    assert 19 < limiter.delay() <= 20
+
+
+def sim(*actions):
+    "A plan with one sim and a node with the given actions."
+    return Plan({'sims': [{'topo': 't.virl', 'nodes': [
+        {'name': 'iosv-1', 'actions': list(actions)}]}]}).sims[0]
+
+
+def run(graph, ok=lambda action: True):
+    "Run the graph in waves, returns the seqs started per wave."
+    waves = list()
+    while not graph.finished:
+        ready = graph.ready()
+        waves.append([a.seq for a in ready])
+        for action in ready:
+            action.result.start()
+            action.result.finish(ok(action))
+        for action in ready:
+            graph.done(action)
+    return waves
+
+
+def test_graph_yaml_order():
+    "Without depends_on actions run in order, background ones alongside."
+    s = sim({'type': 'command'}, {'type': 'filter', 'background': True},
+            {'type': 'command'}, {'type': 'converge'}, {'type': 'command'})
+    assert run(ActionGraph(s.actions())) == [[1], [2, 3], [4], [5]]
+    s = sim({'type': 'converge'}, {'type': 'command'}, {'type': 'command'})
+    assert run(ActionGraph(s.actions()), lambda a: False) == [[1]]
+    assert [a.result.status for a in s.actions()][1:] == [SKIPPED, SKIPPED]
+
+
+def test_graph_converge_node():
+    "A failed converge skips the remaining actions of its node only."
+    s = Plan({'sims': [{'topo': 't.virl', 'nodes': [
+        {'name': 'iosv-1', 'actions': [
+            {'type': 'converge'}, {'type': 'command'}]},
+        {'name': 'iosv-2', 'actions': [
+            {'type': 'command'}, {'type': 'converge'}, {'type': 'command'}]},
+    ]}]}).sims[0]
+    assert run(ActionGraph(s.actions()), lambda a: a.seq != 1) == [
+        [1], [3], [4], [5]]
+    assert [a.result.status for a in s.actions()] == [
+        FAILED, SKIPPED, PASSED, PASSED, PASSED]
+
+
+def test_graph_depends_on():
+    "Ready actions run in parallel within the limit, failures skip dependents."
+    s = sim({'type': 'command', 'id': 'a', 'depends_on': []},
+            {'type': 'command', 'id': 'b', 'depends_on': []},
+            {'type': 'command', 'id': 'c', 'depends_on': []},
+            {'type': 'command', 'depends_on': ['a', 'b']},
+            {'type': 'command', 'depends_on': 'c'})
+    assert run(ActionGraph(s.actions())) == [[1, 2, 3], [4, 5]]
+    s = sim({'type': 'command', 'id': 'a', 'depends_on': []},
+            {'type': 'command', 'id': 'b', 'depends_on': []},
+            {'type': 'command', 'id': 'c', 'depends_on': []},
+            {'type': 'command', 'id': 'd', 'depends_on': ['a', 'b']},
+            {'type': 'command', 'depends_on': 'd'},
+            {'type': 'command', 'depends_on': 'c'})
+    assert run(ActionGraph(s.actions(), 2), lambda a: a.seq != 2) == [
+        [1, 2], [3], [6]]
+    status = [a.result.status for a in s.actions()]
+    assert status[3:] == [SKIPPED, SKIPPED, PASSED]
+
+
+def test_graph_cycle():
+    "Actions in a cycle are skipped instead of waiting forever."
+    s = sim({'type': 'command', 'id': 'a', 'depends_on': 'b'},
+            {'type': 'command', 'id': 'b', 'depends_on': 'a'},
+            {'type': 'command', 'depends_on': []})
+    assert run(ActionGraph(s.actions())) == [[3], []]
+    assert [a.result.status for a in s.actions()] == [
+        SKIPPED, SKIPPED, PASSED]
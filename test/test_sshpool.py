@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"Tests for the pool of SSH sessions to the mgmt LXC."
+
+import threading
+from time import time
+
+from virltester.sshpool import SessionPool
+
+
+class FakeSession(object):
+    "Stands in for a LXCSession."
+
+    def __init__(self, number):
+        self.number = number
+        self.key = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def pool(size, fail=False):
+    "A pool whose sessions are numbered in the order they are opened."
+    opened = list()
+
+    def connect(timeout):
+        if fail:
+            return None
+        opened.append(FakeSession(len(opened) + 1))
+        return opened[-1]
+    return SessionPool(connect, size), opened
+
+
+def test_acquire_release():
+    "Released sessions are reused, new ones are opened up to the size."
+    sessions, opened = pool(2)
+    first = sessions.acquire(1)
+    second = sessions.acquire(1)
+    assert (first.number, second.number) == (1, 2)
+    sessions.release(first)
+    assert sessions.acquire(1) is first
+    assert len(opened) == 2
+
+
+def test_exhaustion():
+    "acquire() waits for a free slot, at most timeout seconds."
+    sessions, _ = pool(1)
+    first = sessions.acquire(1)
+    started = time()
+    assert sessions.acquire(0.2) is None
+    assert 0.2 <= time() - started < 1
+
+    timer = threading.Timer(0.1, sessions.release, (first,))
+    timer.start()
+    assert sessions.acquire(5) is first
+    timer.join()
+
+    # the wait for a slot can be longer than the connect timeout
+    timer = threading.Timer(0.3, sessions.release, (first,))
+    timer.start()
+    assert sessions.acquire(0.1, wait=5) is first
+    timer.join()
+
+
+def test_discard():
+    "A discarded session is closed and frees its slot."
+    sessions, opened = pool(1)
+    first = sessions.acquire(1)
+    sessions.discard(first)
+    assert first.closed
+    second = sessions.acquire(0.1)
+    assert second is not None and second.number == 2
+
+
+def test_connect_failure():
+    "A failed connect returns None and does not use up the slot."
+    sessions, _ = pool(1, fail=True)
+    assert sessions.acquire(0.1) is None
+    assert sessions.acquire(0.1) is None
+    assert sessions._busy == 0
+
+
+def test_key_preference():
+    """An idle session with the key comes first, then one without a key,
+    other keys are only handed out when the pool is full."""
+    sessions, opened = pool(3)
+    a, b, c = [sessions.acquire(1) for _ in range(3)]
+    a.key, b.key = 'r1', None
+    c.key = 'r2'
+    for session in (a, b, c):
+        sessions.release(session)
+    assert sessions.acquire(1, 'r2') is c
+    assert sessions.acquire(1, 'r3') is b
+    # the pool is full, the session of r1 has to be reset by the caller
+    assert sessions.acquire(1, 'r3') is a
+    assert len(opened) == 3
+
+    sessions, opened = pool(2)
+    first = sessions.acquire(1)
+    first.key = 'r1'
+    sessions.release(first)
+    # room for a fresh session, the login to r1 stays cached
+    assert sessions.acquire(1, 'r2').number == 2
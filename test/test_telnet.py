@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"Tests for the telnet interaction and the console transport."
+
+import socket
+import threading
+
+from virltester.command import interaction
+from virltester.telnet import IAC, DO, WILL, WONT, ECHO, TelnetInteraction
+from virltester.virlsim import VIRLSim
+
+
+def test_telnet_commands():
+    "Telnet commands are answered and removed from the output."
+    ours, theirs = socket.socketpair()
+    interact = TelnetInteraction(ours, timeout=2)
+    theirs.sendall(bytes((IAC, WILL, ECHO, IAC, DO, 24)) + b'\r\nrouter>')
+    assert interact.expect([r'[\w-]+# ?', r'[\w-]+> ?']) == 1
+    assert interact.last_match == r'[\w-]+> ?'
+    assert theirs.recv(100) == bytes((IAC, 253, ECHO, IAC, WONT, 24))
+
+    interact.send('show clock')
+    assert theirs.recv(100) == b'show clock\r\n'
+    # a telnet command split across two reads
+    theirs.sendall(b'show clock\r\n12:00\r\n' + bytes((IAC,)))
+    theirs.sendall(bytes((WILL, 3)) + b'router>')
+    interact.expect(r'[\w-]+> ?')
+    assert interact.current_output_clean == 'show clock\n12:00\n'
+    ours.close()
+    theirs.close()
+
+
+def fake_console(sessions):
+    """Serve a console with a login on a local port, 'show users' lists
+    the number of the connection. Returns the port."""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            sessions.append(conn)
+            state, buf = 'user', b''
+            while state != 'closed':
+                data = conn.recv(1024)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    line = line.decode().strip()
+                    if state == 'user':
+                        out, state = '\r\nUsername: ', 'pass'
+                    elif state == 'pass':
+                        out, state = 'cisco\r\nPassword: ', 'exec'
+                    elif state == 'exec':
+                        out, state = '\r\nr1>', 'priv'
+                    elif line == 'enable':
+                        out = 'enable\r\nPassword: '
+                    elif line == 'exit':
+                        conn.close()
+                        state = 'closed'
+                        break
+                    else:
+                        out = '%s\r\nline %d\r\nr1#' % (line, len(sessions))
+                    conn.sendall(out.encode())
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def test_console_transport():
+    "Commands run on the console, the login is kept when persistent."
+    sessions = list()
+    port = fake_console(sessions)
+    virl = VIRLSim('127.0.0.1', 'guest', 'guest', 'test.virl')
+    virl._roster = {(None, 'r1'): ('IOSv', port)}
+
+    for i in range(2):
+        ok = interaction(virl, None, 'r1', 'console', 'cisco', 'cisco',
+                         ['show users'], 'line 1', 'one', 5,
+                         persistent=True)
+        assert ok
+        assert len(sessions) == 1
+
+    ok = interaction(virl, None, 'r1', 'console', 'cisco', 'cisco',
+                     'show users', 'line 1', 'one', 5)
+    assert ok and len(sessions) == 1
+    ok = interaction(virl, None, 'r1', 'console', 'cisco', 'cisco',
+                     'show users', 'line 2', 'one', 5)
+    assert ok and len(sessions) == 2
+    virl.consoleClose()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"Tests for the Chrome trace spans and the profiler."
+
+import asyncio
+import json
+import pstats
+import threading
+import time
+
+from virltester.profiler import Profiler
+from virltester.trace import Tracer
+
+
+def test_tracks(tmpdir):
+    "Spans get a track per thread and per asyncio task."
+    tracer = Tracer()
+    with tracer.span('off', 'test'):
+        pass
+    tracer.enable()
+
+    def work():
+        with tracer.span('outer', 'test', n=1):
+            with tracer.span('inner', 'test'):
+                pass
+
+    async def tasks():
+        await asyncio.gather(asyncio.sleep(0), asyncio.sleep(0))
+        with tracer.span('async', 'test'):
+            await asyncio.sleep(0)
+
+    t = threading.Thread(target=work, name='worker')
+    t.start()
+    t.join()
+    asyncio.run(tasks())
+    filename = str(tmpdir.join('trace.json'))
+    tracer.write(filename)
+
+    events = json.load(open(filename))['traceEvents']
+    tracks = dict((e['tid'], e['args']['name'])
+                  for e in events if e['ph'] == 'M')
+    spans = dict((e['name'], e) for e in events if e['ph'] == 'X')
+    assert sorted(spans) == ['async', 'inner', 'outer']
+    assert tracks[spans['outer']['tid']] == 'worker'
+    assert tracks[spans['async']['tid']].startswith('task ')
+    assert spans['outer']['args'] == dict(n=1)
+    outer, inner = spans['outer'], spans['inner']
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_profiler(tmpdir):
+    "Functions run in threads show up in the merged stats."
+    def in_thread():
+        time.sleep(0.1)
+        return sum(range(1000))
+
+    with Profiler() as profiler:
+        t = threading.Thread(target=in_thread)
+        t.start()
+    # leaving the block waits for the thread
+    assert not t.is_alive()
+    filename = str(tmpdir.join('run.prof'))
+    profiler.dump(filename)
+    names = [func[2] for func in pstats.Stats(filename).stats]
+    assert 'in_thread' in names
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"Tests for the node and interface lookups of VIRLSim."
+
+import logging
+
+import pytest
+
+from fakevirl import FakeVIRL
+from virltester.virlsim import VIRLSim
+
+
+@pytest.fixture
+def virl(tmpdir):
+    "The fake VIRL API and a started sim on it."
+    topo = tmpdir.join('topo.virl')
+    topo.write('<topology/>')
+    with FakeVIRL(nodes=2) as api:
+        sim = VIRLSim('127.0.0.1', 'guest', 'guest', str(topo),
+                      logger=logging.getLogger('test'), port=api.port)
+        assert sim.startSim()
+        yield api, sim
+
+
+def test_interface_cache(virl):
+    "The interfaces are fetched once per sim and again after attaching."
+    api, sim = virl
+    assert sim.loadInterfaces()
+    assert api.calls['GET interfaces'] == 1
+    assert sim.getMgmtIP('iosv-2') == '10.255.0.2'
+    assert sim.getInterfaceId('iosv-1', 'GigabitEthernet0/1') == '0'
+    assert sim.getLXCPort() == 0
+    assert sim.getMgmtIP('iosv-9') is None
+    assert api.calls['GET interfaces'] == 1
+    sim.attachSim(sim.simId)
+    assert sim.getMgmtIP('iosv-1') == '10.255.0.1'
+    assert api.calls['GET interfaces'] == 2
+    assert sim.loadInterfaces()
+    sim.invalidateCache()
+    assert sim.getInterfaceId('iosv-2', 'GigabitEthernet0/1') == '0'
+    assert api.calls['GET interfaces'] == 4
+
+
+def test_roster(virl, tmpdir):
+    "The roster is fetched once and only holds the nodes of the own sim."
+    api, sim = virl
+    topo = str(tmpdir.join('topo.virl'))
+    other = VIRLSim('127.0.0.1', 'guest', 'guest', topo,
+                    logger=logging.getLogger('test'), port=api.port)
+    assert other.startSim()
+    assert sim.getNodeDetail('iosv-2') == ('IOSv', 17001)
+    assert sim.getNodeDetail('iosv-1') == ('IOSv', 17000)
+    assert sorted(sim._roster) == [(sim.simId, 'iosv-1'),
+                                   (sim.simId, 'iosv-2')]
+    assert api.calls['GET roster'] == 1
+    # a node which is not in the roster
+    assert sim.getNodeDetail('iosv-9') == ('unknown', 0)
+    assert other.getNodeDetail('iosv-1') == ('IOSv', 17000)
+    assert sorted(other._roster) == [(other.simId, 'iosv-1'),
+                                     (other.simId, 'iosv-2')]
+    assert api.calls['GET roster'] == 2
+    sim.attachSim(sim.simId)
+    assert sim.getNodeDetail('iosv-1') == ('IOSv', 17000)
+    assert api.calls['GET roster'] == 3
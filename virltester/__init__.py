@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 "Module initialization."
 
+from .plan import Plan
 from .tester import main, load_cfg, do_all_sims
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""asyncio execution engine. Sims, actions and all polling loops run as
+coroutines on one event loop, so their waits (sim slots, stagger,
+initial sleeps, poll and converge intervals) don't take up a thread.
+The blocking calls are handed to thread pools: the REST calls to one
+and the device interaction to another. The latter still blocks its
+thread while waiting for a LXC session, for the device and in its
+connection retries; a pool of its own keeps it from starving the
+polling of the sims."""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from logging import CRITICAL, ERROR, INFO, WARN
+
+from . import metrics
+from .results import action_name
+from .scheduler import ActionGraph, LaunchLimiter
+from .tester import (bg_indicator, capture_assertion, check_capture,
+                     do_command_action, gate_done, gate_timeout, group_failed,
+                     log_skipped, sim_groups, SESSIONS)
+from .trace import span
+
+# threads for REST calls per parallel sim (polls, captures)
+REST_WORKERS = 2
+
+
+# the thread pool for the device interaction of the running engine
+_devices = contextvars.ContextVar('devices')
+
+
+def _run(func, *args, **kwargs):
+    "Run the blocking function in the executor of the running loop."
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _device(func, *args, **kwargs):
+    "Run the blocking device interaction in the thread pool for devices."
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(_devices.get(),
+                                functools.partial(func, *args, **kwargs))
+
+
+async def initial_sleep(virl, action):
+    "Waits for however long is defined in the action."
+    if action.sleep > 0:
+        virl.log(WARN, "(%d) initial sleep %ss", action.seq, action.sleep)
+        with span('sleep', 'wait', seq=action.seq):
+            await asyncio.sleep(action.sleep)
+        virl.log(WARN, "(%d) initial sleep done", action.seq)
+
+
+async def poll(backoff, check, *args):
+    """Awaits check(*args) in the executor until it returns something other
+    than False or the backoff expires, see polling.poll()."""
+    while True:
+        metrics.REGISTRY.inc(metrics.POLLS, check=check.__name__)
+        result = await _run(check, *args)
+        if result is not False:
+            return result
+        if backoff.expired():
+            return False
+        with span('sleep', 'wait', check=check.__name__):
+            await asyncio.sleep(backoff.next())
+
+
+async def wait_for_sim_start(virl):
+    """Returns True if the sim is started and all nodes are active/reachable
+    within the timeout of the sim, see VIRLSim.waitForSimStart()."""
+    if not virl.simStartWait():
+        return await _run(virl.loadInterfaces)
+    active = await poll(virl.backoff(), virl.checkSimStart)
+    return await _run(virl.simStartDone, active)
+
+
+async def stop_sim(virl, wait=False, failed=False):
+    """Stop the simulation, wait until all nodes are stopped if wait is
+    set. See VIRLSim.stopSim() for failed."""
+    if not await _run(virl.stopSim, failed=failed) or not wait:
+        return
+    if await poll(virl.backoff(virl.simTimeout / 2), virl.isSimStopped):
+        virl.log(INFO, 'Simulation finally stopped.')
+    else:
+        virl.log(CRITICAL, 'Simulation did NOT stop.')
+
+
+async def wait_for_capture(virl, cap_id, wait=None):
+    "Wait until the packet capture is done."
+    if wait is None:
+        wait = virl.simTimeout
+    virl.log(INFO, 'Waiting %ds for capture [%s]', wait, cap_id)
+
+    done = await poll(virl.backoff(wait), virl.isCaptureDone, cap_id)
+    if done:
+        virl.log(WARN, "Capture has finished.")
+    elif done is False:
+        virl.log(ERROR, "Timeout... aborting!")
+    return bool(done)
+
+
+async def do_capture_action(virl, name, action):
+    "Starts a PCAP as defined in the action."
+    result = action.result
+    result.start()
+    virl.log(WARN, '(%s%d) filter: %s %s', bg_indicator(action),
+             action.seq, name, action.intfc)
+
+    ok = False
+    if capture_assertion(virl, action) is None:
+        result.finish(ok)
+        return
+
+    await initial_sleep(virl, action)
+    capId = await _run(virl.createCapture, name, action.intfc, action.bpf,
+                       action.count)
+    if capId is not None and await wait_for_capture(virl, capId, action.wait):
+        result.capture = await _run(virl.downloadCapture, capId)
+        ok = (result.capture is not None and
+              await _run(check_capture, virl, action))
+        await _run(virl.deleteCapture, capId)
+    level = WARN if ok else ERROR
+    virl.log(level, "(%d) capture succeeded: %s", action.seq, ok)
+    result.finish(ok)
+
+
+async def do_command_action_async(virl, name, action, log_output):
+    "Execute the given command on the device."
+    await initial_sleep(virl, action)
+    await _device(do_command_action, virl, name, action, log_output,
+                  pause=False)
+
+
+async def do_converge_action(virl, name, action, log_output):
+    """Run the command of the action until it succeeds or the max wait
+    (half of the sim timeout) is exceeded."""
+    await initial_sleep(virl, action)
+    backoff = virl.backoff(virl.simTimeout / 2)
+    while True:
+        await _device(do_command_action, virl, name, action, False,
+                      converge=True, pause=False)
+        if action.result.ok or backoff.expired():
+            break
+        virl.log(INFO, "waiting to converge... %ds left" % backoff.remaining())
+        with span('sleep', 'wait', seq=action.seq):
+            await asyncio.sleep(backoff.next())
+
+
+async def do_action(virl, sim, action):
+    "Execute the given action on its node."
+    nodename = action.node.name
+
+    with span(action_name(action), 'action', sim=virl.simId):
+        if action.type == 'filter':
+            await do_capture_action(virl, nodename, action)
+        elif action.type == 'command':
+            await do_command_action_async(virl, nodename, action, sim.log)
+        elif action.type == 'converge':
+            await do_converge_action(virl, nodename, action, sim.log)
+            if not action.result.ok:
+                virl.log(CRITICAL, 'Sim did not converge! skip dependent actions')
+        else:
+            virl.log(CRITICAL, 'unknown action %s' % action.type)
+            action.result.finish(False)
+
+
+async def run_actions(virl, sim, actions=None):
+    """Run the actions of the sim (or the given ones), each as soon as the
+    actions it depends on have finished. At most 'concurrency' actions
+    of the sim run at the same time."""
+    if actions is None:
+        actions = sim.actions()
+    graph = ActionGraph(actions, sim.concurrency)
+    running = dict()
+    while True:
+        for action in graph.ready():
+            running[asyncio.ensure_future(do_action(virl, sim, action))] = action
+        if graph.finished:
+            break
+        done, _ = await asyncio.wait(running,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            action = running.pop(task)
+            if task.exception() is not None:
+                virl.log(CRITICAL, '(%d) action failed: %r', action.seq,
+                         task.exception())
+            log_skipped(virl, action, graph.done(action))
+
+
+async def run_gate(virl, sim):
+    """Probe all nodes of the converge gate of the sim at the same time
+    until the quorum has converged or the gate times out. Probes still
+    running then stop after their current attempt, which is waited for
+    (it holds a LXC session). Returns True if the gate passed."""
+    gate = sim.gate
+    timeout = gate_timeout(virl, gate)
+    gate.result.start()
+    virl.log(WARN, 'converge gate: waiting %ds for %d of %d nodes',
+             timeout, gate.quorum, len(gate.actions))
+    stop = asyncio.Event()
+
+    async def pause(seconds):
+        "Sleep unless the gate is done, True if it is."
+        try:
+            with span('sleep', 'wait'):
+                await asyncio.wait_for(stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return stop.is_set()
+
+    async def probe(action):
+        "Run the converge command until it succeeds or the gate is done."
+        if action.sleep > 0 and await pause(action.sleep):
+            return
+        backoff = virl.backoff(timeout)
+        while not stop.is_set():
+            await _device(do_command_action, virl, action.node.name,
+                          action, False, converge=True, pause=False)
+            if action.result.ok or backoff.expired():
+                break
+            await pause(backoff.next())
+
+    pending = set(asyncio.ensure_future(probe(a)) for a in gate.actions)
+    while pending and len(gate.converged) < gate.quorum:
+        _, pending = await asyncio.wait(pending,
+                                        return_when=asyncio.FIRST_COMPLETED)
+    stop.set()
+    if pending:
+        await asyncio.wait(pending)
+    return gate_done(virl, sim)
+
+
+async def do_sims(sims):
+    """Run sims which share one simulation, see tester.do_sims(). Returns
+    True if all sims could be run."""
+    first = sims[0].virl
+    sims[0].result.start()
+    # nobody reuses the simulation after the last sim
+    for action in sims[-1].reset:
+        action.result.skip()
+
+    # an attached simulation is kept only if every sim came up and converged
+    failed = False
+    with sims[0].timed('launch'):
+        started = await _run(first.startSim)
+    for i, sim in enumerate(sims):
+        virl = sim.virl
+        last = i == len(sims) - 1
+        ok = False
+        if i:
+            sim.result.start()
+        if started:
+            if i:
+                virl.attachSim(first.simId)
+            with sim.timed('active'):
+                active = await wait_for_sim_start(virl)
+            if active:
+                converged = True
+                if sim.gate is not None:
+                    with sim.timed('converge'):
+                        converged = await run_gate(virl, sim)
+                failed = failed or not converged
+                if converged:
+                    with sim.timed('actions'):
+                        await run_actions(virl, sim)
+                if sim.reset and not last:
+                    virl.log(WARN, 'resetting for the next sim')
+                    with sim.timed('reset'):
+                        await run_actions(virl, sim, sim.reset)
+                ok = True
+            if i:
+                await _run(virl.closeSessions)
+        if not ok:
+            virl.log(CRITICAL, 'simulation %s failed' % virl.simId)
+            failed = True
+        if not last:
+            sim.result.finish(ok)
+    if started:
+        with sims[-1].timed('stop'):
+            await stop_sim(first, wait=True, failed=failed)
+    sims[-1].result.finish(ok)
+    return all(sim.result.ok for sim in sims)
+
+
+async def run_sims(plan, sims, logger):
+    """Run all defined sims as coroutines, at most 'parallel' groups of
+    sims sharing a simulation at a time. Launches are spaced by the
+    'stagger' config value (seconds)."""
+    cfg = plan.config
+    slots = asyncio.Semaphore(max(1, cfg.get('parallel')))
+    limiter = LaunchLimiter(cfg.get('stagger', 0))
+
+    async def run_group(group):
+        "Run the sims in a free slot and flag them as done."
+        with span('sim slot', 'wait'):
+            await slots.acquire()
+        try:
+            with span('stagger', 'wait'):
+                await asyncio.sleep(limiter.delay())
+            logger.warning('new sim %s', group[0].topo)
+            await do_sims(group)
+        except Exception:
+            group_failed(group, logger)
+            return
+        finally:
+            slots.release()
+        for sim in group:
+            sim.done = True
+
+    tasks = list()
+    for group in sim_groups(plan, logger):
+        sims.append(group[0])
+        tasks.append(run_group(group))
+
+    logger.warning('waiting for sims to end')
+    await asyncio.gather(*tasks)
+
+
+def run_sims_async(plan, sims, logger):
+    """Run all defined sims on an asyncio event loop. The thread pool for
+    the device interaction defaults to enough workers for all LXC
+    sessions of all parallel sims and can be set with the 'workers'
+    config key. The REST calls get REST_WORKERS threads per parallel
+    sim."""
+    cfg = plan.config
+    parallel = max(1, cfg.get('parallel'))
+    workers = cfg.get('workers')
+    if workers is None:
+        workers = parallel * cfg.get('sessions', SESSIONS)
+    workers = max(1, workers)
+
+    loop = asyncio.new_event_loop()
+    rest = ThreadPoolExecutor(max_workers=parallel * REST_WORKERS)
+    devices = ThreadPoolExecutor(max_workers=workers)
+    loop.set_default_executor(rest)
+    # the tasks of the loop inherit the context
+    token = _devices.set(devices)
+    try:
+        loop.run_until_complete(run_sims(plan, sims, logger))
+    finally:
+        _devices.reset(token)
+        devices.shutdown(wait=False)
+        rest.shutdown(wait=False)
+        loop.close()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"Check command output and captured packets against the expectations."
+
+import re
+import socket
+
+LOGICS = ('one', 'all', '!one', '!all')
+SCOPES = ('last', 'all', 'each')
+
+
+class Match(object):
+    "A pattern that matched: the command index, line number and line."
+
+    __slots__ = ('pattern', 'command', 'lineno', 'line')
+
+    def __init__(self, pattern, command, lineno, line):
+        self.pattern = pattern
+        self.command = command
+        self.lineno = lineno
+        self.line = line
+
+    def __repr__(self):
+        return 'Match(%r, cmd=%d, line=%d: %r)' % (
+            self.pattern, self.command, self.lineno, self.line)
+
+    def asdict(self):
+        "The match as a dict."
+        return dict(pattern=self.pattern, command=self.command,
+                    lineno=self.lineno, line=self.line)
+
+
+class AssertionResult(object):
+    """Outcome of checking outputs: ok, the matches, the missing patterns
+    and the failure pattern match (if any)."""
+
+    def __init__(self, ok, matches, missing, failed=None):
+        super(AssertionResult, self).__init__()
+        self.ok = ok
+        self.matches = matches
+        self.missing = missing
+        self.failed = failed
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
+
+class OutputAssertion(object):
+    """Compiled output patterns of a command action.
+
+    - patterns: a RE or a list of REs. With scope 'each' the list is
+      aligned with the commands, every entry is a RE, a list of REs or
+      None for commands whose output is not checked.
+    - logic: 'one' (at least one pattern must match) or 'all' (every
+      pattern must match), negated by a leading '!'
+    - scope: which output the patterns are matched against. 'last' is
+      the output of the last command, 'all' the outputs of all commands
+      and 'each' the output of the command the pattern belongs to.
+    - fail: a RE or a list of REs which fail the assertion if found in
+      the output of any command.
+
+    Raises ValueError for an unknown logic or scope or if there is no
+    pattern to check, re.error for an invalid pattern."""
+
+    def __init__(self, patterns, logic='one', scope='last', fail=None):
+        super(OutputAssertion, self).__init__()
+        if logic not in LOGICS:
+            raise ValueError('unknown logic, valid: "[!]all, [!]one"')
+        if scope not in SCOPES:
+            raise ValueError('unknown scope, valid: "last, all, each"')
+        self.negate = logic.startswith('!')
+        self.logic = logic.lstrip('!')
+        self.scope = scope
+
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+
+        # list of (command index, pattern, compiled RE), the command index
+        # is None if the pattern applies to more than one command
+        self.checks = list()
+        if scope == 'each':
+            for index, entry in enumerate(patterns):
+                if entry is None:
+                    continue
+                if not isinstance(entry, list):
+                    entry = [entry]
+                for pattern in entry:
+                    self.checks.append((index, pattern, re.compile(str(pattern))))
+        else:
+            for pattern in patterns:
+                if pattern is None:
+                    pattern = ''
+                self.checks.append((None, pattern, re.compile(str(pattern))))
+        if not self.checks:
+            raise ValueError('no output pattern to check')
+
+        if fail is None:
+            fail = list()
+        elif not isinstance(fail, list):
+            fail = [fail]
+        self.fail = [(pattern, re.compile(str(pattern))) for pattern in fail]
+
+    def matcher(self, count):
+        "Returns a new Matcher for the outputs of count commands."
+        return Matcher(self, count)
+
+    def check(self, outputs):
+        """Match the patterns against the given list of command outputs in
+        a single pass over the lines. Failure patterns are looked for in
+        the complete output. Returns an AssertionResult."""
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+
+        m = self.matcher(len(outputs))
+        for index, output in enumerate(outputs):
+            for line in output.split('\n'):
+                decided = m.feed(index, line)
+                if decided is False or (decided and not self.fail):
+                    return m.result()
+        return m.result()
+
+
+class Matcher(object):
+    """Matches the output lines of the commands of one interaction as
+    they come in. feed() returns True or False as soon as the outcome
+    is known, None otherwise. A failure pattern decides on failure, the
+    patterns decide once they satisfy the logic (success, or failure if
+    negated). When streaming, whatever is seen first wins."""
+
+    def __init__(self, assertion, count):
+        super(Matcher, self).__init__()
+        self._a = assertion
+        self._count = count
+        self._pending = list(assertion.checks)
+        self._lineno = dict()
+        self.matches = list()
+        self.failed = None
+
+    def _applies(self, check, index):
+        "Does the check apply to the output of command index?"
+        if self._a.scope == 'each':
+            return check[0] == index
+        if self._a.scope == 'last':
+            return index == self._count - 1
+        return True
+
+    def _found(self):
+        "Have enough patterns matched to satisfy the logic?"
+        if self._a.logic == 'one':
+            return len(self.matches) > 0
+        return not self._pending
+
+    def feed(self, index, line):
+        "Match a line of the output of command index."
+        lineno = self._lineno.get(index, 0)
+        self._lineno[index] = lineno + 1
+
+        for pattern, compiled in self._a.fail:
+            if compiled.search(line):
+                self.failed = Match(pattern, index, lineno, line)
+                return False
+
+        for c in list(self._pending):
+            if self._applies(c, index) and c[2].search(line):
+                self.matches.append(Match(c[1], index, lineno, line))
+                self._pending.remove(c)
+
+        if self._found():
+            return not self._a.negate
+        return None
+
+    def result(self):
+        "Returns the AssertionResult for the output seen so far."
+        # xor with negate is the result
+        ok = self.failed is None and self._a.negate != self._found()
+        return AssertionResult(ok, self.matches,
+                               [c[1] for c in self._pending], self.failed)
+
+
+# '>=5', '< 3', '0', ... (no operator means exactly)
+CONDITION_RE = re.compile(r'^\s*(==|!=|>=|<=|>|<)?\s*(\d+)\s*$')
+OPERATORS = {
+    '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+    '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b, '<': lambda a, b: a < b,
+}
+
+
+def condition(spec):
+    """Parse a count condition like 5, '>=5' or '<3' into (operator,
+    number). Raises ValueError if the condition is invalid."""
+    m = CONDITION_RE.match(str(spec))
+    if m is None or isinstance(spec, bool):
+        raise ValueError('invalid count condition "%s"' % spec)
+    return m.group(1) or '==', int(m.group(2))
+
+
+def _host(address):
+    "Normalize the textual form of an IP address."
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_ntop(family, socket.inet_pton(family, address))
+        except (socket.error, ValueError):
+            pass
+    raise ValueError('invalid host address "%s"' % address)
+
+
+class CaptureAssertion(object):
+    """Expected packet counts of a capture file.
+
+    - packets: the number of packets (a count condition)
+    - minimum: the minimum number of packets
+    - protocols: dict of protocol name -> count condition
+    - hosts: dict of IP address -> count condition
+
+    A count condition is a number (exactly) or a string with an
+    operator (==, !=, >=, <=, >, <) and a number. Raises ValueError
+    for invalid conditions or addresses."""
+
+    def __init__(self, packets=None, minimum=None, protocols=None, hosts=None):
+        super(CaptureAssertion, self).__init__()
+        # list of (label, summary attribute, key, operator, number)
+        self.checks = list()
+        if packets is not None:
+            self.checks.append(('packets', 'packets', None) + condition(packets))
+        if minimum is not None:
+            self.checks.append(('packets', 'packets', None) +
+                               ('>=', condition(minimum)[1]))
+        for name, spec in (protocols or dict()).items():
+            self.checks.append(('protocol %s' % name, 'protocols',
+                                str(name).lower()) + condition(spec))
+        for address, spec in (hosts or dict()).items():
+            self.checks.append(('host %s' % address, 'hosts',
+                                _host(str(address))) + condition(spec))
+
+    def __len__(self):
+        return len(self.checks)
+
+    def check(self, summary):
+        """Check the PcapSummary. Returns an AssertionResult, the matches
+        and missing are descriptions of the checks that passed / failed."""
+        passed, failed = list(), list()
+        for label, attr, key, op, number in self.checks:
+            value = getattr(summary, attr)
+            if key is not None:
+                value = value.get(key, 0)
+            text = '%s %s %d (%d)' % (label, op, number, value)
+            (passed if OPERATORS[op](value, number) else failed).append(text)
+        return AssertionResult(not failed, passed, failed)
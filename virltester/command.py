@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
-"Interact with devices using the existing LXC SSH session."
+"Interact with devices using the existing LXC SSH session or the console."
 
+import codecs
 import socket
 import re
 import logging
 from datetime import datetime
 from os import devnull
-from time import sleep
+from time import sleep, time
 
+import paramiko
+from paramiko_expect import SSHClientInteraction
+
+from . import metrics
+from .assertions import OutputAssertion
+from .console import DEVICES
 from .prompts import USERNAME_PROMPT, PASSWORD_PROMPT, CISCO_NOPRIV, PROMPT
+from .telnet import TelnetInteraction
+from .trace import span
 
 """
 console=dict(device_type='cisco_ios_telnet',
@@ -25,48 +34,458 @@ net_connect.disconnect()
 """
 
 
-def interaction(sim, logname, dest_ip, transport, username, password, inlines, output_re, logic, timeout, converge=False):
+# seconds to wait for a cached session to respond
+PROBE_TIMEOUT = 5
+
+# device prompts as the last (incomplete) line of streamed output
+PROMPT_RE = [re.compile('(?:%s)$' % p) for p in PROMPT]
+
+# abort a running command: Ctrl-^ (Cisco escape sequence) and Ctrl-C
+BREAK = '\x1e\x03'
+
+
+def lxc_prompt(sim):
+    "The shell prompt of the mgmt LXC of the given sim."
+    return [r'%s@[\w-]+\$ ?' % sim.simUser]
+
+
+def _expect(interact, patterns, timeout=None):
+    """Expect one of the patterns, raises socket.timeout if nothing
+    matched (some paramiko-expect versions return -1 instead)."""
+    with span('expect', 'device'):
+        matched = interact.expect(patterns, timeout)
+    if matched == -1:
+        raise socket.timeout('no match')
+
+
+def _probe(sim, session):
+    """Send an empty line into the shell of the session and return where
+    we are: 'device', 'lxc' or None if the shell does not respond."""
+    interact = session.interact
+    LXC_PROMPT = lxc_prompt(sim)
+    try:
+        interact.send('')
+        _expect(interact, LXC_PROMPT + PROMPT, PROBE_TIMEOUT)
+    except socket.error:
+        return None
+    return 'lxc' if interact.last_match in LXC_PROMPT else 'device'
+
+
+def _logout(sim, session):
+    "Log out of the device, returns True if we are back at the LXC prompt."
+    interact = session.interact
+    try:
+        interact.send('exit')
+        _expect(interact, lxc_prompt(sim), PROBE_TIMEOUT)
+    except socket.error:
+        return False
+    session.key = None
+    return True
+
+
+def _config_mode(interact):
+    "True if the device prompt indicates configuration mode."
+    lines = interact.current_output.rstrip().split('\n')
+    return re.search(r'\(config[^)]*\)# ?$', lines[-1]) is not None
+
+
+def _recv(interact, timeout):
+    "Read the next chunk of raw output, telnet commands are removed."
+    if isinstance(interact, TelnetInteraction):
+        return interact.recv(timeout)
+    interact.channel.settimeout(timeout)
+    return interact.channel.recv(4096)
+
+
+def _stream_command(interact, line, matcher, index, timeout):
+    """Send a command and feed its output line by line to the matcher as
+    it arrives (the echoed command is skipped). Returns the output and
+    the decision of the matcher or None if the prompt came back first.
+    Raises socket.timeout if neither happens within timeout seconds."""
+    decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+    lines, partial, echo = list(), '', True
+    endtime = time() + timeout
+    interact.send(line)
+    while True:
+        remaining = endtime - time()
+        if remaining <= 0:
+            raise socket.timeout('no prompt')
+        data = _recv(interact, remaining)
+        if not data:
+            raise socket.error('channel closed')
+        partial += decoder.decode(data).replace('\r', '')
+        complete = partial.split('\n')
+        partial = complete.pop()
+        for oline in complete:
+            lines.append(oline)
+            if echo:
+                echo = False
+                continue
+            decided = matcher.feed(index, oline)
+            if decided is not None:
+                return '\n'.join(lines + [partial]), decided
+        if any(p.match(partial) for p in PROMPT_RE):
+            # the device is back at the prompt, keep the state consistent
+            # with what expect() would have left behind
+            interact.current_output = '\n'.join(lines + [partial])
+            return '\n'.join(lines), None
+
+
+def _interrupt(interact):
+    "Abort the running command, True if the device prompt comes back."
+    try:
+        if isinstance(interact, TelnetInteraction):
+            # the channel may be a socket (console), it takes bytes only
+            interact.send_raw(BREAK.encode())
+        else:
+            interact.channel.send(BREAK)
+        try:
+            _expect(interact, PROMPT, PROBE_TIMEOUT)
+        except socket.timeout:
+            # no prompt after the break, ask for one. Not done right
+            # away, the prompt would come twice and a stale one throws
+            # off the next expect
+            interact.send('')
+            _expect(interact, PROMPT, PROBE_TIMEOUT)
+    except socket.error:
+        return False
+    return True
+
+
+def _session(sim, key, timeout):
+    """Get a LXC session from the pool of the sim. If the session is
+    still logged in to the device identified by key and responsive then
+    it is reused as is. Sessions logged in to other devices are logged
+    out first. Returns the session (or None) and whether it is logged in.
+    """
+    while True:
+        session = sim.sshOpen(timeout, key)
+        if session is None:
+            return None, False
+        if session.key is None:
+            return session, False
+        state = _probe(sim, session)
+        if state == 'device' and session.key == key:
+            sim.log(logging.INFO, 'reusing device session')
+            return session, True
+        if state == 'lxc' or (state == 'device' and _logout(sim, session)):
+            session.key = None
+            return session, False
+        sim.sshDiscard(session)
+
+
+def _run_commands(sim, interact, inlines, assertion, stream, timeout, fh):
+    """Send the commands to the logged in device, log the output to fh and
+    check it. Returns the AssertionResult and whether the session is
+    broken (an aborted command did not return to the prompt)."""
+    broken = False
+    if not isinstance(inlines, list):
+        inlines = list((inlines,))
+
+    outputs = list()
+    matcher = assertion.matcher(len(inlines)) if stream else None
+    for index, line in enumerate(inlines):
+        fh.write('>>> %s\n' % line)
+        decided = None
+        started = time()
+        with span(line, 'device'):
+            if matcher is None:
+                #interact.send(re.escape(line))
+                interact.send(line)
+                # interact.expect(re.escape(line))
+                interact.expect(PROMPT)
+                output = interact.current_output_clean
+            else:
+                output, decided = _stream_command(interact, line, matcher,
+                                                  index, timeout)
+        metrics.REGISTRY.observe(metrics.COMMAND_SECONDS, time() - started)
+        outputs.append(output)
+        fh.write('<<< %s\n' % output.split('\n')[0])
+        for oline in output.split('\n')[1:]:
+            fh.write('    %s\n' % oline)
+        if decided is not None:
+            # no need to wait for the rest of the output
+            sim.log(logging.INFO, 'result known early, aborting command')
+            broken = not _interrupt(interact)
+            break
+
+    if matcher is None:
+        ok = assertion.check(outputs)
+    else:
+        ok = matcher.result()
+    if ok.failed is not None:
+        m = ok.failed
+        sim.log(logging.INFO, 'failure [%s] in output %d line %d: %s',
+                m.pattern, m.command + 1, m.lineno + 1, m.line)
+        fh.write('=== failure [%s] in output %d line %d\n' % (
+            m.pattern, m.command + 1, m.lineno + 1))
+    for m in ok.matches:
+        sim.log(logging.INFO, 'matched [%s] in output %d line %d: %s',
+                m.pattern, m.command + 1, m.lineno + 1, m.line)
+        fh.write('=== matched [%s] in output %d line %d\n' % (
+            m.pattern, m.command + 1, m.lineno + 1))
+    for pattern in ok.missing:
+        fh.write('=== not found [%s]\n' % pattern)
+    return ok, broken
+
+
+def _login(interact, username, password, secret=None, init_cmd=()):
+    """Log in to the device on a fresh connection if asked for, enable if
+    the prompt is unprivileged and send the initialization commands.
+    Raises socket.error if the device does not respond as expected."""
+    _expect(interact, USERNAME_PROMPT + PASSWORD_PROMPT + PROMPT)
+    if interact.last_match in USERNAME_PROMPT:
+        interact.send(username or '')
+        _expect(interact, PASSWORD_PROMPT)
+    if interact.last_match in PASSWORD_PROMPT:
+        interact.send(password or '')
+        _expect(interact, PROMPT)
+
+    # if we get an unprivileged prompt then
+    # we're not enabled, need to enable first
+    if interact.last_match == CISCO_NOPRIV:
+        interact.send('enable')
+        _expect(interact, PASSWORD_PROMPT + PROMPT)
+        if interact.last_match in PASSWORD_PROMPT:
+            interact.send(secret or password or '')
+            _expect(interact, PROMPT)
+
+    # send the initialization (term length etc.)
+    for line in init_cmd:
+        interact.send(line)
+        _expect(interact, PROMPT)
+
+
+def _console_open(sim, node, username, password, timeout):
+    """Connect to the serial console of the node on the VIRL host and log
+    in, using the device profile for defaults and initialization.
+    Returns the TelnetInteraction, raises socket.error on failure."""
+    subtype, port = sim.getNodeDetail(node)
+    if not port:
+        raise socket.error('no console port for %s' % node)
+    profile = DEVICES.get(subtype)
+    if profile is None:
+        sim.log(logging.WARN, 'no console profile for device type [%s]', subtype)
+        profile = (None, None, None, [], [])
+    p_username, p_password, secret, init_cmd, _ = profile
+
+    sim.log(logging.INFO, 'connecting to console %s:%s', sim.simHost, port)
+    interact = TelnetInteraction(
+        socket.create_connection((sim.simHost, port), PROBE_TIMEOUT), timeout)
+    try:
+        # wake up the console
+        interact.send('')
+        with span('login', 'device', node=node), \
+                metrics.REGISTRY.timed(metrics.LOGIN_SECONDS,
+                                       transport='console'):
+            _login(interact, username or p_username, password or p_password,
+                   secret, init_cmd)
+    except (socket.error, EOFError):
+        interact.close()
+        raise
+    return interact
+
+
+class DeviceSSHInteraction(SSHClientInteraction):
+    "SSHClientInteraction which also closes its SSH client."
+
+    def __init__(self, client, timeout):
+        super(DeviceSSHInteraction, self).__init__(client, timeout=timeout)
+        self.client = client
+
+    def close(self):
+        super(DeviceSSHInteraction, self).close()
+        self.client.close()
+
+
+def _native_open(sim, dest_ip, transport, username, password, timeout):
+    """Open a channel through the mgmt LXC to the node, speak ssh or
+    telnet on it and log in. Returns the interaction, raises
+    socket.error on failure and paramiko.ChannelException if the LXC
+    does not forward channels."""
+    port = 22 if transport == 'ssh' else 23
+    channel = sim.channelOpen(dest_ip, port, timeout)
+    started = time()
+    if transport == 'telnet':
+        interact = TelnetInteraction(channel, timeout)
+    else:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(dest_ip, port, username=username,
+                           password=password, sock=channel,
+                           look_for_keys=False, allow_agent=False,
+                           timeout=timeout)
+            interact = DeviceSSHInteraction(client, timeout)
+        except paramiko.SSHException as e:
+            client.close()
+            raise socket.error('SSH to %s failed: %s' % (dest_ip, e))
+    try:
+        with span('login', 'device', node=dest_ip):
+            _login(interact, username, password)
+    except (socket.error, EOFError):
+        interact.close()
+        raise
+    metrics.REGISTRY.observe(metrics.LOGIN_SECONDS, time() - started,
+                             transport=transport)
+    return interact
+
+
+def _direct(sim, fh, interact, connect, inlines, assertion, timeout, converge, persistent, stream):
+    """Run the commands on a device connection of its own (not the LXC
+    shell). interact is a login kept from before (or None), connect()
+    opens a new one. Returns the result and the login to keep (or
+    None), errors raise socket.error."""
+    # a kept login must still show the prompt
+    if interact is not None:
+        try:
+            interact.send('')
+            _expect(interact, PROMPT, PROBE_TIMEOUT)
+            sim.log(logging.INFO, 'reusing device session')
+        except (socket.error, EOFError):
+            interact.close()
+            interact = None
+    if interact is None:
+        interact = connect()
+        sim.log(logging.INFO, 'logged in to target')
+
+    try:
+        ok, broken = _run_commands(sim, interact, inlines, assertion,
+                                   stream, timeout, fh)
+        if broken:
+            sim.log(logging.WARN, 'device did not return to the prompt')
+        elif persistent and not _config_mode(interact):
+            return ok, interact
+        else:
+            # leave configuration mode and log out
+            if _config_mode(interact):
+                interact.send('end')
+                _expect(interact, PROMPT)
+            interact.send('exit')
+    except (socket.error, EOFError):
+        if not converge:
+            fh.write('\n\npost-exception:')
+            fh.write('<<< %s\n' % interact.current_output)
+        interact.close()
+        raise
+    interact.close()
+    return ok, None
+
+
+def console_interaction(sim, fh, node, username, password, inlines, assertion, timeout, converge, persistent, stream):
+    """interact with a node directly through its serial console on the
+    VIRL host, see interaction(). The console is locked for the whole
+    interaction. With persistent set the login is kept open."""
+    ok = False
+    try:
+        interact = sim.consoleAcquire(node, timeout)
+    except socket.timeout:
+        sim.log(logging.CRITICAL, 'console of %s is busy', node)
+        fh.close()
+        return ok
+
+    keep = None
+    try:
+        ok, keep = _direct(
+            sim, fh, interact,
+            lambda: _console_open(sim, node, username, password, timeout),
+            inlines, assertion, timeout, converge, persistent, stream)
+    except socket.timeout:
+        if not converge:
+            sim.log(logging.CRITICAL, 'console interaction timed out (%ds)' % timeout)
+        else:
+            sim.log(logging.DEBUG, 'waiting for convergence')
+    except (socket.error, EOFError) as e:
+        if not converge:
+            sim.log(logging.CRITICAL, 'console interaction failed (%s)', e)
+        else:
+            sim.log(logging.DEBUG, 'waiting for convergence')
+    finally:
+        sim.consoleRelease(node, keep)
+        fh.close()
+    return ok
+
+
+def native_interaction(sim, fh, dest_ip, transport, username, password, inlines, assertion, timeout, converge, persistent, stream):
+    """interact with a node over a channel forwarded by the mgmt LXC, see
+    interaction(). Many nodes can be driven in parallel over the one
+    SSH connection to the LXC. With persistent set the login is kept
+    open. Raises paramiko.ChannelException if the LXC does not forward
+    channels."""
+    ok = False
+    key = (dest_ip, transport, username)
+    try:
+        ok, keep = _direct(
+            sim, fh, sim.deviceAcquire(key),
+            lambda: _native_open(sim, dest_ip, transport, username,
+                                 password, timeout),
+            inlines, assertion, timeout, converge, persistent, stream)
+        if keep is not None:
+            sim.deviceRelease(key, keep)
+    except socket.timeout:
+        if not converge:
+            sim.log(logging.CRITICAL, 'command interaction timed out (%ds)' % timeout)
+        else:
+            sim.log(logging.DEBUG, 'waiting for convergence')
+    except (socket.error, EOFError) as e:
+        if not converge:
+            sim.log(logging.CRITICAL, 'command interaction failed (%s)', e)
+        else:
+            sim.log(logging.DEBUG, 'waiting for convergence')
+    fh.close()
+    return ok
+
+
+def interaction(sim, logname, dest_ip, transport, username, password, inlines, output_re, logic, timeout, converge=False, persistent=False, scope='last', stream=False):
     """interact with sim nodes via the LXC host (client).
     - sim is the current simulation
     - logname is the name of the node for the log filename
       (if None then no log will be written
-    - dest_ip is the IP of the sim node
-    - transport is either 'ssh' or 'telnet'
+    - dest_ip is the IP of the sim node (the node name for 'console')
+    - transport is either 'ssh', 'telnet' (both through the LXC) or
+      'console' (the serial console on the VIRL host). If the sim is
+      native, ssh and telnet are spoken on channels forwarded by the
+      LXC, otherwise they are typed into the shell of the LXC.
     - username and password (default cisco/cisco)
     - inlines is a list of commands to be sent
     - output_re is a RE or list of REs we expect in the output
+      (or an already compiled OutputAssertion, logic and scope are
+      ignored in this case)
     - if logic is 'all', then all of the REs in output_re must match
       if logic is 'one', then at least one of the REs must match
     - timeout in seconds before the command interaction times out
     - converge is True if this is to check whether sim converged
       in this case, failure is OK, no logging if timeout / fail
       converge does not create a log file.
+    - persistent is True if the device login should be kept open after
+      the commands have been sent. The session is reused by the next
+      interaction with the same node, transport and username.
+    - scope defines which command output is matched: 'last', 'all'
+      or 'each' (see OutputAssertion)
+    - stream is True if the output should be matched while it comes in.
+      As soon as the result is known, the running command is aborted
+      and the remaining commands are not sent.
+    Returns the AssertionResult if the commands have been executed,
+    False otherwise. Both evaluate to the success of the interaction.
     """
 
-    RETRY_ATTEMPTS = 8
-    RETRY_SLEEP = 120
-
     ok = False
     fh = None
 
     # transport and RE logic
-    if transport not in ['ssh', 'telnet']:
-        sim.log(logging.CRITICAL, 'unknown transport (not ssh or telnet)')
-        return ok
-    if logic not in ['all', 'one', '!all', '!one']:
-        sim.log(logging.CRITICAL, 'unknown logic, valid: "[!]all, [!]one"')
+    if transport not in ['ssh', 'telnet', 'console']:
+        sim.log(logging.CRITICAL, 'unknown transport (not ssh, telnet or console)')
         return ok
-    negate = '!' in logic
-    logic = logic.replace('!', '')
-    sim.log(logging.DEBUG, 'transport: %s, negate: %s, logic: %s', transport, negate, logic)
-
-    # open the SSH connection to the node
-    interact = sim.sshOpen(timeout)
-    if interact is None:
-        return False
-
-    # make sure only one at a time
-    sim.lock()
+    if isinstance(output_re, OutputAssertion):
+        assertion = output_re
+    else:
+        try:
+            assertion = OutputAssertion(output_re, logic, scope)
+        except (ValueError, re.error) as e:
+            sim.log(logging.CRITICAL, 'output RE: %s', e)
+            return ok
+    sim.log(logging.DEBUG, 'transport: %s, negate: %s, logic: %s, scope: %s',
+            transport, assertion.negate, assertion.logic, assertion.scope)
 
     # get a logfile
     if logname is not None and not converge:
@@ -75,36 +494,70 @@ def interaction(sim, logname, dest_ip, transport, username, password, inlines, o
     else:
         fh = open(devnull, "w")
 
-    # this is the LXC prompt we expect
-    LXC_PROMPT = [r'%s@[\w-]+\$ ?' % sim.simUser]
-
-    # we need to get a prompt from the mgmt LXC
-    done = False
-    attempts = RETRY_ATTEMPTS
-    while not done:
+    if transport == 'console':
+        return console_interaction(sim, fh, dest_ip, username, password,
+                                   inlines, assertion, timeout, converge,
+                                   persistent, stream)
+    if sim.simNative:
         try:
-            interact.send('')
-            interact.expect(LXC_PROMPT)
-        except socket.timeout as e:
-            sim.log(logging.WARN, 'ATTENTION: LXC issue (%s, %s)' % attempts, e)
-            done = attempts > 0
-            attempts -= 1
-            sleep(RETRY_SLEEP)
-        except socket.error as e:
-            sim.log(logging.CRITICAL, 'SSH error (%s)' % e)
-            interact = sim.sshOpen(timeout)
-            if interact is None:
-                sim.unlock()
-                fh.close()
-                return False
-        else:
-            done = True
+            return native_interaction(sim, fh, dest_ip, transport, username,
+                                      password, inlines, assertion, timeout,
+                                      converge, persistent, stream)
+        except paramiko.ChannelException as e:
+            # forwarding disabled on the LXC, use its shell from now on
+            sim.log(logging.WARN, 'LXC does not forward channels (%s)', e)
+            sim.simNative = False
 
-    # interact with the target sourced from LXC mgmt host
-    sim.log(logging.INFO, 'got initial prompt')
+    # get a SSH session to the LXC from the pool of the sim,
+    # waits if all sessions are in use by other actions
+    key = (dest_ip, transport, username)
+    session, logged_in = _session(sim, key, timeout)
+    if session is None:
+        sim.log(logging.CRITICAL, 'no LXC SSH session within %ds',
+                sim.simTimeout)
+        fh.close()
+        return False
+    interact = session.interact
+
+    # this is the LXC prompt we expect
+    LXC_PROMPT = lxc_prompt(sim)
+
+    # the session goes back to the pool only if the interaction got
+    # through, otherwise its state is unknown
+    healthy = False
     try:
-        done = False
-        attempts = RETRY_ATTEMPTS
+        # we need to get a prompt from the mgmt LXC
+        done = logged_in
+        retry = sim.backoff()
+        while not done:
+            try:
+                interact.send('')
+                interact.expect(LXC_PROMPT)
+            except socket.timeout as e:
+                sim.log(logging.WARN, 'ATTENTION: LXC issue (%ds left, %s)',
+                        retry.remaining(), e)
+                if retry.expired():
+                    return False
+                with span('sleep', 'wait'):
+                    sleep(retry.next())
+            except socket.error as e:
+                sim.log(logging.CRITICAL, 'SSH error (%s)' % e)
+                sim.sshDiscard(session)
+                # not discarded twice should _session() raise
+                session = None
+                session, _ = _session(sim, None, timeout)
+                if session is None:
+                    return False
+                interact = session.interact
+            else:
+                done = True
+
+        # interact with the target sourced from LXC mgmt host
+        if not logged_in:
+            sim.log(logging.INFO, 'got initial prompt')
+        started = time()
+        done = logged_in
+        retry = sim.backoff()
         while not done:
             if transport == 'ssh':
                 interact.send('ssh 2>&1 -v -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no %s@%s' % (username, dest_ip))
@@ -116,75 +569,70 @@ def interaction(sim, logname, dest_ip, transport, username, password, inlines, o
             if not done:
                 sim.log(logging.WARN, 'ATTENTION: [%s]' % interact.current_output_clean.replace('\n', '\\n'))
                 sim.log(logging.WARN, 'ATTENTION: last match: [%s]' % interact.last_match)
-                sim.log(logging.WARN, 'ATTENTION: connection issue (%s)' % attempts)
-                if attempts == 0:
+                sim.log(logging.WARN, 'ATTENTION: connection issue (%ds left)' % retry.remaining())
+                if retry.expired():
+                    raise socket.timeout
+                sim.sshDiscard(session)
+                session = None
+                with span('sleep', 'wait'):
+                    sleep(retry.next())
+                session, _ = _session(sim, None, timeout)
+                if session is None:
                     raise socket.timeout
-                sim.sshClose()
-                sleep(RETRY_SLEEP)
-                interact = sim.sshOpen(timeout)
+                interact = session.interact
                 interact.send('')
                 interact.expect(LXC_PROMPT)
-                attempts -= 1
 
-        sim.log(logging.INFO, 'logged in to target')
-        if transport == 'ssh':
-            interact.send(password)
-        if transport == 'telnet':
-            if interact.last_match in USERNAME_PROMPT:
-                interact.send(username)
-                interact.expect(PASSWORD_PROMPT)
-            if interact.last_match in PASSWORD_PROMPT:
+        if not logged_in:
+            sim.log(logging.INFO, 'logged in to target')
+            if transport == 'ssh':
                 interact.send(password)
-        interact.expect(PROMPT)
-
-        # if we get an unprivileged prompt then
-        # we're not enabled, need to enable first
-        if interact.last_match == CISCO_NOPRIV:
-            interact.send('enable')
-            interact.expect(PASSWORD_PROMPT)
-            interact.send(password)
+            if transport == 'telnet':
+                if interact.last_match in USERNAME_PROMPT:
+                    interact.send(username)
+                    interact.expect(PASSWORD_PROMPT)
+                if interact.last_match in PASSWORD_PROMPT:
+                    interact.send(password)
             interact.expect(PROMPT)
 
-        # at this point we SHOULD be logged in
-        interact.send('')
-        interact.expect(PROMPT)
-
-        if not isinstance(inlines, list):
-            inlines = list((inlines,))
-
-        if not isinstance(output_re, list):
-            output_re = list((output_re,))
+            # if we get an unprivileged prompt then
+            # we're not enabled, need to enable first
+            if interact.last_match == CISCO_NOPRIV:
+                interact.send('enable')
+                interact.expect(PASSWORD_PROMPT)
+                interact.send(password)
+                interact.expect(PROMPT)
 
-        for line in inlines:
-            #interact.send(re.escape(line))
-            interact.send(line)
-            fh.write('>>> %s\n' % line)
-            # interact.expect(re.escape(line))
+            # at this point we SHOULD be logged in
+            interact.send('')
             interact.expect(PROMPT)
-            fh.write('<<< %s\n' % interact.current_output_clean.split('\n')[0])
-            for oline in interact.current_output_clean.split('\n')[1:]:
-                fh.write('    %s\n' % oline)
+            metrics.REGISTRY.observe(metrics.LOGIN_SECONDS, time() - started,
+                                     transport=transport)
 
-        lines_found = 0
-        for re_line in output_re:
-            for oline in interact.current_output_clean.split('\n'):
-                if re.search(re_line, oline):
-                    lines_found += 1
-                    break
-            if lines_found > 0 and logic == 'one':
-                break
-        # xor with negate is the result
-        ok = negate != (lines_found == len(output_re) or lines_found > 0 and logic == 'one')
-
-        # logout from the router
-        interact.send('exit')
-        interact.expect(LXC_PROMPT)
+        ok, broken = _run_commands(sim, interact, inlines, assertion,
+                                   stream, timeout, fh)
+
+        # keep the login for the next interaction with this device
+        # unless it has been left in configuration mode. Otherwise
+        # logout from the router. If an aborted command did not return
+        # to the prompt, the session is unusable.
+        if not broken:
+            if persistent and not _config_mode(interact):
+                session.key = key
+            else:
+                # exit only leaves configuration mode, end it first
+                if _config_mode(interact):
+                    interact.send('end')
+                    _expect(interact, PROMPT)
+                interact.send('exit')
+                _expect(interact, LXC_PROMPT)
+                session.key = None
+            healthy = True
 
     except socket.timeout:
         if not converge:
             sim.log(logging.CRITICAL, 'command interaction timed out (%ds)' % timeout)
             sim.log(logging.CRITICAL, 'last match: [%s]' % interact.last_match)
-            sim.sshClose()
             # write rest of output to file
             fh.write('\n\npost-exception:')
             fh.write('<<< %s\n' % interact.current_output_clean.split('\n')[0])
@@ -193,8 +641,18 @@ def interaction(sim, logname, dest_ip, transport, username, password, inlines, o
             # input('[enter to continue]')
         else:
             sim.log(logging.DEBUG, 'waiting for convergence')
-
-    fh.close()
-    sim.unlock()
+    except (socket.error, EOFError) as e:
+        if not converge:
+            sim.log(logging.CRITICAL, 'command interaction failed (%s)', e)
+        else:
+            sim.log(logging.DEBUG, 'waiting for convergence')
+    finally:
+        fh.close()
+        # a session in an unknown state is not handed out again
+        if session is not None:
+            if healthy:
+                sim.sshRelease(session)
+            else:
+                sim.sshDiscard(session)
 
     return ok
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Compile command files into the plan that is run: render the Jinja
+template, parse the YAML, resolve the includes and validate the result.
+Compiled plans are cached, keyed on the content of the command file,
+all its includes and the environment variables the templates use."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+import jinja2
+import yaml
+
+# bump this if the structure of compiled plans changes
+VERSION = 1
+
+MAX_DEPTH = 10
+
+# env["NAME"], env['NAME'] and env.get('NAME') in templates
+ENV_RE = re.compile(r'''\benv\s*(?:\[|\.get\()\s*['"]([^'"]+)['"]''')
+ENV_USE_RE = re.compile(r'\benv\b')
+
+
+class CompileError(Exception):
+    "The command file can't be read, rendered, parsed or is invalid."
+
+
+def default_cache_dir():
+    "The directory where compiled plans are cached."
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'virltester')
+
+
+# validation of values: (description, check)
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+def _is_scalars(value):
+    return _is_scalar(value) or (isinstance(value, list) and
+                                 all(_is_scalar(v) for v in value))
+
+
+STRING = ('a string', lambda v: isinstance(v, str))
+SCALAR = ('a string or number', lambda v: isinstance(v, (str, int, float)))
+INT = ('an integer', _is_int)
+NUMBER = ('a number', lambda v: _is_int(v) or isinstance(v, float))
+BOOL = ('yes or no', lambda v: isinstance(v, bool))
+SCALARS = ('a string or a list of strings', _is_scalars)
+PATTERNS = ('a regex or a non-empty list of regexes (or lists of regexes)',
+            lambda v: _is_scalar(v) or (isinstance(v, list) and v and
+                                        all(_is_scalars(p) for p in v)))
+COUNT = ('a count or a condition like ">=5"',
+         lambda v: _is_int(v) or isinstance(v, str))
+COUNTS = ('a mapping of names to counts',
+          lambda v: isinstance(v, dict) and
+          all(_is_int(c) or isinstance(c, str) for c in v.values()))
+REUSE = ('yes, no or attach', lambda v: isinstance(v, bool) or v == 'attach')
+
+
+def choice(*values):
+    "Check for one of the given values."
+    return ('one of %s' % ', '.join(values), lambda v: v in values)
+
+
+CONFIG = dict(
+    host=STRING, port=INT, username=SCALAR, password=SCALAR, loglevel=INT,
+    wait=INT, parallel=INT, stagger=NUMBER, sessions=INT, persistent=BOOL,
+    captures=STRING, native=BOOL, engine=choice('threads', 'asyncio'),
+    workers=INT, concurrency=INT, reuse=REUSE, metrics=STRING,
+    metrics_interval=NUMBER,
+)
+
+SIM = dict(
+    topo=STRING, nodes=('a list of nodes', lambda v: isinstance(v, list)),
+    skip=BOOL, log=BOOL, username=SCALAR, password=SCALAR, wait=INT,
+    sessions=INT, persistent=BOOL, captures=STRING, native=BOOL,
+    concurrency=INT, reuse=REUSE,
+    converge=('a mapping', lambda v: isinstance(v, dict)),
+    reset=('a list of nodes', lambda v: isinstance(v, list)),
+)
+SIM_REQUIRED = ('topo',)
+
+NODE = dict(
+    name=SCALAR, username=SCALAR, password=SCALAR,
+    actions=('a list of actions', lambda v: isinstance(v, list)),
+)
+NODE_REQUIRED = ('name',)
+
+ACTION = dict(
+    type=choice('command', 'converge', 'filter'), background=BOOL,
+    sleep=NUMBER, wait=NUMBER, id=SCALAR, depends_on=SCALARS,
+)
+COMMAND = dict(
+    ACTION, log=BOOL, logic=choice('one', 'all', '!one', '!all'),
+    scope=choice('last', 'all', 'each'), transport=choice('telnet', 'ssh', 'console'),
+    username=SCALAR, password=SCALAR, persistent=BOOL, stream=BOOL,
+    fail=SCALARS, out=PATTERNS, **{'in': SCALARS}
+)
+FILTER = dict(
+    ACTION, intfc=STRING, bpf=STRING, count=INT, expect_packets=COUNT,
+    expect_min=INT, expect_protocols=COUNTS, expect_hosts=COUNTS,
+)
+GATE = dict(
+    COMMAND, nodes=('a list of node names', lambda v: isinstance(v, list) and
+                    all(isinstance(n, (str, int)) for n in v)),
+    quorum=INT, timeout=NUMBER,
+)
+for key in ('type', 'background', 'id', 'depends_on'):
+    del GATE[key]
+GATE_REQUIRED = ('nodes', 'in')
+
+ACTIONS = {
+    'command': (COMMAND, ('in',)),
+    'converge': (COMMAND, ('in',)),
+    'filter': (FILTER, ('intfc',)),
+}
+
+
+class Validator(object):
+    """Checks a command file against the schema. Errors are collected
+    with the path of the offending element, unknown keys are only
+    reported as warnings."""
+
+    def __init__(self, source):
+        super(Validator, self).__init__()
+        self.source = source
+        self.errors = list()
+        self.warnings = list()
+
+    def _mapping(self, path, value, schema, required=()):
+        "Validate the keys of a mapping, False if it is no mapping."
+        if not isinstance(value, dict):
+            self.errors.append('%s: must be a mapping' % path)
+            return False
+        for key in required:
+            if key not in value:
+                self.errors.append('%s: "%s" is missing' % (path, key))
+        for key, item in value.items():
+            spec = schema.get(key)
+            if spec is None:
+                if not str(key).startswith('_'):
+                    self.warnings.append('%s: unknown key "%s"' % (path, key))
+            elif not spec[1](item):
+                self.errors.append('%s.%s: must be %s' % (path, key, spec[0]))
+        return True
+
+    def _action(self, path, action):
+        if not isinstance(action, dict):
+            self.errors.append('%s: must be a mapping' % path)
+            return
+        schema, required = ACTIONS.get(action.get('type'), (ACTION, ()))
+        self._mapping(path, action, schema, ('type',) + required)
+
+    def _node(self, path, node):
+        if self._mapping(path, node, NODE, NODE_REQUIRED):
+            for i, action in enumerate(node.get('actions') or list()):
+                self._action('%s.actions[%d]' % (path, i), action)
+
+    def _sim(self, path, sim):
+        if self._mapping(path, sim, SIM, SIM_REQUIRED):
+            for key in ('nodes', 'reset'):
+                for i, node in enumerate(sim.get(key) or list()):
+                    self._node('%s.%s[%d]' % (path, key, i), node)
+                self._dependencies(path, sim, key)
+            if isinstance(sim.get('converge'), dict):
+                self._gate('%s.converge' % path, sim['converge'])
+
+    def _gate(self, path, gate):
+        if self._mapping(path, gate, GATE, GATE_REQUIRED):
+            nodes, quorum = gate.get('nodes'), gate.get('quorum')
+            if isinstance(nodes, list) and _is_int(quorum):
+                if not 0 < quorum <= len(nodes):
+                    self.errors.append('%s.quorum: must be 1 to %d' % (
+                        path, len(nodes)))
+
+    def _dependencies(self, path, sim, key):
+        """Check that the action ids of the nodes (or reset nodes) are
+        unique and depends_on has no cycles."""
+        ids, deps = dict(), dict()
+        for i, node in enumerate(sim.get(key) or list()):
+            if not isinstance(node, dict):
+                continue
+            for j, action in enumerate(node.get('actions') or list()):
+                if not isinstance(action, dict):
+                    continue
+                where = '%s.%s[%d].actions[%d]' % (path, key, i, j)
+                if action.get('id') is not None:
+                    ident = str(action['id'])
+                    if ident in ids:
+                        self.errors.append('%s: duplicate id "%s"' % (where, ident))
+                    ids[ident] = where
+                depends_on = action.get('depends_on')
+                if depends_on is None:
+                    continue
+                if not isinstance(depends_on, list):
+                    depends_on = [depends_on]
+                deps[where] = (action.get('id'), [str(d) for d in depends_on])
+
+        edges = dict()
+        for where, (ident, depends_on) in deps.items():
+            for dep in depends_on:
+                if dep not in ids:
+                    self.errors.append('%s.depends_on: unknown id "%s"' % (where, dep))
+            if ident is not None:
+                edges[str(ident)] = [d for d in depends_on if d in ids]
+
+        # depth first search for a cycle through the ids
+        state = dict()
+        for start in sorted(edges):
+            if start in state:
+                continue
+            state[start] = 'visiting'
+            stack = [(start, iter(edges[start]))]
+            while stack:
+                ident, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    state[ident] = 'done'
+                    stack.pop()
+                elif state.get(child) == 'visiting':
+                    self.errors.append('%s: depends_on cycle through "%s"' % (
+                        path, child))
+                    return
+                elif child not in state:
+                    state[child] = 'visiting'
+                    stack.append((child, iter(edges.get(child, ()))))
+
+    def validate(self, data):
+        "Validate the (included) data, returns True if there are no errors."
+        config = data.get('config')
+        if config is not None:
+            self._mapping('config', config, CONFIG)
+        for key in data:
+            if key not in ('config', 'sims', 'includes'):
+                self.warnings.append('unknown key "%s"' % key)
+        sims = data.get('sims')
+        if not isinstance(sims, list):
+            self.errors.append('sims: must be a list of sims')
+            return False
+        for i, sim in enumerate(sims):
+            source = sim.get('_source', self.source) if isinstance(sim, dict) else self.source
+            self._sim('%s: sims[%d]' % (source, i), sim)
+        return not self.errors
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Compiler(object):
+    """Compiles a command file and its includes. Includes are resolved
+    relative to the file that includes them, the process working
+    directory is never changed (compiling is thread safe). env is the
+    environment for the templates (defaults to os.environ)."""
+
+    def __init__(self, env=None, cache_dir=None, logger=None):
+        super(Compiler, self).__init__()
+        self._env = dict(os.environ if env is None else env)
+        self._cache_dir = cache_dir
+        self._logger = logger or logging.getLogger(__name__)
+        # sha256 of all files read and the env vars used while compiling
+        self._deps = dict()
+        self._env_used = set()
+        self._env_all = False
+
+    def _render(self, filename, source):
+        "Render the Jinja template, note which env vars it uses."
+        names = set(ENV_RE.findall(source))
+        if len(ENV_USE_RE.findall(source)) > len(ENV_RE.findall(source)):
+            # env is used in a way we can't follow, depend on all of it
+            self._env_all = True
+        self._env_used.update(names)
+        try:
+            return jinja2.Template(source).render(env=self._env)
+        except jinja2.TemplateError as e:
+            raise CompileError('%s: template: %s' % (filename, e))
+
+    def _load(self, filename, reldir, depth):
+        """Load the file and its includes. reldir is the directory of the
+        file relative to the top level file (topo paths are relative to
+        the top level file)."""
+        if depth > MAX_DEPTH:
+            raise CompileError('%s: includes nested too deep' % filename)
+        try:
+            with open(filename, 'rb') as fh:
+                raw = fh.read()
+        except (IOError, OSError) as e:
+            raise CompileError('%s: %s' % (filename, e.strerror))
+        self._deps[os.path.abspath(filename)] = _hash(raw)
+
+        try:
+            data = yaml.safe_load(self._render(filename, raw.decode('utf-8')))
+        except (yaml.YAMLError, UnicodeDecodeError) as e:
+            raise CompileError('%s: %s' % (filename, str(e).replace('\n', ' ')))
+        if data is None:
+            data = dict()
+        if not isinstance(data, dict):
+            raise CompileError('%s: must be a mapping' % filename)
+        if data.get('sims') is None:
+            data['sims'] = list()
+        if not isinstance(data['sims'], list):
+            raise CompileError('%s: sims: must be a list of sims' % filename)
+
+        for sim in data['sims']:
+            if isinstance(sim, dict) and isinstance(sim.get('topo'), str):
+                topo = os.path.expanduser(sim['topo'])
+                # topos of included files are relative to the include
+                # but only if the topo name is not absolute
+                if reldir and not os.path.isabs(topo):
+                    topo = os.path.join(reldir, topo)
+                sim['topo'] = topo
+
+        includes = data.pop('includes', None) or list()
+        if not isinstance(includes, list):
+            raise CompileError('%s: includes: must be a list of files' % filename)
+        directory = os.path.dirname(filename)
+        for include in includes:
+            subdata = self._load(os.path.join(directory, include),
+                                 os.path.join(reldir, os.path.dirname(include)),
+                                 depth + 1)
+            for sim in subdata['sims']:
+                # make a note from where this was included
+                if isinstance(sim, dict):
+                    sim.setdefault('_source', include)
+                # append the sims to the parent sim list
+                data['sims'].append(sim)
+        return data
+
+    def _cache_file(self, filename):
+        name = _hash(os.path.abspath(filename).encode('utf-8'))
+        return os.path.join(self._cache_dir, '%s.json' % name)
+
+    def _env_key(self, names):
+        return {name: self._env.get(name) for name in names}
+
+    def _cached(self, filename):
+        "Return the cached plan if none of its inputs has changed."
+        try:
+            with open(self._cache_file(filename), 'r') as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('version') != VERSION:
+            return None
+        if entry['env_all']:
+            if entry['env'] != _hash(json.dumps(self._env, sort_keys=True).encode()):
+                return None
+        elif entry['env'] != self._env_key(entry['env_used']):
+            return None
+        for path, digest in entry['deps'].items():
+            try:
+                with open(path, 'rb') as fh:
+                    if _hash(fh.read()) != digest:
+                        return None
+            except (IOError, OSError):
+                return None
+        return entry['plan']
+
+    def _store(self, filename, plan):
+        "Cache the plan, silently skipped if it can't be stored as JSON."
+        if self._env_all:
+            env = _hash(json.dumps(self._env, sort_keys=True).encode())
+        else:
+            env = self._env_key(self._env_used)
+        entry = dict(version=VERSION, deps=self._deps, env_all=self._env_all,
+                     env_used=sorted(self._env_used), env=env, plan=plan)
+        try:
+            data = json.dumps(entry)
+            if json.loads(data)['plan'] != plan:
+                return
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+            tmp = self._cache_file(filename) + '.%d' % os.getpid()
+            with open(tmp, 'w') as fh:
+                fh.write(data)
+            os.replace(tmp, self._cache_file(filename))
+        except (TypeError, ValueError, IOError, OSError) as e:
+            self._logger.debug('plan not cached: %s', e)
+
+    def compile(self, filename):
+        """Compile the command file, returns the plan (the command file
+        dict with all includes resolved). Raises CompileError."""
+        if self._cache_dir is not None:
+            plan = self._cached(filename)
+            if plan is not None:
+                self._logger.info('using cached plan for %s', filename)
+                return plan
+
+        self._deps, self._env_used, self._env_all = dict(), set(), False
+        plan = self._load(filename, '', 0)
+        validator = Validator(filename)
+        ok = validator.validate(plan)
+        for warning in validator.warnings:
+            self._logger.warning('%s: %s', filename, warning)
+        if not ok:
+            raise CompileError('%s is invalid:\n%s' % (
+                filename, '\n'.join(validator.errors)))
+
+        if self._cache_dir is not None:
+            self._store(filename, plan)
+        return plan
+
+
+def compile_file(filename, cache_dir=None, env=None, logger=None):
+    "Compile the command file, see Compiler."
+    return Compiler(env, cache_dir, logger).compile(filename)
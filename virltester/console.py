@@ -3,7 +3,9 @@
 
 import logging
 import re
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from telnetlib import Telnet
 from socket import error as socket_error
 from .prompts import CISCO_PROMPT, LINUX_PROMPT, USERNAME_PROMPT, PASSWORD_PROMPT, CISCO_NOPRIV
@@ -66,12 +68,13 @@ COREOS = ['~coreos', 'cisco', 'cisco', '', [], ['ip route', 'ifconfig -a']]
 
 DEVICES = {n[0]: n[1:] for n in [ASAV, CSR1KV, IOSV, IOSVL2, IOSXRV, IOSXRV9K, NXOSV, NXOSV9K, SERVER, COREOS]}
 
-LastMatch = None
-
 TIMEOUT = 5
 ENCODING = 'utf-8'
 CRLF = '\r\n'
 
+# number of consoles read concurrently during post-mortem
+WORKERS = 8
+
 # this needs to be byte-encoded for telnetlib...!?
 PROMPT = [p.encode(ENCODING) for p in CISCO_PROMPT + LINUX_PROMPT]
 UPRMPT = [p.encode(ENCODING) for p in USERNAME_PROMPT]
@@ -82,34 +85,6 @@ NOPRIV = [CISCO_NOPRIV.encode(ENCODING)]
     and have not been logged in at this point.
 """
 
-def sendLine(telnet, prompt, line):
-    """sends a line, then expects a prompt.
-    the returned data from expect is:
-    - p[0] the index of the given RE list that matched
-    - p[1] the matched sre
-    - p[2] the entire returned data (including the match)
-    we then remove the prompt in the data.
-    """
-    global LastMatch
-
-    if line is None:
-        return None
-
-    send_line = line.encode(ENCODING)
-    # TODO: the following is a bit fishy:
-    # b/c of adding the additional \n to the line?
-    # works... needs testing if that would only be
-    # added when needed?
-    telnet.write(send_line + b'\n')
-    if line != CRLF and not myMatch(UPRMPT + PPRMPT, LastMatch):
-        telnet.expect([send_line], TIMEOUT)
-    p = telnet.expect(prompt, TIMEOUT)
-    if p[0] is -1:
-        return None
-    r = p[1].group(0)
-    LastMatch = r
-    return p[2].decode(ENCODING)
-
 
 def myMatch(pattern_list, string):
     "Match the pattern."
@@ -121,60 +96,140 @@ def myMatch(pattern_list, string):
     return False
 
 
+class ConsoleSession(object):
+    """A telnet session to the serial console of a node on the VIRL host.
+    All state (like the last prompt seen) is kept per session so that
+    sessions to different consoles can be used concurrently."""
+
+    def __init__(self, host, port, timeout=TIMEOUT):
+        super(ConsoleSession, self).__init__()
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._telnet = None
+        self.last_match = None
+
+    def open(self):
+        "Connect to the console, raises socket.error on failure."
+        self._telnet = Telnet(self._host, self._port, self._timeout)
+
+    def close(self):
+        "Close the connection to the console."
+        if self._telnet is not None:
+            self._telnet.close()
+            self._telnet = None
+
+    def matches(self, pattern_list):
+        "Does the last prompt seen match one of the patterns?"
+        return myMatch(pattern_list, self.last_match)
+
+    def sendLine(self, prompt, line, timeout=None):
+        """sends a line, then expects a prompt.
+        the returned data from expect is:
+        - p[0] the index of the given RE list that matched
+        - p[1] the matched sre
+        - p[2] the entire returned data (including the match)
+        we then remove the prompt in the data.
+        """
+        if line is None:
+            return None
+        if timeout is None:
+            timeout = self._timeout
+
+        send_line = line.encode(ENCODING)
+        # TODO: the following is a bit fishy:
+        # b/c of adding the additional \n to the line?
+        # works... needs testing if that would only be
+        # added when needed?
+        self._telnet.write(send_line + b'\n')
+        if line != CRLF and not self.matches(UPRMPT + PPRMPT):
+            self._telnet.expect([re.escape(send_line)], timeout)
+        p = self._telnet.expect(prompt, timeout)
+        if p[0] == -1:
+            return None
+        self.last_match = p[1].group(0)
+        return p[2].decode(ENCODING)
+
+    def login(self, username, password, secret):
+        """Wake up the console, login and enable if asked for. Returns
+        False if the console does not show any prompt."""
+        self.sendLine(UPRMPT + PROMPT, CRLF)
+        if self.last_match is None:
+            return False
+
+        # login prompt?
+        if self.matches(UPRMPT):
+            self.sendLine(PPRMPT, username)
+            self.sendLine(PROMPT, password)
+
+        # need to enable?
+        if self.matches(NOPRIV):
+            self.sendLine(PPRMPT, 'enable')
+            self.sendLine(PROMPT, secret)
+        return True
+
+    def logout(self):
+        "close session (should work across the board)"
+        try:
+            self.sendLine([b'.*'], 'exit')
+        except EOFError:
+            # the device closed the connection already
+            pass
+
+
 def postMortem(sim, sim_node_id, device_type, host, port):
-    "Post mortem mode... interact direct with the console and log to file."
+    """Post mortem mode... interact direct with the console and log to file.
+    Returns True if the show commands could be run."""
     st = DEVICES.get(device_type)
     if st is None:
         sim.log(logging.CRITICAL, 'postMortem: unknown device type [%s]' % device_type)
-        return
+        return False
 
     username, password, secret, init_cmd, show_cmd = st
 
     if sim is not None:
         fh = open("pm-%s-%s.log" % (sim.simId, sim_node_id), "w")
     else:
-        import sys
         fh = sys.stdout
 
+    ok = False
+    session = ConsoleSession(host, port)
     try:
-        tn = Telnet(host, port)
-    except socket_error as e:
-        fh.write(st)
-        fh.write(str(e))
-    else:
-        sendLine(tn, UPRMPT + PROMPT, CRLF)
-
-        if LastMatch is None:
+        session.open()
+        if not session.login(username, password, secret):
             fh.write('can\'t get a response!')
+        else:
+            # send the initialization (term length etc.)
+            for line in init_cmd:
+                session.sendLine(PROMPT, line)
+
+            # send the actual show commands
+            for line in show_cmd:
+                p = session.sendLine(PROMPT, line)
+                if p is not None:
+                    fh.write(p)
+
+            session.logout()
+            ok = True
+    except (socket_error, EOFError) as e:
+        fh.write('%s %s:%s: %s\n' % (device_type, host, port, e))
+    finally:
+        session.close()
+        if fh is not sys.stdout:
             fh.close()
-            tn.close()
-            return
-
-        # login prompt?
-        if myMatch(UPRMPT, LastMatch):
-            sendLine(tn, PPRMPT, username)
-            sendLine(tn, PROMPT, password)
-
-        # need to enable?
-        if myMatch(NOPRIV, LastMatch):
-            sendLine(tn, PPRMPT, 'enable')
-            sendLine(tn, PROMPT, secret)
-
-        # send the initialization (term length etc.)
-        for line in init_cmd:
-            sendLine(tn, PROMPT, line)
-
-        # send the actual show commands
-        for line in show_cmd:
-            p = sendLine(tn, PROMPT, line)
-            if p is not None:
-                fh.write(p)
-
-        # close session (should work across the board)
-        sendLine(tn, [b'.*'], 'exit')
-        tn.close()
-
-    fh.close()
+    return ok
+
+
+def postMortems(sim, nodes, host, workers=WORKERS):
+    """Run postMortem for all (node, device type, console port) in nodes,
+    at most 'workers' at a time. Returns a dict node -> success."""
+    if not nodes:
+        return dict()
+    with ThreadPoolExecutor(max_workers=min(workers, len(nodes))) as pool:
+        futures = {node: pool.submit(postMortem, sim, node, device_type,
+                                     host, port)
+                   for node, device_type, port in nodes}
+    return {node: future.result() for node, future in futures.items()}
 
 
 #postMortem(None, 'test', 'CSR1000v', '172.23.175.245', 17000)
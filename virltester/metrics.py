@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""In-process counters and histograms (REST latency, SSH connect and
+device login times, command round trips, polls and sim spin-up) which
+are written periodically to a textfile in the Prometheus exposition
+format, so node-exporter's textfile collector can pick them up while a
+long run is going."""
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import time
+
+# histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+           60, 120, 300, 600)
+
+# default seconds between two writes of the textfile
+INTERVAL = 15
+
+
+def _labels(labels):
+    "The label set as a hashable key (sorted name, value pairs)."
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(name, key, value, extra=()):
+    labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in key + extra)
+    if labels:
+        name = '%s{%s}' % (name, labels)
+    return '%s %s' % (name, repr(float(value)) if isinstance(value, float)
+                      else value)
+
+
+class Counter(object):
+    "A counter per label set. The sample name gets the _total suffix."
+
+    kind = 'counter'
+
+    def __init__(self, name, doc):
+        super(Counter, self).__init__()
+        self.name = name
+        self.doc = doc
+        self._values = dict()
+
+    def inc(self, amount=1, **labels):
+        "Add amount to the counter of the labels."
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        "The current count of the labels."
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self):
+        "Yields the lines of the counter."
+        for key, value in sorted(self._values.items()):
+            yield _format(self.name + '_total', key, value)
+
+
+class Histogram(object):
+    "A histogram of observed values (seconds) per label set."
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=BUCKETS):
+        super(Histogram, self).__init__()
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self._values = dict()
+
+    def observe(self, value, **labels):
+        "Count the value in the buckets of the labels."
+        key = _labels(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # one count per bucket, +Inf, the sum
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def count(self, **labels):
+        "The number of observed values of the labels."
+        counts = self._values.get(_labels(labels))
+        return counts[-2] if counts else 0
+
+    def total(self, **labels):
+        "The sum of the observed values of the labels."
+        counts = self._values.get(_labels(labels))
+        return counts[-1] if counts else 0.0
+
+    def samples(self):
+        "Yields the lines of the histogram (buckets are cumulative)."
+        for key, counts in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield _format(self.name + '_bucket', key, count,
+                              (('le', repr(float(bound))),))
+            yield _format(self.name + '_bucket', key, counts[-2],
+                          (('le', '+Inf'),))
+            yield _format(self.name + '_count', key, counts[-2])
+            yield _format(self.name + '_sum', key, counts[-1])
+
+
+class Registry(object):
+    """All metrics of the process. Updates and rendering are serialized
+    by one lock, metrics are cheap to update from any thread."""
+
+    def __init__(self):
+        super(Registry, self).__init__()
+        self._lock = threading.Lock()
+        self._metrics = list()
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc):
+        "Returns a new Counter registered under name."
+        return self._add(Counter(name, doc))
+
+    def histogram(self, name, doc, buckets=BUCKETS):
+        "Returns a new Histogram registered under name."
+        return self._add(Histogram(name, doc, buckets))
+
+    def inc(self, counter, amount=1, **labels):
+        "Increment the counter."
+        with self._lock:
+            counter.inc(amount, **labels)
+
+    def observe(self, histogram, value, **labels):
+        "Observe the value in the histogram."
+        with self._lock:
+            histogram.observe(value, **labels)
+
+    @contextmanager
+    def timed(self, histogram, **labels):
+        "Observe the run time of the block (also if it raises)."
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(histogram, time() - start, **labels)
+
+    def render(self):
+        "Returns the text exposition of all metrics."
+        lines = list()
+        with self._lock:
+            for metric in self._metrics:
+                name = metric.name
+                if metric.kind == 'counter':
+                    name += '_total'
+                lines.append('# HELP %s %s' % (name, metric.doc))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+                lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REST_SECONDS = REGISTRY.histogram(
+    'virltester_rest_request_seconds',
+    'Latency of VIRL API requests by verb and endpoint.')
+REST_ERRORS = REGISTRY.counter(
+    'virltester_rest_errors',
+    'VIRL API requests which failed by verb, endpoint and status code.')
+SSH_OPEN_SECONDS = REGISTRY.histogram(
+    'virltester_ssh_open_seconds',
+    'Time to get a LXC SSH session from the pool (waiting included).')
+SSH_CONNECT_SECONDS = REGISTRY.histogram(
+    'virltester_ssh_connect_seconds',
+    'Time to establish a new SSH session to the mgmt LXC.')
+SSH_CONNECT_ERRORS = REGISTRY.counter(
+    'virltester_ssh_connect_errors',
+    'SSH connections to the mgmt LXC which failed.')
+LOGIN_SECONDS = REGISTRY.histogram(
+    'virltester_device_login_seconds',
+    'Time to log in to a device by transport.')
+COMMAND_SECONDS = REGISTRY.histogram(
+    'virltester_command_seconds',
+    'Round trip time of a command sent to a device.')
+POLLS = REGISTRY.counter(
+    'virltester_poll_iterations',
+    'Polls of the VIRL API by check.')
+SPINUP_SECONDS = REGISTRY.histogram(
+    'virltester_sim_spinup_seconds',
+    'Time from launching a simulation until all its nodes are active.')
+
+
+class TextfileWriter(threading.Thread):
+    """Writes the metrics of the registry to filename every interval
+    seconds until stopped, and a last time when stopping. The file is
+    replaced atomically, so the collector never reads a partial file.
+    Write errors are logged, the run goes on."""
+
+    def __init__(self, filename, interval=INTERVAL, registry=REGISTRY,
+                 logger=None):
+        super(TextfileWriter, self).__init__(name='metrics')
+        self.daemon = True
+        self._filename = filename
+        self._interval = interval
+        self._registry = registry
+        self._logger = logger or logging.getLogger()
+        self._done = threading.Event()
+
+    def write(self):
+        "Write the metrics now, returns False on failure."
+        tmp = '%s.%d.tmp' % (self._filename, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                fh.write(self._registry.render())
+            os.replace(tmp, self._filename)
+        except (IOError, OSError) as e:
+            self._logger.error('metrics: %s', e)
+            return False
+        return True
+
+    def run(self):
+        while not self._done.wait(self._interval):
+            self.write()
+
+    def stop(self):
+        "Stop writing, the final metrics are written before returning."
+        self._done.set()
+        if self.is_alive():
+            self.join()
+        self.write()
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"Reading pcap (libpcap format) capture files without external tools."
+
+import mmap
+import os
+import socket
+import struct
+from collections import Counter
+
+# global file header and per packet record header sizes
+FILE_HEADER = 24
+RECORD_HEADER = 16
+
+# magic number (usec and nsec resolution) -> struct byte order
+MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<', b'\x4d\x3c\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>', b'\xa1\xb2\x3c\x4d': '>',
+}
+
+
+def byte_order(header):
+    "Returns the byte order of the file header or None if it's no pcap."
+    return MAGIC.get(bytes(header[:4]))
+
+
+class PacketCounter(object):
+    """Counts the packets of a pcap file which is fed in chunks of any
+    size, e.g. while it is downloaded. Only the record headers are
+    kept, packet data is skipped. packets is None if the data is not
+    a pcap file (e.g. pcapng)."""
+
+    def __init__(self):
+        super(PacketCounter, self).__init__()
+        self.packets = 0
+        self._order = None
+        self._header = b''
+        self._skip = 0
+
+    def feed(self, data):
+        "Count the packets in the next chunk of the file."
+        pos, size = 0, len(data)
+        while pos < size and self.packets is not None:
+            if self._skip:
+                step = min(self._skip, size - pos)
+                self._skip -= step
+                pos += step
+                continue
+
+            want = FILE_HEADER if self._order is None else RECORD_HEADER
+            need = want - len(self._header)
+            self._header += data[pos:pos + need]
+            pos += need
+            if len(self._header) < want:
+                break
+
+            if self._order is None:
+                self._order = byte_order(self._header)
+                if self._order is None:
+                    self.packets = None
+            else:
+                self.packets += 1
+                self._skip = struct.unpack(self._order + 'I',
+                                           self._header[8:12])[0]
+            self._header = b''
+
+
+# link layer types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPES = {
+    0x0800: 'ipv4', 0x0806: 'arp', 0x86dd: 'ipv6', 0x8847: 'mpls',
+    0x88cc: 'lldp', 0x8809: 'lacp',
+}
+VLAN_TAGS = (0x8100, 0x88a8)
+
+IP_PROTOCOLS = {
+    1: 'icmp', 2: 'igmp', 6: 'tcp', 17: 'udp', 47: 'gre', 50: 'esp',
+    58: 'icmpv6', 88: 'eigrp', 89: 'ospf', 103: 'pim', 112: 'vrrp',
+}
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+
+# well known (protocol, port) -> application
+PORTS = {
+    (6, 22): 'ssh', (6, 23): 'telnet', (6, 179): 'bgp', (6, 646): 'ldp',
+    (17, 53): 'dns', (17, 67): 'dhcp', (17, 68): 'dhcp', (17, 123): 'ntp',
+    (17, 161): 'snmp', (17, 514): 'syslog', (17, 520): 'rip',
+    (17, 646): 'ldp', (17, 3784): 'bfd', (6, 53): 'dns',
+}
+
+
+class PcapReader(object):
+    """Memory mapped pcap file. Iterating yields (timestamp, offset, length)
+    of the captured packet data, which can be read from buf without
+    copying the file. Raises ValueError if the file is no pcap file."""
+
+    def __init__(self, filename):
+        super(PcapReader, self).__init__()
+        self._fh = open(filename, 'rb')
+        self.buf = None
+        try:
+            size = os.fstat(self._fh.fileno()).st_size
+            if size < FILE_HEADER:
+                raise ValueError('%s: not a pcap file' % filename)
+            self.buf = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.order = byte_order(self.buf[:4])
+            if self.order is None:
+                raise ValueError('%s: not a pcap file' % filename)
+            self.nsec = self.buf[:4] in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+            self.linktype = struct.unpack_from(self.order + 'I', self.buf, 20)[0]
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Unmap and close the file."
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        self._fh.close()
+
+    def __iter__(self):
+        record = struct.Struct(self.order + 'IIII')
+        scale = 1e-9 if self.nsec else 1e-6
+        pos, size = FILE_HEADER, len(self.buf)
+        while pos + RECORD_HEADER <= size:
+            sec, frac, caplen, _ = record.unpack_from(self.buf, pos)
+            pos += RECORD_HEADER
+            # a truncated last packet is ignored
+            if pos + caplen > size:
+                break
+            yield sec + frac * scale, pos, caplen
+            pos += caplen
+
+
+def _llc(buf, pos, end):
+    "Name of the 802.3 LLC payload at pos."
+    if pos + 3 > end:
+        return 'llc'
+    if buf[pos] == 0x42:
+        return 'stp'
+    if buf[pos] == 0xaa and pos + 8 <= end:
+        if struct.unpack_from('!H', buf, pos + 6)[0] == 0x2000:
+            return 'cdp'
+    return 'llc'
+
+
+def _transport(buf, proto, pos, end, names):
+    "Add the transport and application protocol at pos to names."
+    name = IP_PROTOCOLS.get(proto)
+    if name is None:
+        names.append('ip-%d' % proto)
+        return
+    names.append(name)
+    if proto in (6, 17) and pos + 4 <= end:
+        sport, dport = struct.unpack_from('!HH', buf, pos)
+        app = PORTS.get((proto, dport), PORTS.get((proto, sport)))
+        if app is not None:
+            names.append(app)
+
+
+def _ipv4(buf, pos, end, names):
+    "Parse the IPv4 packet at pos, returns source and destination."
+    if pos + 20 > end:
+        return None, None
+    ihl = (buf[pos] & 0x0f) * 4
+    proto = buf[pos + 9]
+    src = socket.inet_ntop(socket.AF_INET, buf[pos + 12:pos + 16])
+    dst = socket.inet_ntop(socket.AF_INET, buf[pos + 16:pos + 20])
+    # only the first fragment has the transport header
+    if struct.unpack_from('!H', buf, pos + 6)[0] & 0x1fff == 0:
+        _transport(buf, proto, pos + ihl, end, names)
+    return src, dst
+
+
+def _ipv6(buf, pos, end, names):
+    "Parse the IPv6 packet at pos, returns source and destination."
+    if pos + 40 > end:
+        return None, None
+    proto = buf[pos + 6]
+    src = socket.inet_ntop(socket.AF_INET6, buf[pos + 8:pos + 24])
+    dst = socket.inet_ntop(socket.AF_INET6, buf[pos + 24:pos + 40])
+    pos += 40
+    while proto in IPV6_EXTENSIONS and pos + 8 <= end:
+        proto, length = buf[pos], (buf[pos + 1] + 1) * 8
+        pos += length
+    if proto == IPV6_FRAGMENT and pos + 8 <= end:
+        if struct.unpack_from('!H', buf, pos + 2)[0] & 0xfff8:
+            return src, dst
+        proto = buf[pos]
+        pos += 8
+    _transport(buf, proto, pos, end, names)
+    return src, dst
+
+
+def classify(buf, linktype, pos, length):
+    """Returns the protocol names (outermost first), source and destination
+    IP address (or None) of the packet at pos in buf."""
+    end = pos + length
+    names = list()
+    ethertype = None
+
+    if linktype == LINKTYPE_ETHERNET and pos + 14 <= end:
+        ethertype = struct.unpack_from('!H', buf, pos + 12)[0]
+        pos += 14
+        while ethertype in VLAN_TAGS and pos + 4 <= end:
+            names.append('vlan')
+            ethertype = struct.unpack_from('!H', buf, pos + 2)[0]
+            pos += 4
+        if ethertype <= 1500:
+            names.append(_llc(buf, pos, end))
+            return names, None, None
+    elif linktype == LINKTYPE_LINUX_SLL and pos + 16 <= end:
+        ethertype = struct.unpack_from('!H', buf, pos + 14)[0]
+        pos += 16
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6) and pos < end:
+        ethertype = {4: 0x0800, 6: 0x86dd}.get(buf[pos] >> 4)
+
+    name = ETHERTYPES.get(ethertype)
+    if name is not None:
+        names.append(name)
+    if ethertype == 0x0800:
+        src, dst = _ipv4(buf, pos, end, names)
+    elif ethertype == 0x86dd:
+        src, dst = _ipv6(buf, pos, end, names)
+    else:
+        src, dst = None, None
+    return names, src, dst
+
+
+class PcapSummary(object):
+    """Packet, byte, protocol and host counts of a capture file. A packet
+    counts once for each protocol it contains (e.g. ipv4, tcp, bgp) and
+    once for its source and destination address."""
+
+    def __init__(self):
+        super(PcapSummary, self).__init__()
+        self.packets = 0
+        self.bytes = 0
+        self.protocols = Counter()
+        self.hosts = Counter()
+        self.first = None
+        self.last = None
+
+    def add(self, timestamp, length, names, src, dst):
+        "Account for one packet."
+        self.packets += 1
+        self.bytes += length
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.protocols.update(set(names))
+        self.hosts.update(set(a for a in (src, dst) if a is not None))
+
+    def asdict(self):
+        "The summary as a dict."
+        return dict(packets=self.packets, bytes=self.bytes,
+                    protocols=dict(self.protocols), hosts=dict(self.hosts))
+
+
+def summarize(filename):
+    "Read the pcap file once and return its PcapSummary."
+    summary = PcapSummary()
+    with PcapReader(filename) as pcap:
+        for timestamp, pos, length in pcap:
+            names, src, dst = classify(pcap.buf, pcap.linktype, pos, length)
+            summary.add(timestamp, length, names, src, dst)
+    return summary
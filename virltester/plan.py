@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""The plan that is run: the sims, nodes and actions of a compiled
+command file as compact objects. Every action and sim carries a Result
+with its status, timings and outputs, so results are read from the plan
+once it has been run."""
+
+from contextlib import contextmanager
+from time import time
+
+from .trace import span
+
+# result states
+PENDING = 'pending'
+RUNNING = 'running'
+PASSED = 'passed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def _asdict(value):
+    return value.asdict() if hasattr(value, 'asdict') else value
+
+
+class Result(object):
+    """Status, timings and outputs of an action or sim. matches, missing and
+    failed are the matching, missing and failing output regexes of a
+    command (the passed and failed checks of a capture), capture the
+    download info and analysis the summary of a capture."""
+
+    __slots__ = ('status', 'started', 'finished', 'attempts', 'matches',
+                 'missing', 'failed', 'capture', 'analysis')
+
+    def __init__(self):
+        self.status = PENDING
+        self.started = None
+        self.finished = None
+        self.attempts = 0
+        self.matches = None
+        self.missing = None
+        self.failed = None
+        self.capture = None
+        self.analysis = None
+
+    @property
+    def ok(self):
+        "True if it has passed."
+        return self.status == PASSED
+
+    @property
+    def seconds(self):
+        "Run time in seconds, None if it has not finished."
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def start(self):
+        "Mark it as running, counts the attempts."
+        if self.started is None:
+            self.started = time()
+        self.attempts += 1
+        self.status = RUNNING
+
+    def finish(self, ok):
+        "Mark it as passed or failed."
+        self.finished = time()
+        self.status = PASSED if ok else FAILED
+
+    def skip(self):
+        "Mark it as skipped."
+        self.status = SKIPPED
+
+    def asdict(self):
+        "The result as a dict (without unset outputs)."
+        result = dict(status=self.status, started=self.started,
+                      finished=self.finished, seconds=self.seconds,
+                      attempts=self.attempts)
+        for name in ('matches', 'missing', 'capture', 'analysis'):
+            value = getattr(self, name)
+            if isinstance(value, list):
+                value = [_asdict(v) for v in value]
+            if value is not None:
+                result[name] = value
+        if self.failed is not None:
+            result['failed'] = _asdict(self.failed)
+        return result
+
+
+class Action(object):
+    """A command, converge or filter action of a node. Optional settings
+    have their defaults applied, persistent is None if the sim default
+    applies. depends_on is the list of action ids the action waits for
+    (None if not given), after the resolved (action, required) pairs.
+    assertion is the compiled OutputAssertion (command) or
+    CaptureAssertion (filter), built by the runner on first use."""
+
+    __slots__ = ('seq', 'id', 'depends_on', 'after', 'type', 'node',
+                 'background', 'sleep', 'wait', 'log',
+                 'transport', 'commands', 'out', 'logic', 'scope', 'fail',
+                 'stream', 'username', 'password', 'persistent', 'intfc',
+                 'bpf', 'count', 'expect_packets', 'expect_min',
+                 'expect_protocols', 'expect_hosts', 'assertion', 'result')
+
+    def __init__(self, seq, node, entry):
+        self.seq = seq
+        self.id = entry.get('id')
+        if self.id is not None:
+            self.id = str(self.id)
+        self.depends_on = entry.get('depends_on')
+        if self.depends_on is not None:
+            if not isinstance(self.depends_on, list):
+                self.depends_on = [self.depends_on]
+            self.depends_on = [str(d) for d in self.depends_on]
+        self.after = ()
+        self.type = entry.get('type', '<not set>')
+        self.node = node
+        self.background = entry.get('background', False)
+        self.sleep = entry.get('sleep', 0)
+        self.wait = entry.get('wait', None if self.type == 'filter' else 30)
+        self.log = entry.get('log', False)
+        # command and converge
+        self.transport = entry.get('transport', 'telnet')
+        self.commands = entry.get('in')
+        self.out = entry.get('out')
+        self.logic = entry.get('logic', 'one')
+        self.scope = entry.get('scope', 'last')
+        self.fail = entry.get('fail')
+        self.stream = entry.get('stream', False)
+        self.username = entry.get('username', node.username)
+        self.password = entry.get('password', node.password)
+        self.persistent = entry.get('persistent')
+        # filter
+        self.intfc = entry.get('intfc')
+        self.bpf = entry.get('bpf', '')
+        self.count = entry.get('count', 20)
+        self.expect_packets = entry.get('expect_packets')
+        self.expect_min = entry.get('expect_min')
+        self.expect_protocols = entry.get('expect_protocols')
+        self.expect_hosts = entry.get('expect_hosts')
+
+        self.assertion = None
+        self.result = Result()
+
+
+class Node(object):
+    "A node (name or IP address) of a sim with its actions."
+
+    __slots__ = ('name', 'username', 'password', 'actions')
+
+    def __init__(self, entry):
+        self.name = entry.get('name')
+        self.username = entry.get('username', 'cisco')
+        self.password = entry.get('password', 'cisco')
+        self.actions = list()
+
+
+class Gate(object):
+    """The converge gate of a sim: a converge action for each of its nodes,
+    all of them are probed at the same time. The gate passes once
+    'quorum' nodes (default all) have converged within 'timeout' seconds
+    (None is half the sim timeout). Nodes not defined in the sim get
+    the default credentials."""
+
+    __slots__ = ('actions', 'quorum', 'timeout', 'result')
+
+    def __init__(self, entry, nodes, seq):
+        known = dict((node.name, node) for node in nodes)
+        probe = dict((k, v) for k, v in entry.items()
+                     if k not in ('nodes', 'quorum', 'timeout'))
+        probe['type'] = 'converge'
+        self.actions = list()
+        for name in entry.get('nodes') or list():
+            node = known.get(name) or Node(dict(name=name))
+            seq += 1
+            self.actions.append(Action(seq, node, probe))
+        self.quorum = entry.get('quorum', len(self.actions))
+        self.timeout = entry.get('timeout')
+        self.result = Result()
+
+    @property
+    def converged(self):
+        "The actions of the nodes which have converged."
+        return [a for a in self.actions if a.result.ok]
+
+
+def build_nodes(entries, seq):
+    """Returns the Nodes of the entries with their actions numbered from
+    seq + 1 on. Nodes without a name are left out."""
+    nodes = list()
+    for node_entry in entries or list():
+        node = Node(node_entry)
+        if node.name is None:
+            continue
+        for action_entry in node_entry.get('actions') or list():
+            seq += 1
+            node.actions.append(Action(seq, node, action_entry))
+        nodes.append(node)
+    return nodes
+
+
+def order(actions, where):
+    """Resolve the dependencies of the actions. Without depends_on an
+    action runs after the previous foreground action and requires the
+    last converge action of its node to pass, a failed converge skips
+    the rest of its node only."""
+    ids = dict((a.id, a) for a in actions if a.id is not None)
+    anchor = None
+    converges = dict()
+    for action in actions:
+        if action.depends_on is not None:
+            try:
+                action.after = tuple((ids[d], True)
+                                     for d in action.depends_on)
+            except KeyError as e:
+                raise ValueError('%s: unknown action id %s' % (where, e))
+        else:
+            converge = converges.get(action.node)
+            after = list()
+            if anchor is not None:
+                after.append((anchor, anchor is converge))
+            if converge is not None and converge is not anchor:
+                after.append((converge, True))
+            action.after = tuple(after)
+        if action.type == 'converge' and not action.background:
+            converges[action.node] = action
+        if not action.background:
+            anchor = action
+
+
+class Sim(object):
+    """A sim of the command file. Settings which are None fall back to the
+    config. concurrency limits the actions running at the same time,
+    gate is the converge Gate (or None) which has to pass before the
+    actions are run. With reuse, sims of the same topology share one
+    running simulation and the reset actions are run after the sim's
+    actions if another sim uses the simulation next. virl is the
+    VIRLSim once it has been created, done is set when the sim has
+    been run and stopped. phases has the (start, end) times of the
+    launch, active, converge, actions, reset and stop phases."""
+
+    __slots__ = ('topo', 'source', 'skip', 'log', 'username', 'password',
+                 'wait', 'sessions', 'persistent', 'captures', 'native',
+                 'concurrency', 'reuse', 'nodes', 'gate', 'reset', 'virl',
+                 'done', 'result', 'phases')
+
+    def __init__(self, entry):
+        self.topo = entry['topo']
+        self.source = entry.get('_source')
+        self.skip = entry.get('skip', False)
+        self.log = entry.get('log', True)
+        self.username = entry.get('username')
+        self.password = entry.get('password')
+        self.wait = entry.get('wait')
+        self.sessions = entry.get('sessions')
+        self.persistent = entry.get('persistent')
+        self.captures = entry.get('captures')
+        self.native = entry.get('native')
+        self.concurrency = entry.get('concurrency')
+        self.reuse = entry.get('reuse')
+        self.virl = None
+        self.done = False
+        self.result = Result()
+        self.phases = dict()
+
+        # actions are numbered per sim
+        self.nodes = build_nodes(entry.get('nodes'), 0)
+        actions = list(self.actions())
+        order(actions, self.topo)
+
+        self.gate = None
+        if entry.get('converge'):
+            self.gate = Gate(entry['converge'], self.nodes, len(actions))
+        seq = len(actions) + (len(self.gate.actions) if self.gate else 0)
+
+        self.reset = [a for node in build_nodes(entry.get('reset'), seq)
+                      for a in node.actions]
+        order(self.reset, self.topo)
+
+    def actions(self):
+        "Yields all actions of the sim in order."
+        for node in self.nodes:
+            for action in node.actions:
+                yield action
+
+    @contextmanager
+    def timed(self, phase):
+        "Record the start and end time of the phase (also as a span)."
+        start = time()
+        try:
+            with span(phase, 'sim', topo=self.topo):
+                yield
+        finally:
+            self.phases[phase] = (start, time())
+
+
+class Plan(object):
+    """The compiled command file: the config dict, the sims and a flat list
+    of all actions. workdir is the directory of the command file."""
+
+    __slots__ = ('config', 'sims', 'actions', 'workdir')
+
+    def __init__(self, cmdfile, workdir=''):
+        self.config = cmdfile.get('config')
+        if self.config is None:
+            self.config = dict()
+        self.workdir = workdir
+        self.sims = [Sim(entry) for entry in cmdfile.get('sims') or list()]
+        self.actions = [a for sim in self.sims for a in sim.actions()]
+        for sim in self.sims:
+            if sim.concurrency is None:
+                sim.concurrency = self.config.get('concurrency', 0)
+            if sim.reuse is None:
+                sim.reuse = self.config.get('reuse', False)
+            if sim.skip:
+                sim.result.skip()
+                if sim.gate is not None:
+                    sim.gate.result.skip()
+                for action in list(sim.actions()) + sim.reset:
+                    action.result.skip()
+
+    def summary(self):
+        """Returns the number of actions of all sims which are not skipped
+        and how many of them passed. Actions which have not been run
+        count as not passed, a converge gate counts as one action. Reset
+        actions count if they have been run."""
+        total = passed = 0
+        for sim in self.sims:
+            if sim.skip:
+                continue
+            if sim.gate is not None:
+                total += 1
+                passed += sim.gate.result.ok
+            for action in sim.actions():
+                total += 1
+                passed += action.result.ok
+            for action in sim.reset:
+                if action.result.status not in (PENDING, SKIPPED):
+                    total += 1
+                    passed += action.result.ok
+        return total, passed
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"Polling with exponential backoff for waiting on the VIRL API."
+
+import random
+from time import sleep, time
+
+from . import metrics
+from .trace import span
+
+# first poll interval in seconds, growth factor and jitter (fraction)
+INITIAL = 1
+FACTOR = 2
+JITTER = 0.1
+
+
+class Backoff(object):
+    """Poll intervals for waiting at most 'timeout' seconds. The first
+    interval is 'initial', each following one is 'factor' times longer
+    up to 'cap'. Intervals are randomized by +/- 'jitter' and never go
+    beyond the deadline, so the last poll happens right at the end."""
+
+    def __init__(self, timeout, cap=None, initial=INITIAL, factor=FACTOR,
+                 jitter=JITTER):
+        super(Backoff, self).__init__()
+        self._deadline = time() + timeout
+        self._interval = initial
+        self._cap = max(initial, cap if cap is not None else timeout)
+        self._factor = factor
+        self._jitter = jitter
+        self.iterations = 0
+
+    def remaining(self):
+        "Seconds left until the deadline."
+        return max(0, self._deadline - time())
+
+    def expired(self):
+        "True if the deadline has passed."
+        return self.remaining() == 0
+
+    def next(self):
+        "Returns the time to sleep before the next poll."
+        self.iterations += 1
+        interval = self._interval
+        self._interval = min(self._cap, self._interval * self._factor)
+        if self._jitter:
+            interval *= random.uniform(1 - self._jitter, 1 + self._jitter)
+        return min(interval, self.remaining())
+
+
+def poll(check, backoff, *args):
+    """Calls check(*args) until it returns something other than False or
+    the backoff expires. check() returns True when done, False to
+    continue polling and None on a terminal error. Returns the last
+    result. The polls are counted by the name of check."""
+    name = getattr(check, '__name__', 'check')
+    while True:
+        metrics.REGISTRY.inc(metrics.POLLS, check=name)
+        result = check(*args)
+        if result is not False:
+            return result
+        if backoff.expired():
+            return False
+        with span('sleep', 'wait', check=name):
+            sleep(backoff.next())
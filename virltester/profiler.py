@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""cProfile for the whole run. Before Python 3.12 cProfile only sees the
+thread it was enabled in, so every thread started while profiling gets
+a profiler of its own and the statistics of all of them are merged into
+one .prof file (read it with pstats, snakeviz etc.). From 3.12 on
+cProfile sees all threads but only one profiler can be active, the one
+of the calling thread."""
+
+import cProfile
+import pstats
+import sys
+import threading
+
+# cProfile on sys.monitoring, one profiler for all threads
+SHARED = sys.version_info >= (3, 12)
+
+
+class Profiler(object):
+    """Profiles the calling thread and all threads started within the
+    with block. Leaving the block waits for the (non-daemon) threads
+    started in it, daemon threads still running are left out."""
+
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self._lock = threading.Lock()
+        self._profiles = list()
+
+    def _profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append((threading.current_thread(), profile))
+        return profile
+
+    def _thread(self, *_):
+        # installed by threading as the profile function of a new
+        # thread, hands over to a cProfile of the thread
+        sys.setprofile(None)
+        self._profile().enable()
+
+    def __enter__(self):
+        if not SHARED:
+            threading.setprofile(self._thread)
+        self._main = self._profile()
+        self._main.enable()
+        return self
+
+    def __exit__(self, *_):
+        self._main.disable()
+        if SHARED:
+            return
+        threading.setprofile(None)
+        with self._lock:
+            threads = [t for t, _ in self._profiles]
+        for thread in threads:
+            if not thread.daemon and thread is not threading.current_thread():
+                thread.join()
+
+    def dump(self, filename):
+        "Write the merged statistics of all finished threads to filename."
+        with self._lock:
+            profiles = [p for t, p in self._profiles
+                        if p is self._main or not t.is_alive()]
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(filename)
+        return stats
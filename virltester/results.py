@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Write the results of a plan which has been run as JSON lines or as
+JUnit XML: status, matched patterns and timings of every sim, converge
+gate and action, and the launch / active / converge / actions / reset /
+stop phase times of every sim."""
+
+import json
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from .plan import FAILED, PENDING, SKIPPED
+
+
+def _phases(sim):
+    return dict((phase, dict(start=start, end=end, seconds=end - start))
+                for phase, (start, end) in sim.phases.items())
+
+
+def _sim_id(sim):
+    return sim.virl.simId if sim.virl is not None else None
+
+
+def _ran(sim):
+    "The reset actions of the sim which have been run."
+    return [a for a in sim.reset
+            if a.result.status not in (PENDING, SKIPPED)]
+
+
+def action_name(action):
+    "Short description of the action."
+    what = action.intfc if action.type == 'filter' else action.commands
+    return '(%d) %s %s: %s' % (action.seq, action.type, action.node.name, what)
+
+
+def records(plan):
+    """Yields a dict for every sim, converge gate and action of the plan
+    and a summary at the end."""
+    for index, sim in enumerate(plan.sims):
+        base = dict(sim=index, topo=sim.topo, sim_id=_sim_id(sim))
+        record = dict(base, record='sim', source=sim.source,
+                      phases=_phases(sim))
+        record.update(sim.result.asdict())
+        yield record
+
+        gate = sim.gate
+        if gate is not None:
+            record = dict(base, record='gate', quorum=gate.quorum,
+                          converged=len(gate.converged), nodes=list())
+            record.update(gate.result.asdict())
+            for action in gate.actions:
+                node = dict(node=action.node.name, seq=action.seq)
+                node.update(action.result.asdict())
+                record['nodes'].append(node)
+            yield record
+
+        for reset, actions in ((False, sim.actions()), (True, _ran(sim))):
+            for action in actions:
+                record = dict(base, record='action', seq=action.seq,
+                              action_id=action.id, type=action.type,
+                              node=action.node.name, reset=reset,
+                              name=action_name(action))
+                record.update(action.result.asdict())
+                yield record
+
+    total, passed = plan.summary()
+    yield dict(record='summary', total=total, passed=passed)
+
+
+def write_json(plan, filename):
+    "Write the results as JSON lines (one record per line)."
+    with open(filename, 'w') as fh:
+        for record in records(plan):
+            fh.write(json.dumps(record, default=str))
+            fh.write('\n')
+
+
+def _seconds(result):
+    return '%.3f' % (result.seconds or 0)
+
+
+def _testcase(suite, classname, name, result, message=None, output=None):
+    "Add a testcase for the result to the suite, returns its status."
+    case = ET.SubElement(suite, 'testcase', classname=classname, name=name,
+                         time=_seconds(result))
+    if result.status == SKIPPED:
+        ET.SubElement(case, 'skipped')
+    elif not result.ok:
+        ET.SubElement(case, 'failure', message=message or result.status)
+    if output:
+        ET.SubElement(case, 'system-out').text = output
+    return result.status if result.ok or result.status == SKIPPED else FAILED
+
+
+def _output(result):
+    "The matches of the result, one per line."
+    lines = list()
+    for match in result.matches or list():
+        if hasattr(match, 'line'):
+            lines.append('%s: %s' % (match.pattern, match.line))
+        else:
+            lines.append(str(match))
+    if result.failed is not None:
+        lines.append('FAILED %s: %s' % (result.failed.pattern,
+                                        result.failed.line))
+    return '\n'.join(lines) or None
+
+
+def _message(result):
+    "The failure message of the result."
+    if result.failed is not None:
+        return 'fail pattern %s found' % result.failed.pattern
+    if result.missing:
+        return 'missing: %s' % ', '.join(str(m) for m in result.missing)
+    if result.status == PENDING:
+        return 'not run'
+    return None
+
+
+def junit(plan):
+    "Returns the results as JUnit XML ElementTree."
+    root = ET.Element('testsuites', name='virltester')
+    counts = dict(tests=0, failures=0, skipped=0)
+    for index, sim in enumerate(plan.sims):
+        name = os.path.splitext(os.path.basename(sim.topo))[0]
+        suite = ET.SubElement(root, 'testsuite', name=sim.topo, id=str(index),
+                              time=_seconds(sim.result))
+        if sim.result.started is not None:
+            suite.set('timestamp', datetime.fromtimestamp(
+                sim.result.started).isoformat(timespec='seconds'))
+        properties = ET.SubElement(suite, 'properties')
+        if _sim_id(sim) is not None:
+            ET.SubElement(properties, 'property', name='sim_id',
+                          value=_sim_id(sim))
+        for phase, (start, end) in sorted(sim.phases.items(),
+                                          key=lambda p: p[1][0]):
+            ET.SubElement(properties, 'property', name='phase.%s' % phase,
+                          value='%.3f' % (end - start))
+
+        statuses = list()
+        gate = sim.gate
+        if gate is not None:
+            lines = list()
+            for action in gate.actions:
+                if action.result.ok:
+                    lines.append('%s converged after %.3fs' % (
+                        action.node.name,
+                        action.result.finished - gate.result.started))
+                else:
+                    lines.append('%s did not converge' % action.node.name)
+            message = '%d of %d nodes converged (quorum %d)' % (
+                len(gate.converged), len(gate.actions), gate.quorum)
+            statuses.append(_testcase(suite, '%s.converge' % name,
+                                      'converge gate', gate.result,
+                                      message, '\n'.join(lines)))
+
+        for reset, actions in (('', sim.actions()), ('reset ', _ran(sim))):
+            for action in actions:
+                statuses.append(_testcase(
+                    suite, '%s.%s' % (name, action.node.name),
+                    reset + action_name(action), action.result,
+                    _message(action.result), _output(action.result)))
+
+        suite.set('tests', str(len(statuses)))
+        suite.set('failures', str(statuses.count(FAILED)))
+        suite.set('skipped', str(statuses.count(SKIPPED)))
+        suite.set('errors', '0')
+        counts['tests'] += len(statuses)
+        counts['failures'] += statuses.count(FAILED)
+        counts['skipped'] += statuses.count(SKIPPED)
+    for key, value in counts.items():
+        root.set(key, str(value))
+    return ET.ElementTree(root)
+
+
+def write_junit(plan, filename):
+    "Write the results as JUnit XML."
+    junit(plan).write(filename, encoding='utf-8', xml_declaration=True)
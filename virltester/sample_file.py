@@ -7,14 +7,24 @@ config:
   # the VIRL host (using Jinja2 templating)
   host: {{ env["VIRL_HOST"] or "123.45.67.89" }}
   # username and password
-  user: {{ env["VIRL_USER"] or "guest" }}
+  username: {{ env["VIRL_USER"] or "guest" }}
   password: {{ env["VIRL_PASS"] or "guest" }}
   # loglevel (0-4, 4=Debug)
   loglevel: 2
   # max parallel simulations
   parallel: 4
+  # minimum seconds between two sim launches
+  stagger: 0
   # default wait time (spinup / actions)
   wait: 300
+  # concurrent SSH sessions to the mgmt LXC per simulation
+  sessions: 4
+  # keep device logins open for subsequent actions
+  persistent: yes
+  # directory for packet captures (default: current directory)
+  #captures: pcaps
+  # reach nodes via channels forwarded by the mgmt LXC (default yes)
+  native: yes
 
 
 sims:
@@ -44,6 +54,11 @@ sims:
       bpf: icmp
       # mandatory interface
       intfc: Ethernet1/1
+      # check the captured packets (optional), counts are a number
+      # or an operator and a number like '>=5'
+      expect_min: 10
+      expect_protocols:
+        icmp: '>=10'
   
   - name: nx-osv9000-2
     actions:
@@ -59,7 +74,7 @@ sims:
       # mandatory interface
       intfc: Ethernet1/1
   
-  - name nx-osv9000-1
+  - name: nx-osv9000-1
     actions:
     - type: command
       background: yes
@@ -81,6 +96,11 @@ sims:
       wait: 5
       in: ping 10.0.0.5 count 50
       out: 0.00% packet loss
+    - type: command
+      # telnet (default) or ssh from the mgmt LXC, or the serial console
+      transport: console
+      in: show interface brief
+      out: Eth1/1
 '''
 
 
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Slot and launch rate bookkeeping for running simulations in parallel
+and the dependency ordering of the actions of a sim."""
+
+from collections import defaultdict, deque
+from threading import Condition, Lock
+from time import time
+
+from .plan import PASSED, PENDING, SKIPPED
+
+
+class SimSlots(object):
+    """Admits at most 'parallel' sims at a time. A waiting caller is
+    woken up the moment a running sim releases its slot."""
+
+    def __init__(self, parallel=1):
+        super(SimSlots, self).__init__()
+        self._parallel = max(1, int(parallel))
+        self._active = 0
+        self._cond = Condition()
+
+    @property
+    def active(self):
+        "Number of sims currently holding a slot."
+        return self._active
+
+    def acquire(self):
+        "Wait for a free slot and take it."
+        with self._cond:
+            while self._active >= self._parallel:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        "Give the slot back, wakes up waiting callers."
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def join(self):
+        "Wait until all slots have been released."
+        with self._cond:
+            while self._active > 0:
+                self._cond.wait()
+
+
+class LaunchLimiter(object):
+    """Spaces sim launches at least 'interval' seconds apart. Each call
+    to delay() reserves the next launch time and returns how long the
+    caller has to wait for it (0 if launches are not limited)."""
+
+    def __init__(self, interval=0):
+        super(LaunchLimiter, self).__init__()
+        self._interval = max(0, interval)
+        self._next = 0
+        self._lock = Lock()
+
+    def delay(self):
+        "Reserve the next launch and return the seconds to wait for it."
+        if not self._interval:
+            return 0
+        with self._lock:
+            now = time()
+            launch = max(now, self._next)
+            self._next = launch + self._interval
+        return launch - now
+
+
+class ActionGraph(object):
+    """Orders the actions of a sim by their dependencies (Action.after).
+    ready() hands out the actions whose dependencies have finished, at
+    most 'limit' at a time (0 is no limit), done() is called when an
+    action has finished. An action is skipped instead of run if a
+    required dependency did not pass, the others only order the
+    actions. Not thread safe, the caller has to serialize the calls."""
+
+    def __init__(self, actions, limit=0):
+        super(ActionGraph, self).__init__()
+        self._limit = max(0, limit or 0)
+        self._running = 0
+        self._left = 0
+        self._waiting = dict()
+        self._dependents = defaultdict(list)
+        self._queue = deque()
+        for action in actions:
+            self._left += 1
+            self._waiting[action] = len(action.after)
+            for dep, required in action.after:
+                self._dependents[dep].append((action, required))
+            if not action.after:
+                self._queue.append(action)
+
+    @property
+    def finished(self):
+        "True if all actions have been run or skipped."
+        return self._left == 0
+
+    @property
+    def running(self):
+        "Number of actions handed out and not done yet."
+        return self._running
+
+    def ready(self):
+        """Returns the actions which can be started now. If none can
+        ever be started (a dependency cycle) the remaining actions are
+        skipped."""
+        actions = list()
+        while self._queue and (not self._limit or
+                               self._running < self._limit):
+            actions.append(self._queue.popleft())
+            self._running += 1
+        if not actions and not self._running and not self._queue and self._left:
+            skipped = [a for a, n in self._waiting.items()
+                       if n and a.result.status == PENDING]
+            for action in skipped:
+                action.result.skip()
+            self._left = 0
+        return actions
+
+    def done(self, action):
+        """The action has finished, returns the list of its dependents
+        (and their dependents) which are skipped because of it."""
+        self._running -= 1
+        skipped = list()
+        finished = [action]
+        while finished:
+            action = finished.pop()
+            self._left -= 1
+            status = action.result.status
+            for dependent, required in self._dependents.pop(action, ()):
+                if dependent.result.status == SKIPPED:
+                    continue
+                if required and status != PASSED:
+                    dependent.result.skip()
+                    skipped.append(dependent)
+                    finished.append(dependent)
+                    continue
+                self._waiting[dependent] -= 1
+                if not self._waiting[dependent]:
+                    self._queue.append(dependent)
+        return skipped
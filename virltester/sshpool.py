@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"Bounded pool of SSH sessions to the mgmt LXC of a simulation."
+
+from threading import Condition
+from time import time
+
+
+class LXCSession(object):
+    """A SSH client and its interactive shell on the mgmt LXC. The key
+    identifies the device the shell is currently logged in to (None if
+    the shell sits at the LXC prompt)."""
+
+    def __init__(self, client, interact):
+        super(LXCSession, self).__init__()
+        self.client = client
+        self.interact = interact
+        self.key = None
+
+    def close(self):
+        "Close the shell and the underlying SSH connection."
+        try:
+            self.interact.close()
+        finally:
+            self.client.close()
+
+
+class SessionPool(object):
+    """Hands out at most 'size' sessions at a time. Sessions are opened
+    on demand using the connect callable, returned sessions are kept
+    idle for the next caller. Idle sessions carrying the requested key
+    are preferred so that their state (e.g. a device login) can be
+    reused."""
+
+    def __init__(self, connect, size=1):
+        super(SessionPool, self).__init__()
+        self._connect = connect
+        self._size = max(1, int(size))
+        self._cond = Condition()
+        self._idle = list()
+        self._busy = 0
+
+    @property
+    def size(self):
+        "Maximum number of concurrently open sessions."
+        return self._size
+
+    def acquire(self, timeout, key=None, wait=None):
+        """Return an idle session or open a new one if the pool is not
+        exhausted, wait for a free slot otherwise. Preference is given
+        to an idle session with the same key, then to one without a key.
+        If neither exists but the pool is exhausted, an idle session with
+        a different key is returned and the caller has to reset it.
+        timeout is the connect timeout of a new session. Returns None if
+        no slot frees up within wait seconds (default timeout) or a new
+        session could not be opened."""
+        deadline = time() + (timeout if wait is None else wait)
+        with self._cond:
+            while not self._idle and self._busy >= self._size:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self._busy += 1
+            session = self._pick(key)
+            if session is not None:
+                return session
+        session = None
+        try:
+            session = self._connect(timeout)
+        finally:
+            if session is None:
+                self._free()
+        return session
+
+    def release(self, session):
+        "Give a healthy session back to the pool."
+        with self._cond:
+            self._busy -= 1
+            self._idle.append(session)
+            self._cond.notify()
+
+    def discard(self, session):
+        "Close a (broken) session and free its slot."
+        try:
+            if session is not None:
+                session.close()
+        finally:
+            self._free()
+
+    def close(self):
+        "Close all idle sessions."
+        with self._cond:
+            idle, self._idle = self._idle, list()
+        for session in idle:
+            session.close()
+
+    def _pick(self, key):
+        "Take the best matching idle session, called with the lock held."
+        if not self._idle:
+            return None
+        for wanted in (key, None):
+            for i, session in enumerate(self._idle):
+                if session.key == wanted:
+                    return self._idle.pop(i)
+        # there's room for a fresh session, leave the other keys cached
+        if self._busy + len(self._idle) <= self._size:
+            return None
+        return self._idle.pop(0)
+
+    def _free(self):
+        with self._cond:
+            self._busy -= 1
+            self._cond.notify()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Telnet spoken directly over a socket (or any socket like channel) with
+the expect interface of paramiko-expect's SSHClientInteraction."""
+
+import codecs
+import re
+import socket
+from time import time
+
+# telnet commands and options
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SGA = 1, 3
+
+ANSI_RE = re.compile(r'\x1b\[[0-9;?]*[a-zA-Z]')
+
+
+class TelnetInteraction(object):
+    """Telnet client on a connected channel. Like SSHClientInteraction it
+    provides send(), expect(), last_match, current_output and
+    current_output_clean. The server may echo and suppress go-ahead,
+    all other options are refused."""
+
+    def __init__(self, channel, timeout=60, newline='\r\n', buffer_size=1024,
+                 encoding='utf-8'):
+        super(TelnetInteraction, self).__init__()
+        self.channel = channel
+        self.timeout = timeout
+        self.newline = newline
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+
+        self.current_output = ''
+        self.current_output_clean = ''
+        self.current_send_string = ''
+        self.last_match = ''
+
+        # an incomplete telnet command at the end of the last read
+        self._pending = b''
+        self._decoder = codecs.getincrementaldecoder(encoding)('ignore')
+
+    def close(self):
+        "Close the channel."
+        try:
+            self.channel.close()
+        except Exception:
+            pass
+
+    def send(self, send_string, newline=None):
+        "Send the string followed by the newline."
+        self.current_send_string = send_string
+        newline = newline if newline is not None else self.newline
+        data = (send_string + newline).encode(self.encoding)
+        self.channel.sendall(data.replace(b'\xff', b'\xff\xff'))
+
+    def send_raw(self, data):
+        "Send the bytes without a newline (e.g. control characters)."
+        self.channel.sendall(data.replace(b'\xff', b'\xff\xff'))
+
+    def recv(self, timeout=None):
+        """Returns the next data received with all telnet commands removed,
+        b'' if the connection has been closed. Raises socket.timeout."""
+        self.channel.settimeout(timeout if timeout else self.timeout)
+        while True:
+            data = self.channel.recv(self.buffer_size)
+            if not data:
+                return b''
+            data = self._filter(data)
+            if data:
+                return data
+
+    def _filter(self, data):
+        "Remove and answer the telnet commands in data."
+        data = self._pending + data
+        self._pending = b''
+        out, replies = bytearray(), bytearray()
+        i = 0
+        while i < len(data):
+            if data[i] != IAC:
+                out.append(data[i])
+                i += 1
+                continue
+            cmd = data[i + 1] if i + 1 < len(data) else None
+            if cmd == IAC:
+                out.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data):
+                    self._pending = data[i:]
+                    break
+                option = data[i + 2]
+                if cmd == DO:
+                    replies += bytes((IAC, WONT, option))
+                elif cmd == WILL:
+                    reply = DO if option in (ECHO, SGA) else DONT
+                    replies += bytes((IAC, reply, option))
+                i += 3
+            elif cmd == SB:
+                end = data.find(bytes((IAC, SE)), i)
+                if end < 0:
+                    self._pending = data[i:]
+                    break
+                i = end + 2
+            elif cmd is None:
+                self._pending = data[i:]
+                break
+            else:
+                i += 2
+        if replies:
+            self.channel.sendall(bytes(replies))
+        return bytes(out)
+
+    def _match(self, re_strings):
+        "Index of the first RE matching the last line of output or None."
+        tail = '\n' + self.current_output.rsplit('\n', 1)[-1]
+        for index, re_string in enumerate(re_strings):
+            if re.match('.*\n' + re_string + '$', tail, re.DOTALL):
+                return index
+        return None
+
+    def expect(self, re_strings='', timeout=None):
+        """Wait until the last line of output matches one of the REs.
+        Returns the index of the RE or -1 if the connection was closed
+        (or nothing is expected). Raises socket.timeout."""
+        timeout = timeout if timeout else self.timeout
+        if isinstance(re_strings, str):
+            re_strings = [re_strings] if re_strings else []
+
+        self.current_output = ''
+        deadline = time() + timeout
+        found = None
+        while not re_strings or found is None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise socket.timeout('no match')
+            data = self.recv(remaining)
+            if not data:
+                break
+            output = self._decoder.decode(data).replace('\r', '')
+            self.current_output += ANSI_RE.sub('', output)
+            if re_strings:
+                found = self._match(re_strings)
+
+        # same cleanup as paramiko-expect
+        self.current_output_clean = self.current_output
+        if self.current_send_string:
+            self.current_output_clean = self.current_output_clean.replace(
+                self.current_send_string + self.newline, '')
+        self.current_send_string = ''
+
+        if found is None:
+            return -1
+        self.last_match = re_strings[found]
+        self.current_output_clean = re.sub(
+            self.last_match + '$', '', self.current_output_clean)
+        return found
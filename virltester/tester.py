@@ -9,6 +9,23 @@ Configuration is parametrized by providing
 - loglevel: 0-4 (4=DEBUG), command line overrides command file
 - parallel: how many simulation should be run in parallel?
 - wait: default wait time for simulations to start
+- sessions: how many SSH sessions to the mgmt LXC a simulation may
+    use concurrently (limits parallel command actions per simulation
+    in the LXC shell, with native they share one connection)
+- persistent: keep device logins open and reuse them for subsequent
+    command and converge actions on the same node (default no)
+- stagger: minimum time in seconds between two sim launches (default 0)
+- captures: directory for downloaded packet captures (default is the
+    current directory)
+- native: reach the nodes through channels forwarded by the mgmt LXC
+    instead of running ssh / telnet in its shell (default no)
+- engine: 'threads' (default) runs every sim and background action
+    in its own thread, 'asyncio' runs them as coroutines on one event
+    loop with a thread pool of 'workers' threads for the device
+    interaction (REST calls have a pool of their own)
+- metrics: file the metrics (REST latency, SSH connect, login and
+    command times, polls, sim spin-up) are written to every
+    'metrics_interval' seconds (default 15) for node-exporter
 
 Simulations and nodes within a simulation can be specified as lists
 to allow to fire up multiple simulations (also in parallel) and
@@ -18,6 +35,10 @@ Simulations parameters are
 - topo: the topology file to use
 - wait: the individual wait time for the sim to start
     (uses the global wait time if ommitted)
+- sessions: the individual LXC SSH session limit
+    (uses the global session limit if ommitted)
+- persistent: the individual device login reuse setting
+    (uses the global setting if ommitted)
 - nodes: a list of nodes with names and actions
 
 
@@ -28,17 +49,59 @@ A node is:
 
 Actions for a node can be
 - filter: start a packet filter with given parameters (packet count,
-    and BPF string)
+    and BPF string). The downloaded capture can be checked with
+    expect_packets (count), expect_min (minimum count),
+    expect_protocols and expect_hosts (protocol name or IP address
+    -> count). A count is a number or an operator and a number,
+    e.g. '>=5'.
 - command: executes commands on the node (via the LXC) and compares
     output against a set of regex strings. Both commands and expected
     result strings can be given in lists.
 - converge: like command. In this case it's a prerequisite before
     the remaining actions are started.
 
+The output of a command or converge action is matched using
+- out: a regex or a list of regexes
+- logic: 'one' or 'all' of the regexes have to match, a leading '!'
+    negates the result
+- scope: match against the output of the 'last' command (default),
+    of 'all' commands together or of 'each' command (then 'out' is a
+    list with a regex or list of regexes per command)
+- fail: a regex or a list of regexes which fail the action as soon as
+    one of them shows up in the output of any command
+- stream: match the output while it arrives and stop the command (and
+    skip the remaining ones) once the result is known (default no)
+
 For both actions the following common parameter can be specified
 - background: run the action as a thread in the background
 - sleep: wait specified time before actions starts in seconds
 - wait: maximum time to wait before giving up in seconds
+- id: name of the action for depends_on
+- depends_on: ids of actions which have to pass before this action
+    starts, instead of running it after the previous action
+
+Actions run as soon as their dependencies are done, at most
+'concurrency' (sim or config, default no limit) at a time per sim.
+
+A sim can have a 'converge' gate which probes all its 'nodes' at the
+same time with the given converge command ('in', 'out' etc.) before
+any action runs. The actions run once 'quorum' nodes (default all)
+have converged, all of them are skipped if that does not happen
+within 'timeout' seconds (default half of the sim wait time).
+
+With 'reuse' (sim or config, default no) sims of the same topology
+share one running simulation: it is started for the first of them,
+the others run their actions on it in turn and it is stopped after
+the last one. The 'reset' nodes and actions of a sim (same syntax as
+'nodes') are run after its actions if another sim reuses it. With
+'reuse: attach' sims are launched under a name made of the topology
+name and fingerprint and are left running unless they failed or were
+interrupted: the next run (or sim) of the same topology attaches to
+the active simulation instead of launching a new one.
+
+Command and converge actions can override 'persistent' per action.
+Their 'transport' is 'telnet' (default) or 'ssh' from the mgmt LXC to
+the node or 'console' for the serial console of the node on the host.
 """
 
 import argparse
@@ -50,13 +113,20 @@ import threading
 from logging import CRITICAL, DEBUG, ERROR, INFO, WARN
 from time import sleep
 
-import jinja2
 import netaddr
-import yaml
 
+from .assertions import CaptureAssertion, OutputAssertion
 from .command import interaction
+from .compiler import CompileError, compile_file, default_cache_dir
+from .metrics import INTERVAL as METRICS_INTERVAL, TextfileWriter
+from .pcap import summarize
+from .plan import Plan
+from .profiler import Profiler
+from .results import action_name, write_json, write_junit
 from .loghandler import ColorHandler
+from .scheduler import ActionGraph, LaunchLimiter, SimSlots
 from .sample_file import writeCommandSample
+from .trace import TRACER, span
 from .virlsim import VIRLSim
 
 # default for wait time in seconds
@@ -66,8 +136,8 @@ MAXWAIT = 300
 # 2 = WARNING
 LOGDEFAULT = 2
 
-# how long to wait for things when polling?
-BUSYWAIT = 5
+# default number of concurrent SSH sessions to the mgmt LXC per sim
+SESSIONS = 4
 
 
 def is_valid_hostname(hostname):
@@ -90,37 +160,77 @@ def str_to_ip(s):
         return None
 
 
-def initial_sleep(virl, seq, action):
+def initial_sleep(virl, action):
     "Waits for however long is defined in the action."
-    sleeptimer = action.get('sleep', 0)
-    if sleeptimer > 0:
-        virl.log(WARN, "(%d) initial sleep %ss", seq, sleeptimer)
-        sleep(sleeptimer)
-        virl.log(WARN, "(%d) initial sleep done", seq)
+    if action.sleep > 0:
+        virl.log(WARN, "(%d) initial sleep %ss", action.seq, action.sleep)
+        with span('sleep', 'wait', seq=action.seq):
+            sleep(action.sleep)
+        virl.log(WARN, "(%d) initial sleep done", action.seq)
+
+
+def capture_assertion(virl, action):
+    """Returns the CaptureAssertion of the filter action (built once),
+    None if the expectations are invalid."""
+    if action.assertion is None:
+        try:
+            action.assertion = CaptureAssertion(
+                action.expect_packets, action.expect_min,
+                action.expect_protocols, action.expect_hosts)
+        except (ValueError, AttributeError) as e:
+            virl.log(CRITICAL, 'capture expectation: %s', e)
+    return action.assertion
+
+
+def check_capture(virl, action):
+    """Read the downloaded capture of the action and check it against the
+    expectations. The summary is stored in the result as analysis."""
+    expect = action.assertion
+    if not expect:
+        return True
+    try:
+        summary = summarize(action.result.capture['file'])
+    except (IOError, OSError, ValueError) as e:
+        virl.log(ERROR, '(%d) capture analysis: %s', action.seq, e)
+        return False
+    action.result.analysis = summary.asdict()
+    result = expect.check(summary)
+    action.result.matches = result.matches
+    action.result.missing = result.missing
+    for text in result.matches:
+        virl.log(INFO, '(%d) capture %s', action.seq, text)
+    for text in result.missing:
+        virl.log(ERROR, '(%d) capture expected %s', action.seq, text)
+    return result.ok
+
+
+def bg_indicator(action):
+    "Log prefix of background actions."
+    return '*' if action.background else ''
 
 
 def do_capture_action(virl, name, action):
     "Starts a PCAP as defined in the action."
-    intfc = action['intfc']
-    count = action.get('count', 20)
-    bpf = action.get('bpf', '')
-    wait = action.get('wait', None)
-
-    # this stuff probably should all go into an Action class
-    seq = action['_seq']
-    bg = action.get('background', False)
-    bg_indicator = '*' if bg else ''
-    virl.log(WARN, '(%s%d) filter: %s %s', bg_indicator, seq, name, intfc)
-
-    initial_sleep(virl, seq, action)
-    capId = virl.createCapture(name, intfc, bpf, count)
+    result = action.result
+    result.start()
+    virl.log(WARN, '(%s%d) filter: %s %s', bg_indicator(action),
+             action.seq, name, action.intfc)
+
     ok = False
-    if capId is not None and virl.waitForCapture(capId, wait):
-        ok = virl.downloadCapture(capId)
+    if capture_assertion(virl, action) is None:
+        result.finish(ok)
+        return
+
+    initial_sleep(virl, action)
+    capId = virl.createCapture(name, action.intfc, action.bpf, action.count)
+    if capId is not None and virl.waitForCapture(capId, action.wait):
+        result.capture = virl.downloadCapture(capId)
+        ok = (result.capture is not None and
+              check_capture(virl, action))
         virl.deleteCapture(capId)
     level = WARN if ok else ERROR
-    virl.log(level, "(%d) capture succeeded: %s", action['_seq'], ok)
-    action['success'] = ok
+    virl.log(level, "(%d) capture succeeded: %s", action.seq, ok)
+    result.finish(ok)
 
 
 def do_converge_action(virl, name, action, log_output):
@@ -134,38 +244,42 @@ def do_converge_action(virl, name, action, log_output):
     - ...
     only after
     """
-    waited = 0
+    backoff = virl.backoff(virl.simTimeout / 2)
+    pause = True
     while True:
-        do_command_action(virl, name, action, False, converge=True)
-        if action['success'] or waited > virl.simTimeout / 2:
+        do_command_action(virl, name, action, False, converge=True,
+                          pause=pause)
+        if action.result.ok or backoff.expired():
             break
-        virl.log(INFO, "waiting to converge... %d" % waited)
-        sleep(virl.simPollInterval)
-        waited += virl.simPollInterval
-        action['sleep'] = 0
-
-
-def do_command_action(virl, name, action, log_output, converge=False):
-    "Execute the given command on the device."
-    transport = action.get('transport', 'telnet')
-    logic = action.get('logic', 'one')  # RE match: match one or all
-    in_cmd = action.get('in')
-    out_re = action.get('out')
-    wait = action.get('wait', 30)
-    username = action.get('username')
-    password = action.get('password')
-
-    # TODO: this stuff probably should all go into an Action class
+        virl.log(INFO, "waiting to converge... %ds left" % backoff.remaining())
+        with span('sleep', 'wait', seq=action.seq):
+            sleep(backoff.next())
+        pause = False
+
+
+def do_command_action(virl, name, action, log_output, converge=False,
+                      pause=True):
+    """Execute the given command on the device. The initial sleep of
+    the action is skipped if pause is False (the caller did sleep)."""
+    result = action.result
+    result.start()
+    persistent = action.persistent
+    if persistent is None:
+        persistent = virl.simPersistent
+
     ok = False
-    seq = action['_seq']
-    bg = action.get('background', False)
-    bg_indicator = '*' if bg else ''
     label = 'converge' if converge else 'command'
-    virl.log(WARN, '(%s%d) %s: %s %s', bg_indicator, seq, label, name, in_cmd)
-    initial_sleep(virl, seq, action)
-
-    # get the IP of the mgmt LXC for SSH
-    address = virl.getMgmtIP(name)
+    virl.log(WARN, '(%s%d) %s: %s %s', bg_indicator(action), action.seq,
+             label, name, action.commands)
+    if pause:
+        initial_sleep(virl, action)
+
+    # the console is found by node name, otherwise get the IP of the
+    # node to connect to it from the mgmt LXC
+    if action.transport == 'console':
+        address = name
+    else:
+        address = virl.getMgmtIP(name)
 
     # if it is not a node: maybe an IP address?
     if address is None:
@@ -173,270 +287,427 @@ def do_command_action(virl, name, action, log_output, converge=False):
         if ip is not None:
             address = str(ip)
 
+    # compile the output REs once per action (converge reuses them)
+    if action.assertion is None:
+        try:
+            action.assertion = OutputAssertion(action.out, action.logic,
+                                               action.scope, action.fail)
+        except (ValueError, re.error) as e:
+            virl.log(CRITICAL, 'output RE: %s', e)
+
     # check if the nodename is found
     if address is None:
         virl.log(ERROR, 'Nodename not found!')
         ok = False
+    elif action.assertion is None:
+        ok = False
     else:
-        if log_output or action.get('log', False):
+        if log_output or action.log:
             logname = '-'.join((virl.simId, name))
         else:
             logname = None
-        ok = interaction(virl, logname, address, transport,
-                         username, password,
-                         in_cmd, out_re, logic, wait)
+        ok = interaction(virl, logname, address, action.transport,
+                         action.username, action.password,
+                         action.commands, action.assertion, action.logic,
+                         action.wait, persistent=persistent,
+                         stream=action.stream)
+        if ok is not False:
+            result.matches = ok.matches
+            result.missing = ok.missing
+            result.failed = ok.failed
+            ok = ok.ok
     if not converge:
         level = WARN if ok else ERROR
         label = 'SUCCEEDED' if ok else 'FAILED'
     else:
         level = WARN
         label = 'CONVERGED' if ok else 'WAITING'
-    virl.log(level, "(%d) command %s", action['_seq'], label)
-    action['success'] = ok
+    virl.log(level, "(%d) command %s", action.seq, label)
+    result.finish(ok)
+
+
+def do_action(virl, sim, action):
+    "Execute the given action on its node."
+    nodename = action.node.name
+
+    with span(action_name(action), 'action', sim=virl.simId):
+        if action.type == 'filter':
+            do_capture_action(virl, nodename, action)
+        elif action.type == 'command':
+            do_command_action(virl, nodename, action, sim.log)
+        elif action.type == 'converge':
+            do_converge_action(virl, nodename, action, sim.log)
+            if not action.result.ok:
+                virl.log(CRITICAL, 'Sim did not converge! skip dependent actions')
+        else:
+            virl.log(CRITICAL, 'unknown action %s' % action.type)
+            action.result.finish(False)
+
+
+def log_skipped(virl, action, skipped):
+    "Log the actions which are skipped because of the given action."
+    for dependent in skipped:
+        virl.log(ERROR, '(%d) skipped, (%d) did not pass',
+                 dependent.seq, action.seq)
 
 
-def do_action(func, threads, virl, name, action, *args):
-    "Execute the given action on the device (async or sync)."
-    background = action.get('background', False)
-    if background:
-        new_args = [virl, name, action] + list(args)
-        t = threading.Thread(target=func, args=new_args)
+def run_actions(virl, sim, actions=None):
+    """Run the actions of the sim (or the given ones), each in its own
+    thread as soon as the actions it depends on have finished. At most
+    'concurrency' actions of the sim run at the same time."""
+    if actions is None:
+        actions = sim.actions()
+    graph = ActionGraph(actions, sim.concurrency)
+    cond = threading.Condition()
+
+    def run(action):
+        "Run the action and hand its dependents to the graph."
+        try:
+            do_action(virl, sim, action)
+        finally:
+            with cond:
+                log_skipped(virl, action, graph.done(action))
+                cond.notify()
+
+    with cond:
+        while True:
+            for action in graph.ready():
+                t = threading.Thread(target=run, args=(action,))
+                t.daemon = True
+                t.name = virl.simId
+                t.start()
+            if graph.finished:
+                break
+            cond.wait()
+
+
+def gate_timeout(virl, gate):
+    "Seconds the nodes of the gate have to converge."
+    return gate.timeout if gate.timeout else virl.simTimeout / 2
+
+
+def gate_done(virl, sim):
+    """Log the convergence time of every node of the gate, finish its
+    result and skip all actions of the sim if it did not pass."""
+    gate = sim.gate
+    for action in gate.actions:
+        if action.result.ok:
+            virl.log(WARN, 'converge gate: %s converged after %.1fs',
+                     action.node.name,
+                     action.result.finished - gate.result.started)
+        else:
+            virl.log(ERROR, 'converge gate: %s did not converge',
+                     action.node.name)
+    converged = len(gate.converged)
+    ok = converged >= gate.quorum
+    gate.result.finish(ok)
+    virl.log(WARN if ok else CRITICAL,
+             'converge gate: %d of %d nodes converged in %.1fs (quorum %d)',
+             converged, len(gate.actions), gate.result.seconds, gate.quorum)
+    if not ok:
+        virl.log(CRITICAL, 'Sim did not converge! skip all actions')
+        for action in sim.actions():
+            action.result.skip()
+    return ok
+
+
+def run_gate(virl, sim):
+    """Probe all nodes of the converge gate of the sim at the same time,
+    each in its own thread, until the quorum has converged or the gate
+    times out. Probes still running then stop after their current
+    attempt, which is waited for (it holds a LXC session). Returns True
+    if the gate passed."""
+    gate = sim.gate
+    timeout = gate_timeout(virl, gate)
+    gate.result.start()
+    virl.log(WARN, 'converge gate: waiting %ds for %d of %d nodes',
+             timeout, gate.quorum, len(gate.actions))
+    cond = threading.Condition()
+    stop = threading.Event()
+    finished = list()
+
+    def probe(action):
+        "Run the converge command until it succeeds or the gate is done."
+        try:
+            backoff = virl.backoff(timeout)
+            pause = True
+            while not stop.is_set():
+                do_command_action(virl, action.node.name, action, False,
+                                  converge=True, pause=pause)
+                if action.result.ok or backoff.expired():
+                    break
+                pause = False
+                stop.wait(backoff.next())
+        finally:
+            with cond:
+                finished.append(action)
+                cond.notify()
+
+    threads = list()
+    for action in gate.actions:
+        t = threading.Thread(target=probe, args=(action,))
         t.daemon = True
         t.name = virl.simId
-        threads.append(t)
         t.start()
-    else:
-        func(virl, name, action, *args)
+        threads.append(t)
+
+    with cond:
+        while (len(gate.converged) < gate.quorum and
+               len(finished) < len(gate.actions)):
+            cond.wait()
+    stop.set()
+    for t in threads:
+        t.join()
+    return gate_done(virl, sim)
+
+
+def do_sims(sims):
+    """Run sims which share one simulation: the first sim starts it, the
+    others attach to it in turn and it is stopped after the last one.
+    Between two sims the reset actions of the earlier one are run. The
+    time of each phase is recorded in the sim, the launch in the first
+    and the stop in the last one. Returns True if all sims could be run."""
+    first = sims[0].virl
+    sims[0].result.start()
+    # nobody reuses the simulation after the last sim
+    for action in sims[-1].reset:
+        action.result.skip()
+
+    # an attached simulation is kept only if every sim came up and converged
+    failed = False
+    with sims[0].timed('launch'):
+        started = first.startSim()
+    for i, sim in enumerate(sims):
+        virl = sim.virl
+        last = i == len(sims) - 1
+        ok = False
+        if i:
+            sim.result.start()
+        if started:
+            if i:
+                virl.attachSim(first.simId)
+            with sim.timed('active'):
+                active = virl.waitForSimStart()
+            if active:
+                converged = True
+                if sim.gate is not None:
+                    with sim.timed('converge'):
+                        converged = run_gate(virl, sim)
+                failed = failed or not converged
+                if converged:
+                    with sim.timed('actions'):
+                        run_actions(virl, sim)
+                if sim.reset and not last:
+                    virl.log(WARN, 'resetting for the next sim')
+                    with sim.timed('reset'):
+                        run_actions(virl, sim, sim.reset)
+                ok = True
+            if i:
+                virl.closeSessions()
+        if not ok:
+            virl.log(CRITICAL, 'simulation %s failed' % virl.simId)
+            failed = True
+        if not last:
+            sim.result.finish(ok)
+    if started:
+        with sims[-1].timed('stop'):
+            first.stopSim(wait=True, failed=failed)
+    sims[-1].result.finish(ok)
+    return all(sim.result.ok for sim in sims)
 
 
 def do_sim(virl, sim):
     "start the sim, wait for it to come up, execute actions on it, stop it."
-    ok = False
-    threads = list()
-    n = 0
-
-    if virl.startSim():
-        if virl.waitForSimStart():
-            for node in sim.get('nodes', list()):
-
-                nodename = node.get('name')
-                if nodename is None:
-                    virl.log(CRITICAL, 'No nodename configured!')
-                    continue
-
-                username = node.get('username', 'cisco')
-                password = node.get('password', 'cisco')
-
-                for action in node.get('actions', list()):
-
-                    n += 1
-                    action_type = action.get('type', '<not set>')
-                    action['_seq'] = n
-
-                    # adding the node's u/p to the action so that
-                    # it can be passed to the function of the action
-                    action['username'] = username
-                    action['password'] = password
-
-                    if action_type == 'filter':
-                        do_action(do_capture_action, threads, virl,
-                                  nodename, action)
-                        continue
-
-                    if action_type == 'command':
-                        log_output = sim.get('log', True)
-                        do_action(do_command_action, threads, virl,
-                                  nodename, action, log_output)
-                        continue
-
-                    if action_type == 'converge':
-                        log_output = sim.get('log', True)
-                        do_action(do_converge_action, threads, virl,
-                                  nodename, action, log_output)
-                        if not action['success']:
-                            virl.log(
-                                CRITICAL, 'Sim did not converge! break action list')
-                            break
-                        continue
-
-                    virl.log(CRITICAL, 'unknown action %s' % action_type)
-            # wait for all action threads to stop
-            if threads:
-                virl.log(WARN, 'waiting for background actions to finish')
-                for thread in threads:
-                    thread.join()
-            ok = True
-        virl.stopSim(wait=True)
-    if not ok:
-        virl.log(CRITICAL, 'simulation %s failed' % virl.simId)
-    return ok
+    sim.virl = virl
+    return do_sims([sim])
+
+
+def make_sim(plan, sim, logger):
+    "Create the VIRLSim object for the given sim of the plan."
+    cfg = plan.config
+
+    def setting(value, key, default):
+        "The sim's value, the config value or the default."
+        return value if value is not None else cfg.get(key, default)
+
+    # .virl files are relative to command file
+    # prepend path of command file
+    topo = os.path.join(plan.workdir, sim.topo)
+    # captures go into the 'captures' directory (relative to the
+    # command file) if configured
+    capdir = setting(sim.captures, 'captures', None)
+    if capdir is not None:
+        capdir = os.path.join(plan.workdir, capdir)
+        os.makedirs(capdir, exist_ok=True)
+
+    virl = VIRLSim(cfg.get('host', 'virl'),
+                   setting(sim.username, 'username', 'guest'),
+                   setting(sim.password, 'password', 'guest'),
+                   topo, logger,
+                   timeout=setting(sim.wait, 'wait', MAXWAIT),
+                   port=cfg.get('port', 19399),
+                   sessions=setting(sim.sessions, 'sessions', SESSIONS),
+                   persistent=setting(sim.persistent, 'persistent', False),
+                   capdir=capdir,
+                   native=setting(sim.native, 'native', False),
+                   attach=sim.reuse == 'attach')
+
+    # for testing purposes
+    #virl._sim_id = 'csr1kv-single-test-Uw32MT'
+    #virl._no_start = True
+
+    return virl
+
+
+def sim_groups(plan, logger):
+    """Create the VIRLSim of every sim which is not skipped and return the
+    sims grouped by the simulation they run on. Sims with reuse share
+    one simulation if their topology fingerprint and user are the same
+    (the group runs where its first sim is), all others run alone."""
+    groups, shared = list(), dict()
+    for sim in plan.sims:
+        if sim.skip:
+            logger.warning('skipping sim %s', sim.topo)
+            continue
+
+        sim.virl = make_sim(plan, sim, logger)
+        key = (sim.virl.simUser, sim.virl.simFingerprint)
+        if sim.reuse and key[1] is not None:
+            if key in shared:
+                logger.info('sim %s reuses the simulation of %s', sim.topo,
+                            shared[key][0].topo)
+                shared[key].append(sim)
+                continue
+            shared[key] = [sim]
+            groups.append(shared[key])
+        else:
+            groups.append([sim])
+    return groups
+
+
+def group_failed(group, logger):
+    """Log the exception which ended the run of the group and fail its
+    sims which have not finished. They are not flagged as done, so the
+    started simulation is stopped at the end."""
+    logger.exception('sim %s failed', group[0].topo)
+    for sim in group:
+        if sim.result.finished is None and not sim.skip:
+            sim.result.finish(False)
+
 
+def run_sims_threaded(plan, sims, logger):
+    """Run all defined sims, each group of sims sharing a simulation in
+    its own thread. The first sim of every group is appended to sims,
+    the done flags are set once the group has been run. The next group
+    is started as soon as a running one frees its slot, launches are
+    spaced by the 'stagger' config value (seconds)."""
 
-def do_all_sims(cmdfile, logger=None):
-    "Go through all defined sims."
+    cfg = plan.config
+    slots = SimSlots(cfg.get('parallel'))
+    limiter = LaunchLimiter(cfg.get('stagger', 0))
+
+    def run_group(group):
+        "Run the sims, flag them as done and free the slot."
+        try:
+            do_sims(group)
+            for sim in group:
+                sim.done = True
+        except Exception:
+            group_failed(group, logger)
+        finally:
+            slots.release()
+
+    for group in sim_groups(plan, logger):
+        # wait for a free slot and our turn to launch
+        with span('sim slot', 'wait'):
+            slots.acquire()
+        with span('stagger', 'wait'):
+            sleep(limiter.delay())
+
+        logger.warning('new thread %s', group[0].topo)
+        t = threading.Thread(target=run_group, args=(group,))
+        t.daemon = True
+        sims.append(group[0])
+        t.start()
+
+    # wait for all sims to finish
+    logger.warning('waiting for background sims to end')
+    slots.join()
+
+
+def do_all_sims(plan, logger=None):
+    """Go through all defined sims of the plan (a Plan or the dict of a
+    compiled command file). The results are kept in the plan. The
+    execution engine is selected by the 'engine' config key: 'threads'
+    (default) or 'asyncio'."""
 
     # do we have a logger? If not, get the root logger
     if logger is None:
         logger = logging.getLogger()
 
-    cfg = cmdfile['config']
-    cfg_wait = cfg.get('wait', MAXWAIT)
-
-    # store threads and sims in this list
-    sims = list()
-
-    def active_sims():
-        "Check whether the sim is alive."
-        active = 0
-        for sim in sims:
-            if sim['thread'].isAlive():
-                active += 1
-        return active
+    if not isinstance(plan, Plan):
+        plan = Plan(plan, plan.get('_workdir', ''))
+    cfg = plan.config
 
     # if undefined make it one
     if cfg.get('parallel') is None:
         cfg['parallel'] = 1
 
+    engine = cfg.get('engine', 'threads')
+    if engine == 'asyncio':
+        from .aioengine import run_sims_async as run_sims
+    elif engine == 'threads':
+        run_sims = run_sims_threaded
+    else:
+        logger.critical('unknown engine %s', engine)
+        return False
+
+    # write the metrics periodically while the sims run
+    writer = None
+    if cfg.get('metrics'):
+        writer = TextfileWriter(cfg['metrics'],
+                                cfg.get('metrics_interval', METRICS_INTERVAL),
+                                logger=logger)
+        writer.start()
+
+    # started sims are stored in this list
+    sims = list()
+
     # start all sims
     try:
-        for sim in cmdfile['sims']:
-            if sim.get('skip', False):
-                logger.warning('skipping sim %s', sim['topo'])
-                continue
-
-            # .virl files are relative to command file
-            # prepend path of command file
-            workdir = cmdfile.get('_workdir', '')
-            topo = os.path.join(workdir, sim['topo'])
-            wait = sim.get('wait', cfg_wait)
-            virl = VIRLSim(cfg.get('host', 'virl'),
-                           sim.get('username', cfg.get('username', 'guest')),
-                           sim.get('password', cfg.get('password', 'guest')),
-                           topo, logger, timeout=wait,
-                           port=cfg.get('port', 19399))
-
-            # for testing purposes
-            #virl._sim_id = 'csr1kv-single-test-Uw32MT'
-            #virl._no_start = True
-
-            logger.warning('new thread %s', sim['topo'])
-            t = threading.Thread(target=do_sim, args=(virl, sim))
-            t.daemon = True
-            t.start()
-            sims.append(dict(thread=t, virl=virl))
-            if active_sims() == cfg.get('parallel'):
-                busy = True
-                while busy:
-                    if active_sims() < cfg.get('parallel'):
-                        busy = False
-                        break
-                    sleep(BUSYWAIT)
-            # need to wait a bit to stagger sim starts
-            sleep(BUSYWAIT)
-
-        # wait for all sims to finish
-        busy = active_sims() > 0
-        logger.warning('waiting for background sims to end')
-        while busy:
-            sleep(BUSYWAIT)
-            current = active_sims()
-            logger.debug('waiting for %d sim(s) to end', current)
-            busy = active_sims() > 0
+        run_sims(plan, sims, logger)
     except KeyboardInterrupt:
         pass
     finally:
-        # make sure to stop all started sims which are still active
+        # make sure to stop all started sims which are still active,
+        # an interrupted sim is not kept for reuse
         for sim in sims:
-            if sim['thread'].isAlive() and sim['virl'].simId is not None:
-                sim['virl'].stopSim()
+            if not sim.done and sim.virl.simId is not None:
+                sim.virl.stopSim(failed=True)
+        if writer is not None:
+            writer.stop()
 
-    total = success = 0
-    for sim in cmdfile['sims']:
-        if sim.get('skip', False):
-            continue
-        for node in sim.get('nodes', list()):
-            for action in node.get('actions'):
-                total += 1
-                if action.get('success', False):
-                    success += 1
+    total, success = plan.summary()
     logger.warning('%d out of %d succeeded', success, total)
 
     return total == success
 
 
-def load_cfg(fh, lvl=0):
-    """Load the YAML formatted configuration file specified by fh.
-    Recursively include additional command files if the include
-    key exist (list of files)
+def load_cfg(fh, cache_dir=None):
+    """Load the YAML formatted command file specified by fh (a file name
+    or an open file). Additional command files listed in the includes
+    key are loaded relative to the including file:
 
     includes:
     - command1.yml
     - command2.yml
 
-    the 'includes' key is removed after recursive loading is done
-    """
-    if lvl > 10:
-        raise yaml.scanner.ScannerError('recursion too deep')
-
-    def use_template(fh):
-        "Read via Jinja to do the templating."
-        data = jinja2.Template(fh.read()).render(env=os.environ)
-        return yaml.load(data)
-
-    """"this works around a Python3 vs Python2 issue.
-    A file handle is of type io.TextIOWrapper in Py3 and of
-    type file in Py2.
-    Sequence of testing is important :) if fh is a file then
-    - in py2 it is False or True --> it is a file!
-    - in py3 it is True or (not evaluated but it would cause an
-      exception) --> it is a file
-
-    Update: Well, if this is an included file then the var will
-    be of type string and in Py3 it will check against 'file'
-    which still causes an exception. Ah, crap.
+    their sims are appended to the sims of the including file and the
+    'includes' key is removed. Compiled files are cached in cache_dir
+    (if given). Raises CompileError.
     """
-
-    # if isinstance(fh, TextIOWrapper) or isinstance(fh, file):
-    # this misses unicode strings in python2
-    if not isinstance(fh, str):
-        data = use_template(fh)
-    else:
-        with open(fh, 'r') as f:
-            data = use_template(f)
-    if data is None:
-        data = dict()
-    if data.get('sims') is None:
-        data['sims'] = list()
-    for sim in data['sims']:
-        sim['topo'] = os.path.expanduser(sim['topo'])
-    includes = data.get('includes')
-    if includes is not None:
-        for include in includes:
-            curdir = os.getcwd()
-            try:
-                path = os.path.dirname(include)
-                basename = os.path.basename(include)
-                if path:
-                    os.chdir(path)
-                subdata = load_cfg(basename, lvl + 1)
-            except (IOError, OSError) as e:
-                raise yaml.scanner.ScannerError("%s/%s: %s" % (
-                    os.getcwd(), include, e.strerror))
-            else:
-                if subdata is not None:
-                    for sim in subdata['sims']:
-                        topo = sim['topo']
-                        # if we are in a subdirectory, add the path
-                        # but only if the topo name is not absolute
-                        if not os.path.isabs(topo):
-                            sim['topo'] = os.path.join(path, topo)
-                        # make a note from where this was included
-                        sim['_source'] = include
-                        # append the sims to the parent sim list
-                        data['sims'].append(sim)
-            os.chdir(curdir)
-        del data['includes']
-    return data
+    filename = fh if isinstance(fh, str) else fh.name
+    return compile_file(filename, cache_dir)
 
 
 def main():
@@ -462,6 +733,21 @@ def main():
                         help="don't use colors for logging")
     parser.add_argument('--loglevel', '-l', type=int, choices=range(0, 5),
                         help="loglevel, 0-4 (default is %d)" % LOGDEFAULT)
+    parser.add_argument('--engine', choices=('threads', 'asyncio'),
+                        help="execution engine, overrides the command file")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use or store cached command files")
+    parser.add_argument('--junit', metavar='FILE',
+                        help="write the results as JUnit XML to FILE")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON lines to FILE")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="write metrics to FILE while running, "
+                        "overrides the command file")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="run under cProfile, write the stats to FILE")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="write a Chrome trace (Perfetto) to FILE")
     args = parser.parse_args()
 
     # setup logging
@@ -484,22 +770,42 @@ def main():
         ok = writeCommandSample()
     else:
         root_logger.info('loading command file')
+        cache_dir = None if args.no_cache else default_cache_dir()
         try:
-            commands = load_cfg(args.cmdfile)
-        except (yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
-            root_logger.critical('YAML: %s', str(e).replace('\n', ''))
+            commands = load_cfg(args.cmdfile, cache_dir)
+        except CompileError as e:
+            for line in str(e).split('\n'):
+                root_logger.critical('command file: %s', line)
         else:
-            # remember working directory
-            commands['_workdir'] = os.path.dirname(args.cmdfile.name)
+            # topo paths are relative to the command file
+            plan = Plan(commands, os.path.dirname(args.cmdfile.name))
             # override command file loglevel
-            if commands.get('config') is None:
-                commands['config'] = dict()
-            loglevel = commands['config'].get('loglevel', LOGDEFAULT)
+            loglevel = plan.config.get('loglevel', LOGDEFAULT)
             if args.loglevel is not None:
                 if loglevel != args.loglevel:
                     loglevel = args.loglevel
             root_logger.setLevel(logging.CRITICAL - loglevel * 10)
-            ok = do_all_sims(commands, root_logger)
+            # override command file engine
+            if args.engine is not None:
+                plan.config['engine'] = args.engine
+            # override command file metrics
+            if args.metrics is not None:
+                plan.config['metrics'] = args.metrics
+            if args.trace:
+                TRACER.enable()
+            if args.profile:
+                with Profiler() as profiler:
+                    ok = do_all_sims(plan, root_logger)
+                profiler.dump(args.profile)
+            else:
+                ok = do_all_sims(plan, root_logger)
+            if args.trace:
+                TRACER.disable()
+                TRACER.write(args.trace)
+            if args.junit:
+                write_junit(plan, args.junit)
+            if args.json:
+                write_json(plan, args.json)
 
     # shell return value
     return 0 if ok else -1
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Spans (sim phases, actions, REST calls, device I/O, sleeps and
+waits) recorded per thread and written as Chrome trace events, which
+can be opened in Perfetto or chrome://tracing. Coroutines of the
+asyncio engine get a track per task. Recording is off unless enabled,
+a span then costs next to nothing."""
+
+import asyncio
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+
+def _task():
+    "The running asyncio task or None."
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+class Tracer(object):
+    "Records complete events ('X') with a track per thread or task."
+
+    def __init__(self):
+        super(Tracer, self).__init__()
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = list()
+        self._tracks = dict()
+        self._names = list()
+        self._origin = perf_counter()
+
+    def enable(self):
+        "Start recording, forgets earlier spans."
+        with self._lock:
+            self._events = list()
+            self._tracks = dict()
+            self._names = list()
+            self._origin = perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        "Stop recording."
+        self.enabled = False
+
+    def _track(self):
+        "The track id of the current thread or task."
+        task = _task()
+        if task is not None:
+            key, name = id(task), 'task %s' % task.get_name()
+        else:
+            thread = threading.current_thread()
+            key, name = thread.ident, thread.name
+        with self._lock:
+            track = self._tracks.get(key)
+            # thread idents are reused, a new name is a new track
+            if track is None or track[1] != name:
+                track = self._tracks[key] = (len(self._names) + 1, name)
+                self._names.append(track)
+        return track[0]
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        "Record the block as a span of category cat."
+        if not self.enabled:
+            yield
+            return
+        track = self._track()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            event = dict(name=name, cat=cat, ph='X', pid=os.getpid(),
+                         tid=track, ts=(start - self._origin) * 1e6,
+                         dur=(end - start) * 1e6)
+            if args:
+                event['args'] = args
+            with self._lock:
+                self._events.append(event)
+
+    def events(self):
+        "Returns the recorded events with the track names first."
+        with self._lock:
+            meta = [dict(name='thread_name', ph='M', pid=os.getpid(),
+                         tid=tid, args=dict(name=name))
+                    for tid, name in self._names]
+            return meta + list(self._events)
+
+    def write(self, filename):
+        "Write the trace as Chrome trace event JSON."
+        with open(filename, 'w') as fh:
+            json.dump(dict(traceEvents=self.events(),
+                           displayTimeUnit='ms'), fh, default=str)
+
+
+TRACER = Tracer()
+span = TRACER.span
@@ -1,27 +1,38 @@
 # -*- coding: utf-8 -*-
 "Defines the VIRLSim class"
 
+import hashlib
 import os
-from datetime import datetime, timedelta
-from time import sleep
+import socket
 from logging import DEBUG, INFO, WARN, ERROR, CRITICAL
-from threading import Semaphore
+from threading import Lock
 from json import dumps
+from time import sleep, time
 
 import requests
 import paramiko
 from paramiko_expect import SSHClientInteraction
-from .console import postMortem
+from . import metrics
+from .console import postMortems
+from .pcap import PacketCounter
+from .polling import Backoff, poll
+from .sshpool import LXCSession, SessionPool
+from .trace import span
 
 
 class VIRLSim(object):
     "Defines the simulation element and holds configuration information of a VIRL simulation."
 
-    # will sleep for 'timeout / INTERVAL' when waiting for sim to start
+    # polls back off to at most 'timeout / INTERVAL' when waiting for
+    # the sim to start / stop or a capture to finish
     INTERVAL = 30
 
+    # bytes read per chunk when downloading captures
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, host, user, password, filename,
-                 logger=None, timeout=300, port=19399):
+                 logger=None, timeout=300, port=19399, sessions=1,
+                 persistent=False, capdir=None, native=False, attach=False):
         super(VIRLSim, self).__init__()
         self._host = host
         self._port = port
@@ -36,9 +47,26 @@ class VIRLSim(object):
         self._lxc_port = None
         self._lxc_host = host
         self._no_start = False
-        self._semaphore = Semaphore()
-        self._ssh_client = None
-        self._ssh_interact = None
+        self._lxc_lock = Lock()
+        self._cache_lock = Lock()
+        self._interfaces = None
+        self._mgmt_ips = dict()
+        self._intfc_ids = dict()
+        self._roster_lock = Lock()
+        self._roster = None
+        self._nodes = None
+        self._ssh_pool = SessionPool(self._sshConnect, sessions)
+        self._persistent = persistent
+        self._capdir = capdir
+        self._console_locks = dict()
+        self._consoles = dict()
+        self._native = native
+        self._channel_lock = Lock()
+        self._channel_client = None
+        self._devices = dict()
+        self._fingerprint = None
+        self._attach = attach
+        self._launched = None
 
     def _url(self, method='', roster=False):
         """Return the proper URL given the set vars and the
@@ -50,9 +78,17 @@ class VIRLSim(object):
                                                 api, method)
 
     def _request(self, verb, method, *args, **kwargs):
-        url = self._url(method, roster=kwargs.pop('roster', False))
-        r = self._session.request(verb, url, *args, **kwargs)
+        roster = kwargs.pop('roster', False)
+        url = self._url(method, roster=roster)
+        # the endpoint without IDs, e.g. 'nodes' or 'roster'
+        endpoint = 'roster' if roster else method.split('/')[0]
+        with span('%s %s' % (verb, endpoint), 'rest', url=url), \
+                metrics.REGISTRY.timed(metrics.REST_SECONDS, verb=verb,
+                                       endpoint=endpoint):
+            r = self._session.request(verb, url, *args, **kwargs)
         if not r.ok:
+            metrics.REGISTRY.inc(metrics.REST_ERRORS, verb=verb,
+                                 endpoint=endpoint, code=r.status_code)
             self.log(ERROR, 'VIRL API [%s]: %s',
                      r.status_code, r.json().get('cause'))
         return r
@@ -87,6 +123,28 @@ class VIRLSim(object):
     def simId(self, value):
         self._sim_id = value
 
+    @property
+    def simFingerprint(self):
+        """The sha256 of the topology file (None if it can't be read).
+        Sims with the same fingerprint run the same topology."""
+        if self._fingerprint is None:
+            try:
+                with open(os.path.expanduser(self._filename), 'rb') as fh:
+                    self._fingerprint = hashlib.sha256(fh.read()).hexdigest()
+            except IOError as e:
+                self.log(ERROR, 'fingerprint: %s', e)
+        return self._fingerprint
+
+    @property
+    def simSession(self):
+        """The session name the sim is launched with if it may be attached
+        to later: the topology name and its fingerprint (None if the
+        topology can't be read)."""
+        if self.simFingerprint is None:
+            return None
+        sim_name = os.path.basename(os.path.splitext(self._filename)[0])
+        return '%s-%s' % (sim_name, self.simFingerprint[:12])
+
     @property
     def simHost(self):
         "Returns the name of the simulation host."
@@ -108,11 +166,25 @@ class VIRLSim(object):
         return self._timeout
 
     @property
-    def sshInteract(self):
-        "Returns a SSH object to interact with the simulation via LXC."
-        if self._ssh_interact is not None:
-            return self._ssh_interact
-        return self.sshOpen()
+    def simNative(self):
+        """Returns True if devices are reached through channels forwarded
+        by the mgmt LXC instead of its shell."""
+        return self._native
+
+    @simNative.setter
+    def simNative(self, native):
+        "Switch between forwarded channels and the LXC shell."
+        self._native = native
+
+    @property
+    def sshSessions(self):
+        "Returns the maximum number of concurrent LXC SSH sessions."
+        return self._ssh_pool.size
+
+    @property
+    def simPersistent(self):
+        "Returns True if device logins should be kept for reuse."
+        return self._persistent
 
     @property
     def simPollInterval(self):
@@ -122,13 +194,12 @@ class VIRLSim(object):
             interval = self._timeout
         return interval
 
-    def lock(self):
-        "Lock the simulation, admit only one at a time."
-        self._semaphore.acquire()
-
-    def unlock(self):
-        "Unlocks the simulation."
-        self._semaphore.release()
+    def backoff(self, timeout=None):
+        """Returns the poll intervals for waiting timeout seconds (default
+        is the sim timeout), backing off up to the sim poll interval."""
+        if timeout is None:
+            timeout = self._timeout
+        return Backoff(timeout, cap=self.simPollInterval)
 
     def startSim(self):
         "This function will start a simulation using the provided .virl file."
@@ -139,12 +210,28 @@ class VIRLSim(object):
         if self._no_start and self._sim_id:
             return True
 
+        # a new sim has new nodes and interfaces
+        self.invalidateCache()
+        self._launched = None
+
+        # Parameter which will be passed to the server with the API call
+        params = dict(file=sim_name)
+        if self._attach:
+            session = self.simSession
+            status = self.findSim(session) if session else None
+            if status == 'ACTIVE':
+                self.attachSim(session)
+                return True
+            if status is None and session:
+                params['session'] = session
+            elif status is not None:
+                self.log(WARN, 'Simulation %s is %s, launching a new one',
+                         session, status)
+
         # Open .virl file and assign it to the variable
         ok = False
         try:
             with open(os.path.expanduser(self._filename), 'rb') as virl_file:
-                # Parameter which will be passed to the server with the API call
-                params = dict(file=sim_name)
 
                 # Make an API call and assign the response information to the
                 # variable
@@ -153,45 +240,92 @@ class VIRLSim(object):
                 # Check if call was successful, if true log it and return the value
                 if r.status_code == 200:
                     self._sim_id = r.text
+                    self._launched = time()
                     self.log(WARN, 'Simulation started.')
                 ok = r.ok
+                # another run launched the session in the meantime
+                if not ok and 'session' in params:
+                    ok = self.findSim(params['session']) == 'ACTIVE'
+                    if ok:
+                        self.attachSim(params['session'])
         except IOError as e:
             self.log(CRITICAL, 'open file: %s', e)
         return ok
 
+    def listSims(self):
+        """Returns the sims of the user on the host keyed by sim ID or None
+        if the API call failed."""
+        r = self._get('list')
+        if not r.ok:
+            return None
+        return r.json().get('simulations', dict())
+
+    def findSim(self, sim_id):
+        """Returns the status of the sim with the given ID (e.g. 'ACTIVE')
+        or None if there is no such sim."""
+        sims = self.listSims()
+        if not sims or sim_id not in sims:
+            return None
+        return sims[sim_id].get('status')
+
+    def attachSim(self, sim_id):
+        """Use the already running simulation with the given ID instead of
+        starting one. waitForSimStart() and stopSim() work as usual."""
+        self.invalidateCache()
+        self._sim_id = sim_id
+        self.log(WARN, 'Attached to running simulation.')
+
+    def getNodes(self):
+        """Returns the state of all nodes of the sim keyed by node name
+        or None if the API call failed."""
+        r = self._get('nodes/%s' % self._sim_id)
+        if not r.ok:
+            return None
+        return r.json()[self._sim_id]
+
+    @staticmethod
+    def nodesActive(nodes):
+        "Returns True if all given nodes are active AND reachable."
+        for node in nodes.values():
+            if node['state'] == 'SHUTOFF':
+                continue
+            if not (node['state'] == 'ACTIVE' and node['reachable']):
+                return False
+        return True
+
+    def checkSimStart(self):
+        """Poll the node states once. Returns True if all nodes are active
+        and reachable, False if not (yet) and None if the API call failed
+        or a node went into the ERROR state (no point in waiting)."""
+        self._nodes = self.getNodes()
+        if self._nodes is None:
+            return None
+        failed = [name for name, node in self._nodes.items()
+                  if node['state'] == 'ERROR']
+        if failed:
+            self.log(ERROR, "node(s) in ERROR state: %s", ', '.join(failed))
+            return None
+        return self.nodesActive(self._nodes)
+
     def waitForSimStart(self):
         """Returns True if the sim is started and all nodes are active/reachable
         waits for self._timeout (default 5min)."""
+        if not self.simStartWait():
+            return self.loadInterfaces()
+        return self.simStartDone(poll(self.checkSimStart, self.backoff()))
 
-        active = False
+    def simStartWait(self):
+        """Start waiting for the sim to become active. Returns False if
+        there is nothing to poll (a sim that is not started by us)."""
         self.log(WARN, 'Waiting %ds to become active...', self._timeout)
 
         # for testing purposes
-        if self._no_start and self._sim_id:
-            return True
-
-        endtime = datetime.utcnow() + timedelta(seconds=self._timeout)
-        while not active and endtime > datetime.utcnow():
-
-            # Make an API call and assign the response information to the
-            # variable
-            r = self._get('nodes/%s' % self._sim_id)
-            if not r.ok:
-                return False
-
-            # check if all nodes are active AND reachable
-            nodes = r.json()[self._sim_id]
-            active = True
-            for node in nodes.values():
-                if node['state'] == 'SHUTOFF':
-                    continue
-                if not (node['state'] == 'ACTIVE' and node['reachable']):
-                    active = False
-                    break
+        return not (self._no_start and self._sim_id)
 
-            # wait if not
-            if not active:
-                sleep(self.simPollInterval)
+    def simStartDone(self, active):
+        """Finish waiting for the sim with the result of polling
+        checkSimStart(): load the interfaces of an active sim, write the
+        post-mortems of one that failed. Returns True if it is active."""
 
         # for testing purposes
         #active = False
@@ -199,36 +333,81 @@ class VIRLSim(object):
 
         if active:
             self.log(WARN, "Simulation is active.")
+            self.simActive()
+            self.loadInterfaces()
         else:
-            self.log(ERROR, "Timeout... aborting!")
-
-            # write status log file
-            with open("status-%s.log" % self._sim_id, "w") as fh:
-                fh.write(dumps(self.getStatus(), indent=2))
-
-            for name, node in nodes.items():
-                state = node['state']
-                reachable = node['reachable']
-                if state == 'ACTIVE' and not reachable:
-                    self.log(ERROR, "%s: %s, %s", name, state, reachable)
-
-                    subtype, serial_port = self.getNodeDetail(name)
-                    if serial_port is not None:
-                        postMortem(self, name, subtype, self._host, serial_port)
-                        self.log(ERROR, "error log written!")
-
-        return active
+            if active is False:
+                self.log(ERROR, "Timeout... aborting!")
+            self.simStartFailed()
+
+        return bool(active)
+
+    def simActive(self):
+        "Record the spin-up time once a sim launched by startSim() is active."
+        # attached sims were up already
+        if self._launched is not None:
+            metrics.REGISTRY.observe(metrics.SPINUP_SECONDS,
+                                     time() - self._launched)
+            self._launched = None
+
+    def simStartFailed(self):
+        """Writes the status of the sim and a post-mortem log of every node
+        that is active but not reachable (as of the last poll). The
+        consoles of these nodes are read concurrently."""
+        nodes = self._nodes
+        if nodes is None:
+            return
 
-    def stopSim(self, wait=False):
-        "This function will stop the simulation."
+        # write status log file
+        with open("status-%s.log" % self._sim_id, "w") as fh:
+            fh.write(dumps(self.getStatus(), indent=2))
+
+        failed = list()
+        for name, node in nodes.items():
+            state = node['state']
+            reachable = node['reachable']
+            if state == 'ACTIVE' and not reachable:
+                self.log(ERROR, "%s: %s, %s", name, state, reachable)
+
+                subtype, serial_port = self.getNodeDetail(name)
+                if serial_port:
+                    failed.append((name, subtype, serial_port))
+
+        for name, ok in postMortems(self, failed, self._host).items():
+            if ok:
+                self.log(ERROR, "%s: error log written!", name)
+            else:
+                self.log(ERROR, "%s: no console output", name)
+
+    def closeSessions(self):
+        """Close the SSH sessions, channels and consoles (if open) and
+        forget the cached sim data, the sim keeps running."""
+        self.sshClose()
+        self.channelClose()
+        self.consoleClose()
+        self.invalidateCache()
+
+    def isSimStopped(self):
+        "Returns True if the simulation has completely stopped."
+        status = self.getStatus()
+        return isinstance(status, dict) and status.get('state') == "DONE"
+
+    def stopSim(self, wait=False, failed=False):
+        """This function will stop the simulation. Returns True if the
+        stop has been initiated. A sim which can be attached to is left
+        running for the next run unless it failed (or was interrupted)."""
         self.log(WARN, 'Simulation stop...')
 
         # for debugging purposes
         if self._no_start and self._sim_id:
-            return
+            return False
 
-        # ensure SSH sessions are closed, if open
-        self.sshClose()
+        self.closeSessions()
+
+        # sims which can be attached to are kept for the next run
+        if self._attach and not failed:
+            self.log(WARN, 'Simulation left running for reuse.')
+            return False
 
         # Make an API call and assign the response information to the variable
         r = self._get('stop/%s' % self._sim_id)
@@ -238,41 +417,41 @@ class VIRLSim(object):
             self.log(INFO, 'Simulation stop initiated.')
 
             # should we wait until all nodes are stopped?
+            # only wait for so long before giving up
             if wait:
-                status = self.getStatus()
-                waited = 0
-                while not status['state'] == "DONE":
-
-                    # print(dumps(status, indent=2))
-                    seconds = self.simPollInterval
-                    self.log(INFO, 'sleeping %ds' % seconds)
-                    sleep(seconds)
-
-                    # only wait for so long before giving up
-                    waited += seconds
-                    if waited > self._timeout / 2:
-                        self.log(CRITICAL, 'Simulation did NOT stop.')
-                        break
-                    status = self.getStatus()
-
-                if status['state'] == "DONE":
+                if poll(self.isSimStopped, self.backoff(self._timeout / 2)):
                     self.log(INFO, 'Simulation finally stopped.')
+                else:
+                    self.log(CRITICAL, 'Simulation did NOT stop.')
             # we might rely on the _sim_id after stop
             # for logging purposes.
             # self._sim_id = None
+        return r.status_code == 200
 
-    def getNodeDetail(self, node):
-        """Get the node subtype and console port of the given node
+    def loadRoster(self):
+        """Fetch the roster of the host once and index the nodes of this
+        sim by (sim_id, node). Roster keys look like
         guest|csr1kv-single-test-9DYnbf|virl|csr1000v-1
-        """
-        self.log(INFO, "Getting console port for [%s]...", node)
+        Returns True if the roster has been loaded."""
+        self.log(INFO, "Getting roster...")
         r = self._get('', roster=True)
-        if r.ok:
-            for k, v in r.json().items():
-                f = k.split('|')
-                if len(f) > 1 and f[1] == self._sim_id and f[3] == node:
-                    return (v.get('NodeSubtype'), v.get('PortConsole'))
-        return ('unknown', 0)
+        if not r.ok:
+            return False
+        roster = dict()
+        for k, v in r.json().items():
+            f = k.split('|')
+            if len(f) > 3 and f[1] == self._sim_id:
+                roster[(f[1], f[3])] = (v.get('NodeSubtype'), v.get('PortConsole'))
+        self._roster = roster
+        return True
+
+    def getNodeDetail(self, node):
+        "Get the node subtype and console port of the given node."
+        self.log(INFO, "Getting console port for [%s]...", node)
+        with self._roster_lock:
+            if self._roster is None and not self.loadRoster():
+                return ('unknown', 0)
+            return self._roster.get((self._sim_id, node), ('unknown', 0))
 
     def getEvents(self):
         "Get the events associated with the sim."
@@ -290,9 +469,60 @@ class VIRLSim(object):
             return r.json()
         return '{}'
 
+    def loadInterfaces(self):
+        """Fetch the interfaces of all nodes of the sim with one API call
+        and index them by node, management IP and interface name. Lookups
+        are answered from this cache until invalidateCache() is called.
+        Returns True if the cache has been loaded."""
+        self.log(INFO, "Getting interfaces for all nodes...")
+        r = self._get('interfaces/%s' % self._sim_id)
+        if not r.ok:
+            return False
+        with self._cache_lock:
+            self._interfaces = dict()
+            self._mgmt_ips = dict()
+            self._intfc_ids = dict()
+            nodes = r.json().get(self._sim_id) or dict()
+            for node, interfaces in nodes.items():
+                self._indexInterfaces(node, interfaces)
+        return True
+
+    def _indexInterfaces(self, node, interfaces):
+        "Add the interfaces of the node to the cache (lock must be held)."
+        self._interfaces[node] = interfaces
+        if interfaces is None:
+            return
+        for key, intfc in interfaces.items():
+            if key == 'management':
+                if intfc.get('ip-address') is not None:
+                    address = intfc.get('ip-address').split('/')[0]
+                    self._mgmt_ips[node] = address
+            elif intfc.get('name') is not None:
+                self._intfc_ids[(node, intfc.get('name'))] = key
+
+    def invalidateCache(self):
+        "Forget all cached node, interface and roster data of the sim."
+        with self._cache_lock:
+            self._interfaces = None
+            self._mgmt_ips = dict()
+            self._intfc_ids = dict()
+        with self._roster_lock:
+            self._roster = None
+        self._nodes = None
+        with self._lxc_lock:
+            self._lxc_port = None
+
     def getInterfaces(self, node):
         """Return the list of interfaces for the given node or
         None if not found."""
+        with self._cache_lock:
+            if self._interfaces is not None:
+                interfaces = self._interfaces.get(node)
+                if interfaces is None:
+                    self.log(ERROR, 'node not found: %s', node)
+                return interfaces
+
+        # cache not loaded (yet), ask for this node only
         self.log(INFO, "Getting interfaces for [%s]...", node)
         params = dict(nodes=node)
         r = self._get('interfaces/%s' % self._sim_id, params=params)
@@ -305,11 +535,17 @@ class VIRLSim(object):
     def getInterfaceId(self, node, interface):
         "Get the interface index for the given interface name."
         self.log(INFO, "Getting ID from name [%s]...", interface)
-        interfaces = self.getInterfaces(node)
-        for key, intfc in interfaces.items():
-            if intfc.get('name') == interface:
-                self.log(INFO, "Found id: %s", key)
-                return key
+        with self._cache_lock:
+            cached = self._interfaces is not None
+            key = self._intfc_ids.get((node, interface))
+        if not cached:
+            for ikey, intfc in (self.getInterfaces(node) or dict()).items():
+                if intfc.get('name') == interface:
+                    key = ikey
+                    break
+        if key is not None:
+            self.log(INFO, "Found id: %s", key)
+            return key
         self.log(ERROR, "Can't find specified interface %s", interface)
         return None
 
@@ -342,68 +578,91 @@ class VIRLSim(object):
         r = self._delete('capture/%s' % self._sim_id, params=params)
         return r.ok
 
+    def isCaptureDone(self, cap_id):
+        """Returns True if the packet capture is no longer running, False
+        if it is still running and None if the API call failed."""
+        r = self._get('capture/%s' % self._sim_id)
+        if not r.ok:
+            return None
+        for cid, cval in r.json().items():
+            if cid == cap_id and not cval.get('running'):
+                return True
+        return False
+
     def waitForCapture(self, cap_id, wait=None):
         """Wait until the packet capture is done. check for the 'running'
-        state according to the set wait time divided by INTERVAL
-        divisor."""
+        state with backoff up to the set wait time divided by INTERVAL."""
 
         if wait is None:
             wait = self._timeout
 
-        done = False
         self.log(INFO, 'Waiting %ds for capture [%s]', wait, cap_id)
-
-        endtime = datetime.utcnow() + timedelta(seconds=wait)
-        while not done and endtime > datetime.utcnow():
-
-            # Make an API call and assign the response information to the
-            # variable
-            r = self._get('capture/%s' % self._sim_id)
-            if not r.ok:
-                return False
-
-            # check if all nodes are active AND reachable
-            captures = r.json()
-            for cid, cval in captures.items():
-                if cid == cap_id and not cval.get('running'):
-                    done = True
-                    break
-
-            # wait if not
-            if not done:
-                sleep(self.simPollInterval)
+        done = poll(self.isCaptureDone, self.backoff(wait), cap_id)
 
         if done:
             self.log(WARN, "Capture has finished.")
-        else:
+        elif done is False:
             self.log(ERROR, "Timeout... aborting!")
 
-        return done
+        return bool(done)
 
     def downloadCapture(self, pcap_id):
-        "Download the finished capture and write it into a file."
+        """Download the finished capture into a file in the capture
+        directory (or the current directory). The file is streamed to
+        disk in chunks. Returns a dict with the file name, size in
+        bytes, packet count, sha256 and throughput (bytes/s) or None
+        if the download failed."""
 
         content = 'application/vnd.tcpdump.pcap'
         params = dict(capture=pcap_id)
         headers = dict(accept=content)
         self.log(WARN, 'Downloading capture file...')
 
-        # Make an API call and assign the response information to the
-        # variable
+        started = time()
         r = self._get('capture/%s' % self._sim_id,
-                      params=params, headers=headers)
-        if r.status_code == 200 and r.headers.get('content-type') == content:
+                      params=params, headers=headers, stream=True)
+        try:
+            if r.status_code != 200 or r.headers.get('content-type') != content:
+                self.log(ERROR, "problem... %s", r.headers)
+                return None
+
             # "ContentDisposition":
             # "attachment; filename=V1_Ethernet1_1_2016-10-15-17-18-18.pcap
             filename = r.headers.get('Content-Disposition').split('=')[1]
-            with open(filename, "wb") as fh:
-                fh.write(r.content)
-        else:
-            self.log(ERROR, "problem... %s", r.headers)
-            return False
-
-        self.log(WARN, "Download finished.")
-        return True
+            if self._capdir is not None:
+                filename = os.path.join(self._capdir,
+                                        os.path.basename(filename))
+
+            # write into a temporary file first so that an aborted
+            # download does not leave a truncated capture behind
+            size = 0
+            digest = hashlib.sha256()
+            counter = PacketCounter()
+            partial = filename + '.part'
+            try:
+                with open(partial, "wb") as fh:
+                    for chunk in r.iter_content(self.CHUNK_SIZE):
+                        fh.write(chunk)
+                        size += len(chunk)
+                        digest.update(chunk)
+                        counter.feed(chunk)
+                os.replace(partial, filename)
+            except (IOError, OSError, requests.RequestException) as e:
+                self.log(ERROR, "download failed: %s", e)
+                if os.path.exists(partial):
+                    os.remove(partial)
+                return None
+        finally:
+            r.close()
+
+        elapsed = max(time() - started, 1e-6)
+        info = dict(file=filename, bytes=size, packets=counter.packets,
+                    sha256=digest.hexdigest(), seconds=round(elapsed, 3),
+                    throughput=int(size / elapsed))
+        self.log(WARN, "Download finished: %s, %d bytes, %s packets, "
+                 "%d bytes/s", filename, size, counter.packets,
+                 info['throughput'])
+        return info
 
     def getMgmtIP(self, node):
         "Return the management IP of the given Node name."
@@ -412,6 +671,12 @@ class VIRLSim(object):
         if interfaces is None:
             return None
 
+        with self._cache_lock:
+            address = self._mgmt_ips.get(node)
+        if address is not None:
+            self.log(INFO, "Found mgmt ip for %s: %s", node, address)
+            return address
+
         for key, intfc in interfaces.items():
             if key == 'management' and intfc.get('ip-address') is not None:
                 address = intfc.get('ip-address').split('/')[0]
@@ -429,60 +694,191 @@ class VIRLSim(object):
         if self._lxc_port is not None:
             return self._lxc_port
 
-        self._semaphore.acquire()
-        interfaces = self.getInterfaces('~mgmt-lxc')
-        if interfaces is not None:
-            for key, intfc in interfaces.items():
-                if key != 'management' and \
-                   intfc.get('external-ip-address') is not None:
-                    self._lxc_port = int(intfc.get('external-port'))
-                    self.log(INFO, "Found LXC port: %s", self._lxc_port)
-                    break
+        with self._lxc_lock:
+            if self._lxc_port is not None:
+                return self._lxc_port
+
+            interfaces = self.getInterfaces('~mgmt-lxc')
+            if interfaces is not None:
+                for key, intfc in interfaces.items():
+                    if key != 'management' and \
+                       intfc.get('external-ip-address') is not None:
+                        self._lxc_port = int(intfc.get('external-port'))
+                        self.log(INFO, "Found LXC port: %s", self._lxc_port)
+                        break
 
-        # crude hack to make it work with ngrok
-        tmp_lxc = os.environ.get('VIRL_LXC_PORT', None)
-        if tmp_lxc is not None and tmp_lxc:
-            self._lxc_port = int(tmp_lxc)
-        tmp_host = os.environ.get('VIRL_LXC_HOST', None)
-        if tmp_host is not None and tmp_host:
-            self._lxc_host = tmp_host
-
-        if self._lxc_port is None:
-            self.log(ERROR, "Can't find LXC port")
-        self._semaphore.release()
-        return self._lxc_port
+            # crude hack to make it work with ngrok
+            tmp_lxc = os.environ.get('VIRL_LXC_PORT', None)
+            if tmp_lxc is not None and tmp_lxc:
+                self._lxc_port = int(tmp_lxc)
+            tmp_host = os.environ.get('VIRL_LXC_HOST', None)
+            if tmp_host is not None and tmp_host:
+                self._lxc_host = tmp_host
 
-    def sshOpen(self, timeout=5):
-        "Opens a SSH connection to the mgmt LXC."
-        if self._ssh_interact is not None:
-            return self._ssh_interact
+            if self._lxc_port is None:
+                self.log(ERROR, "Can't find LXC port")
+        return self._lxc_port
 
-        self.log(WARN, 'Acquiring LXC SSH session')
-        self._ssh_client = paramiko.SSHClient()
+    def _lxcClient(self):
+        "Opens a new SSH connection to the mgmt LXC, None on failure."
+        client = paramiko.SSHClient()
         paramiko.hostkeys.HostKeys(filename=os.devnull)
         # client.load_system_host_keys()
-        self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         # the below might update self._lxc_host if the env var is set during
         # the execution of getLXCPort().
         port = self.getLXCPort()
         try:
-            self._ssh_client.connect(hostname=self._lxc_host, username=self._username,
-                                     pkey=None, look_for_keys=False, allow_agent=False,
-                                     password=self._password, port=port)
+            client.connect(hostname=self._lxc_host, username=self._username,
+                           pkey=None, look_for_keys=False, allow_agent=False,
+                           password=self._password, port=port)
         except (paramiko.AuthenticationException,
-                paramiko.SSHException) as e:
+                paramiko.SSHException, socket.error) as e:
             self.log(CRITICAL, 'SSH connect failed: %s' % e)
+            client.close()
+            return None
+        # interactive traffic like ssh with a tty: commands and keystrokes
+        # are small, don't hold them back until the last one is ACKed
+        client.get_transport().sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client
+
+    def _sshConnect(self, timeout):
+        "Opens a new SSH connection and shell to the mgmt LXC."
+        self.log(WARN, 'Acquiring LXC SSH session')
+        with metrics.REGISTRY.timed(metrics.SSH_CONNECT_SECONDS):
+            client = self._lxcClient()
+        if client is None:
+            metrics.REGISTRY.inc(metrics.SSH_CONNECT_ERRORS)
             return None
 
-        self._ssh_interact = SSHClientInteraction(self._ssh_client, timeout=timeout,
-                                                  display=self.isLogDebug())
-        return self._ssh_interact
+        interact = SSHClientInteraction(client, timeout=timeout,
+                                        display=self.isLogDebug())
+        return LXCSession(client, interact)
+
+    def sshOpen(self, timeout=5, key=None):
+        """Returns a SSH session to the mgmt LXC from the session pool.
+        Blocks until a session is available, returns None if none frees
+        up within the sim timeout or a new session could not be
+        established within timeout seconds. A session still logged in to
+        the device identified by key is preferred. The session must be
+        given back using sshRelease() or sshDiscard()."""
+        with span('ssh pool', 'wait'), \
+                metrics.REGISTRY.timed(metrics.SSH_OPEN_SECONDS):
+            return self._ssh_pool.acquire(timeout, key, wait=self._timeout)
+
+    def sshRelease(self, session):
+        "Returns a healthy LXC SSH session to the session pool."
+        self._ssh_pool.release(session)
+
+    def sshDiscard(self, session):
+        "Closes a broken LXC SSH session and frees its pool slot."
+        self.log(WARN, 'Closing LXC SSH session')
+        self._ssh_pool.discard(session)
 
     def sshClose(self):
-        "Closes the connection to the mgmt LXC, if it exists."
-        if self._ssh_interact is None:
-            return
-        self.log(WARN, 'Closing LXC SSH session')
-        self._ssh_interact.close()
-        self._ssh_client.close()
-        self._ssh_interact = self._ssh_client = None
+        "Closes all idle connections to the mgmt LXC."
+        self.log(INFO, 'Closing LXC SSH sessions')
+        self._ssh_pool.close()
+
+    def consoleAcquire(self, node, timeout):
+        """Lock the serial console of the node for exclusive use (it only
+        takes one connection). Returns the connection kept open by the
+        previous user or None. Raises socket.timeout if the console is
+        not free within timeout seconds."""
+        with self._cache_lock:
+            lock = self._console_locks.setdefault(node, Lock())
+        with span('console lock', 'wait', node=node):
+            acquired = lock.acquire(timeout=timeout)
+        if not acquired:
+            raise socket.timeout('console of %s busy' % node)
+        with self._cache_lock:
+            return self._consoles.pop(node, None)
+
+    def consoleRelease(self, node, interact=None):
+        """Unlock the console of the node. If given, interact is kept open
+        for the next user of the console."""
+        with self._cache_lock:
+            if interact is not None:
+                self._consoles[node] = interact
+            lock = self._console_locks[node]
+        lock.release()
+
+    def consoleClose(self):
+        "Closes all console connections kept open."
+        with self._cache_lock:
+            consoles, self._consoles = self._consoles, dict()
+        for interact in consoles.values():
+            interact.close()
+
+    def _channelTransport(self):
+        """Returns the SSH transport to the mgmt LXC shared by all forwarded
+        channels, (re)connects if needed. None if the LXC can't be
+        reached."""
+        with self._channel_lock:
+            client = self._channel_client
+            if client is None or not client.get_transport().is_active():
+                if client is not None:
+                    client.close()
+                self.log(WARN, 'Opening LXC SSH transport for channels')
+                self._channel_client = client = self._lxcClient()
+                if client is None:
+                    return None
+            return client.get_transport()
+
+    def channelOpen(self, address, port, timeout):
+        """Opens a direct-tcpip channel through the mgmt LXC to address and
+        port, each attempt takes at most timeout seconds. All channels
+        share one SSH connection. While the connection is refused (e.g.
+        the device is still booting) it is retried with backoff for up
+        to half the sim timeout. Raises socket.error on failure and
+        paramiko.ChannelException if the LXC does not forward."""
+        backoff = self.backoff(self._timeout / 2)
+        while True:
+            transport = self._channelTransport()
+            if transport is None:
+                raise socket.error('no SSH connection to the mgmt LXC')
+            try:
+                return transport.open_channel(
+                    'direct-tcpip', (address, port), ('127.0.0.1', 0),
+                    timeout=timeout)
+            except paramiko.ChannelException as e:
+                if e.code == paramiko.common.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED:
+                    raise
+                if backoff.expired():
+                    raise socket.error('channel to %s:%d failed (%s)' % (
+                        address, port, e))
+                self.log(WARN, 'channel to %s:%d failed (%s), retrying',
+                         address, port, e)
+            except paramiko.SSHException as e:
+                if backoff.expired():
+                    raise socket.error(str(e))
+                self.log(WARN, 'LXC SSH transport failed (%s), retrying', e)
+            with span('sleep', 'wait', address=address):
+                sleep(backoff.next())
+
+    def deviceAcquire(self, key):
+        """Returns an idle device login identified by key (kept open with
+        deviceRelease) or None."""
+        with self._cache_lock:
+            idle = self._devices.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def deviceRelease(self, key, interact):
+        "Keep the device login open for the next user of the key."
+        with self._cache_lock:
+            self._devices.setdefault(key, list()).append(interact)
+
+    def channelClose(self):
+        "Closes all idle device logins and the shared LXC SSH transport."
+        with self._cache_lock:
+            devices, self._devices = self._devices, dict()
+        for idle in devices.values():
+            for interact in idle:
+                interact.close()
+        with self._channel_lock:
+            if self._channel_client is not None:
+                self._channel_client.close()
+                self._channel_client = None